@@ -0,0 +1,57 @@
+"""
+Measures the bytes allocated by a single pixel type conversion, before (the former implementation, which always went
+through numpy.float32(array) and friends) and after the copy-free conversion layer in exrconverter.utils.
+
+Run from the repository root:
+    python benchmarks/change_array_type.py
+"""
+import tracemalloc
+import numpy
+from exrconverter import utils
+from exrconverter.pixeltype import PixelType
+
+change_array_type = getattr(utils, '__change_array_type')
+new_buffer = getattr(utils, '__new_buffer')
+
+SHAPE = (2048, 2048)
+
+
+def legacy_change_array_type(array, pixel_type):
+    if pixel_type == PixelType.FLOAT64:
+        return numpy.float32(array)
+    if pixel_type == PixelType.FLOAT32:
+        return numpy.float32(array)
+    elif pixel_type == PixelType.FLOAT16:
+        return numpy.float16(array)
+    else:
+        raise Exception("Unsupported pixel_format value " + str(pixel_type))
+
+
+def allocated_bytes(function, *args, **kwargs):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    result = function(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return peak
+
+
+def main():
+    cases = [
+        ("float32 -> FLOAT32 (EXR/TIFF channel)", numpy.zeros(SHAPE, dtype=numpy.float32), PixelType.FLOAT32, {}),
+        ("big-endian float32 -> FLOAT32 (FITS HDU)", numpy.zeros(SHAPE, dtype='>f4'), PixelType.FLOAT32, {}),
+        ("big-endian float32 -> FLOAT16 (FITS HDU)", numpy.zeros(SHAPE, dtype='>f4'), PixelType.FLOAT16, {}),
+        ("big-endian float32 -> FLOAT16 into reused buffer", numpy.zeros(SHAPE, dtype='>f4'), PixelType.FLOAT16,
+         {'out': new_buffer(SHAPE, PixelType.FLOAT16)}),
+    ]
+
+    print("%-50s %14s %14s" % ("conversion", "before (bytes)", "after (bytes)"))
+    for name, array, pixel_type, kwargs in cases:
+        before = allocated_bytes(legacy_change_array_type, array, pixel_type)
+        after = allocated_bytes(change_array_type, array, pixel_type, **kwargs)
+        print("%-50s %14d %14d" % (name, before, after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Generators of synthetic FITS, TIFF and EXR files for the benchmarks. The pixels look vaguely like an astronomical frame
+(sky background, noise and a few point sources), and are generated from a fixed seed so that runs are reproducible.
+"""
+import json
+import os
+import numpy
+
+SEED = 20190401
+
+
+def make_image(width, height, layer=0, dtype=numpy.float32):
+    """
+    Returns a synthetic 2D image of the given size. Different layers get different (but reproducible) pixels.
+    """
+    random = numpy.random.RandomState(SEED + layer)
+    y, x = numpy.mgrid[0:height, 0:width]
+    image = 100.0 + 0.01 * x + 0.02 * y + random.normal(0.0, 5.0, (height, width))
+
+    # Point sources, drawn as gaussians on 15x15 pixel stamps.
+    stamp_y, stamp_x = numpy.mgrid[-7:8, -7:8]
+    stamp = numpy.exp(-(stamp_x ** 2 + stamp_y ** 2) / 8.0)
+    for _ in range(max(width * height // 2000, 1)):
+        center_x, center_y = random.randint(7, max(width - 7, 8)), random.randint(7, max(height - 7, 8))
+        target = image[center_y - 7:center_y + 8, center_x - 7:center_x + 8]
+        target += random.uniform(100.0, 5000.0) * stamp[:target.shape[0], :target.shape[1]]
+    return image.astype(dtype)
+
+
+def make_fits(path, width, height, hdus=3):
+    """
+    Writes a FITS file with an image in the primary HDU and hdus - 1 image extensions, all float32.
+    """
+    from astropy.io import fits
+    hdu_list = fits.HDUList()
+    for index in range(hdus):
+        hdu_class = fits.PrimaryHDU if index == 0 else fits.ImageHDU
+        hdu = hdu_class(data=make_image(width, height, index))
+        hdu.header['FILTER'] = 'ugriz'[index % 5]
+        hdu.header['CRPIX1'] = width / 2.0
+        hdu.header['CRPIX2'] = height / 2.0
+        hdu_list.append(hdu)
+    hdu_list.writeto(path, overwrite=True)
+
+
+def make_tiff(path, width, height, pages=3):
+    """
+    Writes a multi-page float32 TIFF file.
+    """
+    import SimpleITK as sitk
+    stack = numpy.stack([make_image(width, height, index) for index in range(pages)])
+    sitk.WriteImage(sitk.GetImageFromArray(stack), path)
+
+
+def make_exr(path, width, height, channels=3, pixel_type=numpy.float32, headers='fits'):
+    """
+    Writes a multi-channel EXR file laid out as the ones written by fits2exr (headers='fits') or tiff2exr
+    (headers='tiff'), so that it can be converted back by exr2fits or exr2tiff.
+    """
+    import Imath
+    import OpenEXR
+    exr_header = OpenEXR.Header(width, height)
+    exr_pixel = OpenEXR.HALF if pixel_type == numpy.float16 else OpenEXR.FLOAT
+    exr_header['channels'] = dict((str(index), Imath.Channel(Imath.PixelType(exr_pixel))) for index in range(channels))
+
+    if headers == 'fits':
+        from astropy.io import fits
+        fits_headers = [fits.Header([('FILTER', 'ugriz'[index % 5])]).tostring() for index in range(channels)]
+        exr_header['fits_headers'] = str.encode(json.dumps(fits_headers))
+    elif headers == 'tiff':
+        exr_header['tiff_headers'] = str.encode(json.dumps([{}] + [{} for _ in range(channels)]))
+
+    exr_file = OpenEXR.OutputFile(path, exr_header)
+    try:
+        exr_file.writePixels(dict((str(index), make_image(width, height, index, pixel_type))
+                                  for index in range(channels)))
+    finally:
+        exr_file.close()
+
+
+def make_directory(path, kind, files, width, height, layers=3):
+    """
+    Fills a directory with synthetic files of one kind: 'fits', 'tiff', 'exr-fits' or 'exr-tiff'.
+    :return: list of the generated paths.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    paths = []
+    for index in range(files):
+        if kind == 'fits':
+            paths.append(os.path.join(path, 'frame-%04d.fits' % index))
+            make_fits(paths[-1], width, height, layers)
+        elif kind == 'tiff':
+            paths.append(os.path.join(path, 'frame-%04d.tif' % index))
+            make_tiff(paths[-1], width, height, layers)
+        elif kind in ('exr-fits', 'exr-tiff'):
+            paths.append(os.path.join(path, 'frame-%04d.exr' % index))
+            make_exr(paths[-1], width, height, layers, headers=kind[4:])
+        else:
+            raise Exception("Unsupported kind " + str(kind))
+    return paths
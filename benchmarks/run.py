@@ -0,0 +1,174 @@
+"""
+End-to-end benchmark of the conversions. Every convert and convert_directory path is run on synthetic files (see
+generators.py) in a fresh process, and its wall time, throughput in megapixels per second and peak RSS are recorded.
+The results are written as JSON, and can be compared with the results of a previous release to spot regressions.
+
+Run from the repository root:
+    python benchmarks/run.py --size 2048 --layers 3 --files 4 --output results.json
+    python benchmarks/run.py --compare baseline.json --output results.json
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import generators
+
+# (name, module, function, input kind, input extension, output extension, extra keyword arguments)
+CASES = [
+    ('fits2exr.convert', 'fits2exr', 'convert', 'fits', 'fits', 'exr', {}),
+    ('fits2exr.convert[streaming]', 'fits2exr', 'convert', 'fits', 'fits', 'exr', {'streaming': True}),
+    ('exr2fits.convert', 'exr2fits', 'convert', 'exr-fits', 'exr', 'fits', {}),
+    ('exr2fits.convert[streaming]', 'exr2fits', 'convert', 'exr-fits', 'exr', 'fits', {'streaming': True}),
+    ('fits2exr.convert[threads]', 'fits2exr', 'convert', 'fits', 'fits', 'exr', {'threads': os.cpu_count()}),
+    ('exr2fits.convert[threads]', 'exr2fits', 'convert', 'exr-fits', 'exr', 'fits', {'threads': os.cpu_count()}),
+    ('tiff2exr.convert', 'tiff2exr', 'convert', 'tiff', 'tif', 'exr', {}),
+    ('exr2tiff.convert', 'exr2tiff', 'convert', 'exr-tiff', 'exr', 'tif', {}),
+    ('fits2exr.convert_directory', 'fits2exr', 'convert_directory', 'fits', 'fits', 'exr', {}),
+    ('exr2fits.convert_directory', 'exr2fits', 'convert_directory', 'exr-fits', 'exr', 'fits', {}),
+    ('tiff2exr.convert_directory', 'tiff2exr', 'convert_directory', 'tiff', 'tif', 'exr', {}),
+    ('exr2tiff.convert_directory', 'exr2tiff', 'convert_directory', 'exr-tiff', 'exr', 'tif', {}),
+]
+
+
+def run_case(module_name, function_name, input_path, output_path, kwargs):
+    """
+    Runs one conversion. Meant to be called in a fresh process, so that ru_maxrss only reflects this conversion.
+    """
+    import importlib
+    module = importlib.import_module('exrconverter.' + module_name)
+    rss_before = __max_rss()
+
+    start = time.perf_counter()
+    if function_name == 'convert':
+        getattr(module, function_name)(input_path, output_path, verbose=False, **kwargs)
+    else:
+        result = getattr(module, function_name)(input_path, verbose=False, **kwargs)
+        if len(result.failed) > 0:
+            raise Exception(result.failed[0].error)
+    elapsed = time.perf_counter() - start
+
+    return elapsed, rss_before, __max_rss()
+
+
+def run(size, layers, files, workers, repeat, cases=None):
+    """
+    Runs the benchmark cases and returns the results as a dictionary.
+    """
+    work_dir = tempfile.mkdtemp(prefix='exrconverter-benchmark-')
+    context = multiprocessing.get_context('spawn')
+    results = []
+
+    try:
+        for name, module_name, function_name, kind, input_extension, output_extension, kwargs in CASES:
+            if cases and name not in cases:
+                continue
+
+            case_dir = os.path.join(work_dir, name.replace('.', '_').replace('[', '_').replace(']', ''))
+            count = files if function_name == 'convert_directory' else 1
+            inputs = generators.make_directory(case_dir, kind, count, size, size, layers)
+            if function_name == 'convert':
+                input_path, output_path = inputs[0], inputs[0][:-len(input_extension)] + output_extension
+            else:
+                input_path, output_path = case_dir, None
+                kwargs = dict(kwargs, workers=workers)
+
+            timings = []
+            for _ in range(repeat):
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    timings.append(executor.submit(run_case, module_name, function_name, input_path, output_path,
+                                                   kwargs).result())
+            elapsed, rss_before, rss_after = min(timings)
+            megapixels = size * size * layers * count / 1e6
+
+            results.append({'name': name, 'files': count, 'megapixels': megapixels, 'seconds': elapsed,
+                            'mp_per_s': megapixels / elapsed, 'peak_rss_mb': rss_after,
+                            'peak_rss_over_import_mb': rss_after - rss_before})
+            print ("%-32s %8.3fs %10.1f MP/s %10.1f MB peak RSS" % (name, elapsed, megapixels / elapsed, rss_after))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {'parameters': {'size': size, 'layers': layers, 'files': files, 'workers': workers, 'repeat': repeat},
+            'environment': __environment(), 'results': results}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the change of every case with respect to a baseline run. Returns the names of the cases whose throughput
+    dropped, or whose peak RSS grew, by more than tolerance (a fraction).
+    """
+    baseline_results = dict((result['name'], result) for result in baseline['results'])
+    regressions = []
+    for result in results['results']:
+        previous = baseline_results.get(result['name'])
+        if previous is None:
+            continue
+        speed = result['mp_per_s'] / previous['mp_per_s'] - 1
+        memory = result['peak_rss_mb'] / previous['peak_rss_mb'] - 1
+        regressed = speed < -tolerance or memory > tolerance
+        if regressed:
+            regressions.append(result['name'])
+        print ("%-32s throughput %+7.1f%%   peak RSS %+7.1f%%%s" % (result['name'], 100 * speed, 100 * memory,
+                                                                  "   REGRESSION" if regressed else ""))
+    return regressions
+
+
+def __max_rss():
+    # Worker processes of convert_directory are counted through RUSAGE_CHILDREN (the largest one, once finished).
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    max_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return max_rss / 1024.0 ** 2 if sys.platform == 'darwin' else max_rss / 1024.0
+
+
+def __environment():
+    import numpy
+    environment = {'python': platform.python_version(), 'platform': platform.platform(), 'numpy': numpy.__version__,
+                   'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    for package in ('astropy', 'OpenEXR', 'SimpleITK'):
+        try:
+            environment[package] = getattr(__import__(package), '__version__', 'unknown')
+        except ImportError:
+            environment[package] = None
+    return environment
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=1024, help='width and height of the images, in pixels')
+    parser.add_argument('--layers', type=int, default=3, help='HDUs, pages or channels per file')
+    parser.add_argument('--files', type=int, default=4, help='files per directory for the convert_directory cases')
+    parser.add_argument('--workers', type=int, default=1, help='workers for the convert_directory cases')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per case, the fastest one is reported')
+    parser.add_argument('--case', action='append', help='only run this case (can be given several times)')
+    parser.add_argument('--output', help='path of the JSON file with the results')
+    parser.add_argument('--compare', help='path of the JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change reported as a regression')
+    arguments = parser.parse_args()
+
+    results = run(arguments.size, arguments.layers, arguments.files, arguments.workers, arguments.repeat,
+                  arguments.case)
+
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), arguments.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
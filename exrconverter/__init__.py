@@ -1 +1 @@
-__all__ = ["exr2fits", "fits2exr", "tiff2exr", "exr2tiff", "pixeltypes"]
\ No newline at end of file
+__all__ = ["exr2fits", "fits2exr", "tiff2exr", "exr2tiff", "pixeltypes", "batch", "region", "compression", "stats", "catalog", "tiffpages", "image", "router", "worker", "cli", "verification"]
\ No newline at end of file
@@ -0,0 +1,469 @@
+import hashlib
+import json
+import os
+import shutil
+import socket
+import time
+import traceback
+import uuid
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from .stats import ConversionStats
+
+__POOL_TYPES = {'process': ProcessPoolExecutor, 'thread': ThreadPoolExecutor}
+
+# Name of the manifest file kept by the incremental mode of convert_directory, inside the converted directory.
+# Sharded batches keep one manifest per shard, named .exrconverter-manifest.<shard_index>.jsonl, and the batches of an
+# unsharded claim run one per node, named .exrconverter-manifest.<claim_run>.<host>.<pid>.jsonl, and read them all.
+MANIFEST_NAME = '.exrconverter-manifest.jsonl'
+
+# Directory, inside the converted directory, of the claim files of the work claiming mode of convert_directory.
+CLAIMS_NAME = '.exrconverter-claims'
+
+
+class FileResult(object):
+    """
+    Outcome of converting a single file inside a batch.
+    """
+
+    def __init__(self, input_path, output_path, error=None, error_traceback=None, elapsed=0.0, stats=None,
+                 skipped=False):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.error = error
+        self.error_traceback = error_traceback
+        self.elapsed = elapsed
+        self.stats = stats
+        self.skipped = skipped
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    def __repr__(self):
+        status = "ok" if self.succeeded else "failed: " + self.error
+        if self.skipped:
+            status = "skipped"
+        return "FileResult(" + self.input_path + ", " + status + ", " + "%.3fs" % self.elapsed + ")"
+
+
+class BatchResult(object):
+    """
+    Summary of a batch conversion. The results are kept in the same (sorted) order as the input files,
+    regardless of the order in which the workers finished them.
+    """
+
+    def __init__(self, results, elapsed):
+        self.results = results
+        self.elapsed = elapsed
+
+    @property
+    def succeeded(self):
+        return [result for result in self.results if result.succeeded]
+
+    @property
+    def failed(self):
+        return [result for result in self.results if not result.succeeded]
+
+    @property
+    def skipped(self):
+        """
+        Results of the files that were not converted, because they were up to date or claimed by another node.
+        """
+        return [result for result in self.results if result.skipped]
+
+    @property
+    def stats(self):
+        """
+        ConversionStats of the whole batch: the stages, bytes and pixels of every file added up, and the largest peaks.
+        """
+        stats = ConversionStats()
+        for result in self.results:
+            if result.stats is not None:
+                stats.merge(result.stats)
+        return stats
+
+    def summary(self):
+        if len(self.skipped) == 0:
+            return "Converted %d of %d files (%d failed) in %.3fs" % (len(self.succeeded), len(self.results),
+                                                                     len(self.failed), self.elapsed)
+        return "Converted %d of %d files (%d failed, %d skipped) in %.3fs" % (
+            len(self.succeeded) - len(self.skipped), len(self.results), len(self.failed), len(self.skipped),
+            self.elapsed)
+
+    def __repr__(self):
+        return "BatchResult(" + self.summary() + ")"
+
+
+class Manifest(object):
+    """
+    Record of the files converted by previous batches, used by the incremental mode of convert_directory to skip
+    the files whose output is up to date. It is kept as a JSON lines file, with one entry appended per converted (or
+    failed) file, so that a batch that dies halfway loses nothing but the files it was converting. When an input
+    appears several times, its last entry wins.
+    Each entry holds the input path, size and modification time (plus its SHA-256 digest if checksum is True), a
+    fingerprint of the conversion options, the output path and size, and the error if the conversion failed.
+    :param path: path of the manifest file. Paths inside it are stored relative to its directory.
+    :param checksum: If True, inputs whose modification time changed are hashed, and only converted again if their
+                     content changed too (e.g. after being copied). Otherwise, size and modification time are trusted.
+    :param shared_paths: paths of other manifests of the same directory, written by concurrent batches (such as the
+                         other shards of a sharded batch), which are read but never written.
+    """
+
+    def __init__(self, path, checksum=False, shared_paths=()):
+        self.path = path
+        self.checksum = checksum
+        self.entries = {}
+        self.__states = {}
+        for shared_path in shared_paths:
+            if shared_path != path and os.path.exists(shared_path):
+                self.__read(shared_path)
+        if os.path.exists(path):
+            self.__load()
+
+    def is_up_to_date(self, input_path, output_path, options):
+        """
+        Checks whether an input was already converted successfully, with the same options, into an output that is
+        still there. The state of the input is kept, and recorded by record() once the conversion ends.
+        """
+        state = self.__input_state(input_path)
+        entry = self.entries.get(self.__relative(input_path))
+        self.__states[input_path] = state
+
+        if entry is None or entry.get('error') is not None or entry.get('options') != options:
+            return False
+        if entry.get('output') != self.__relative(output_path) or not os.path.exists(output_path) \
+                or os.path.getsize(output_path) != entry.get('output_size'):
+            return False
+        if entry.get('size') != state['size']:
+            return False
+        if entry.get('mtime_ns') == state['mtime_ns']:
+            return True
+        if self.checksum and entry.get('sha256') is not None:
+            state['sha256'] = self.__hash(input_path)
+            return entry['sha256'] == state['sha256']
+        return False
+
+    def record(self, result, options):
+        """
+        Appends the outcome of a conversion (a FileResult) to the manifest.
+        """
+        state = self.__states.pop(result.input_path, None) or self.__input_state(result.input_path)
+        if self.checksum and 'sha256' not in state and result.succeeded:
+            state['sha256'] = self.__hash(result.input_path)
+
+        entry = dict(state, input=self.__relative(result.input_path), output=self.__relative(result.output_path),
+                     options=options, error=result.error, time=time.time())
+        entry['output_size'] = os.path.getsize(result.output_path) \
+            if result.succeeded and os.path.exists(result.output_path) else None
+        self.entries[entry['input']] = entry
+        with open(self.path, 'a') as manifest_file:
+            manifest_file.write(json.dumps(entry) + '\n')
+
+    def __load(self):
+        lines, own_entries = self.__read(self.path)
+
+        # Superseded entries are dropped by rewriting the manifest, atomically, once they make up most of it.
+        if lines > 2 * len(own_entries):
+            temp_path = temporary_path(self.path)
+            with open(temp_path, 'w') as manifest_file:
+                for entry in own_entries.values():
+                    manifest_file.write(json.dumps(entry) + '\n')
+            os.replace(temp_path, self.path)
+
+    def __read(self, path):
+        # Returns the number of lines of the manifest, and its last entry per input. Entries of several manifests
+        # are merged by keeping the most recent one.
+        lines = 0
+        entries = {}
+        with open(path) as manifest_file:
+            for line in manifest_file:
+                lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a batch that died while writing it
+                entries[entry['input']] = entry
+        for input_path, entry in entries.items():
+            if input_path not in self.entries or self.entries[input_path]['time'] <= entry['time']:
+                self.entries[input_path] = entry
+        return lines, entries
+
+    def __relative(self, path):
+        return os.path.relpath(path, os.path.dirname(os.path.abspath(self.path)))
+
+    def __input_state(self, input_path):
+        status = os.stat(input_path)
+        return {'size': status.st_size, 'mtime_ns': status.st_mtime_ns}
+
+    def __hash(self, input_path):
+        digest = hashlib.sha256()
+        with open(input_path, 'rb') as input_file:
+            for chunk in iter(lambda: input_file.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+
+def list_directory(path, input_extensions, output_extension):
+    """
+    Lists the files in a directory that have one of the given extensions, paired with their output paths.
+    :param path: path of the directory.
+    :param input_extensions: list of accepted file extensions, without the leading dot. Example: ['tiff', 'tif'].
+    :param output_extension: extension of the output files, without the leading dot. Example: 'exr'.
+    :return: list of (input_path, output_path) tuples, sorted by file name.
+    """
+    jobs = []
+    for filename in sorted(os.listdir(path)):
+        if filename.startswith('.'):
+            continue  # hidden files, such as the temporary outputs of convert_file and the manifest
+        for extension in input_extensions:
+            if filename.endswith('.' + extension):
+                output_filename = filename[:-len(extension)] + output_extension
+                jobs.append((path + '/' + filename, path + '/' + output_filename))
+                break
+    return jobs
+
+
+def shard(jobs, shard_index, shard_count):
+    """
+    Splits a list of jobs into shard_count shards of about the same total input size, and returns one of them. The
+    split only depends on the file names and sizes, so that every node of an array job computes the same one: the
+    files are taken from the largest to the smallest, and each goes to the shard with the smallest total so far.
+    :param jobs: list of (input_path, output_path) tuples, as returned by list_directory.
+    :param shard_index: index of the shard to return, from 0 to shard_count - 1.
+    :param shard_count: number of shards.
+    :return: the jobs of the shard, in the same order as in jobs.
+    """
+    if shard_index < 0 or shard_index >= shard_count:
+        raise Exception("Shard index " + str(shard_index) + " out of range for " + str(shard_count) + " shards")
+
+    sizes = dict((job[0], os.path.getsize(job[0])) for job in jobs)
+    totals = [0] * shard_count
+    owners = {}
+    for input_path, output_path in sorted(jobs, key=lambda job: (-sizes[job[0]], job[0])):
+        owner = totals.index(min(totals))
+        owners[input_path] = owner
+        totals[owner] += sizes[input_path]
+    return [job for job in jobs if owners[job[0]] == shard_index]
+
+
+def claim(claims_path, input_path):
+    """
+    Claims a file for conversion by creating its claim file, which only succeeds for one node, even on a shared
+    filesystem (files are created with O_EXCL). Claim files hold the host, process and time of the claim.
+    :param claims_path: directory of the claim files of the batch.
+    :param input_path: path of the file to claim.
+    :return: True if the file was claimed, False if another node claimed it first.
+    """
+    if not os.path.exists(claims_path):
+        os.makedirs(claims_path, exist_ok=True)
+    try:
+        claim_file = os.open(os.path.join(claims_path, os.path.basename(input_path)),
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(claim_file, 'w') as claim_file:
+        claim_file.write(json.dumps({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}))
+    return True
+
+
+def release(claims_path, input_path):
+    """
+    Removes the claim of a file, e.g. after its conversion failed, so that another node, or a later batch of the same
+    run, can claim it again.
+    """
+    try:
+        os.remove(os.path.join(claims_path, os.path.basename(input_path)))
+    except FileNotFoundError:
+        pass
+
+
+def clear_claims(path, claim_run=None):
+    """
+    Removes the claim files of a finished run of convert_directory, or of every run if claim_run is None. Claims are
+    kept once a run is over, so that a batch started late with the same run name does not convert the files again.
+    Only clear the claims of runs that no batch is still working on.
+    :param path: path of the converted directory.
+    :param claim_run: name of the run.
+    """
+    claims_path = os.path.join(path, CLAIMS_NAME)
+    if claim_run is not None:
+        claims_path = os.path.join(claims_path, claim_run)
+    shutil.rmtree(claims_path, ignore_errors=True)
+
+
+def convert_directory(convert_function, path, input_extensions, output_extension, options, workers=1,
+                      pool='process', verbose=True, incremental=False, checksum=False, shard_index=0, shard_count=1,
+                      claim_run=None, trace_memory=False):
+    """
+    Converts the files of a directory. Shared implementation of the convert_directory function of every converter.
+    :param convert_function: conversion function. See run.
+    :param path: path of the directory.
+    :param input_extensions: list of accepted file extensions. See list_directory.
+    :param output_extension: extension of the output files. See list_directory.
+    :param options: dictionary of keyword arguments passed to convert_function.
+    :param workers: number of files converted simultaneously. See run.
+    :param pool: 'process' or 'thread'. See run.
+    :param verbose: Boolean variable for deciding whether to print progress and warning messages.
+    :param incremental: If True, up to date files are skipped according to a Manifest kept in the directory.
+    :param checksum: If True, the manifest compares the content of the files whose modification time changed.
+    :param shard_index: index, from 0 to shard_count - 1, of the part of the directory converted by this batch.
+    :param shard_count: number of batches (e.g. the nodes of an array job) the directory is split among. See shard.
+    :param claim_run: If not None, name of the run, shared by all its batches (e.g. the id of the array job). Every
+                      file is then claimed before being converted (see claim), and once a batch is done with its
+                      shard, it goes on with the files of the other shards that nobody claimed yet, starting from
+                      their end. No file is converted twice within a run, and idle nodes help the slow ones. The
+                      claims of files that failed are released, so that batches reaching them later retry them. The
+                      claims of a finished run are kept in the directory until removed with clear_claims.
+                      In incremental mode, unsharded batches of a run keep a manifest per node (host and process),
+                      which are left in the directory, and read by every later batch.
+    :param trace_memory: If True, the peak memory of every conversion is traced. See run.
+    :return: a BatchResult object.
+    """
+    jobs = list_directory(path, input_extensions, output_extension)
+    own_jobs = shard(jobs, shard_index, shard_count) if shard_count > 1 else jobs
+    if claim_run is not None:
+        own_inputs = set(job[0] for job in own_jobs)
+        own_jobs = own_jobs + [job for job in reversed(jobs) if job[0] not in own_inputs]
+
+    manifest = None
+    if incremental:
+        manifest_path = os.path.join(path, MANIFEST_NAME)
+        shared_paths = [os.path.join(path, filename) for filename in sorted(os.listdir(path))
+                        if filename.startswith(MANIFEST_NAME[:-len('jsonl')]) and filename.endswith('.jsonl')]
+        if shard_count > 1:
+            manifest_path = os.path.join(path, MANIFEST_NAME[:-len('jsonl')] + str(shard_index) + '.jsonl')
+        elif claim_run is not None:  # every node of the run must compact its own manifest only
+            manifest_path = os.path.join(path, MANIFEST_NAME[:-len('jsonl')] + '.'.join(
+                [claim_run, socket.gethostname(), str(os.getpid()), 'jsonl']))
+        manifest = Manifest(manifest_path, checksum, shared_paths)
+
+    claims_path = os.path.join(path, CLAIMS_NAME, claim_run) if claim_run is not None else None
+    return run(convert_function, own_jobs, kwargs=options, workers=workers, pool=pool, verbose=verbose,
+               manifest=manifest, claims_path=claims_path, trace_memory=trace_memory)
+
+
+def temporary_path(path):
+    """
+    Returns a unique path for a hidden temporary file next to path, keeping its extension (SimpleITK picks the file
+    format from it). Renaming the temporary file over path is atomic, since both are in the same directory.
+    """
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, '.' + filename + '.' + uuid.uuid4().hex[:12] + os.path.splitext(filename)[1])
+
+
+def convert_file(convert_function, input_path, output_path, args=(), kwargs=None, atomic=False, claims_path=None,
+                 trace_memory=False):
+    """
+    Runs a single conversion, capturing any error instead of raising it.
+    :param atomic: If True, the output is written to a temporary file which is renamed to output_path once the
+                   conversion succeeds, so that output_path never holds a partially written file, and a failed
+                   conversion leaves the previous output in place.
+    :param claims_path: If not None, the file is claimed in this directory first (see claim), and skipped if another
+                        node claimed it already. Claiming happens here, when a worker gets to the file, so that
+                        queued files remain available to other nodes. The claim is released if the conversion fails.
+    :param trace_memory: trace_memory argument of the ConversionStats of the conversion.
+    :return: a FileResult object, with the ConversionStats of the conversion.
+    """
+    if claims_path is not None and not claim(claims_path, input_path):
+        return FileResult(input_path, output_path, skipped=True)
+
+    stats = ConversionStats(trace_memory=trace_memory)
+    start = time.perf_counter()
+    target_path = temporary_path(output_path) if atomic else output_path
+    try:
+        convert_function(input_path, target_path, *args, stats=stats, **(kwargs or {}))
+        if atomic and os.path.exists(target_path):
+            os.replace(target_path, output_path)
+    except Exception as e:
+        if claims_path is not None:
+            release(claims_path, input_path)
+        return FileResult(input_path, output_path, error=repr(e), error_traceback=traceback.format_exc(),
+                          elapsed=time.perf_counter() - start, stats=stats)
+    finally:
+        if atomic and os.path.exists(target_path):
+            os.remove(target_path)
+    return FileResult(input_path, output_path, elapsed=time.perf_counter() - start, stats=stats)
+
+
+def run(convert_function, jobs, args=(), kwargs=None, workers=1, pool='process', verbose=True, manifest=None,
+        claims_path=None, trace_memory=False):
+    """
+    Converts a list of files, optionally in parallel. A failure in one file does not abort the batch; it is
+    recorded in the returned BatchResult instead.
+    :param convert_function: conversion function, called as convert_function(input_path, output_path, *args,
+                             stats=stats, **kwargs), where stats is the exrconverter.stats.ConversionStats object of
+                             the file. It must be defined at module level when pool='process', so that it can be
+                             pickled.
+    :param jobs: list of (input_path, output_path) tuples, as returned by list_directory.
+    :param args: extra positional arguments passed to convert_function.
+    :param kwargs: extra keyword arguments passed to convert_function.
+    :param workers: number of files converted simultaneously. If equal to 1, files are converted one at a time in
+                    the calling process.
+    :param pool: 'process' for a pool of processes (best for CPU bound codecs), or 'thread' for a pool of threads.
+    :param verbose: Boolean variable for deciding whether to print progress and warning messages.
+    :param manifest: If not None, a Manifest object. Jobs whose output is up to date according to it are skipped,
+                     the other outputs are written atomically (see convert_file), and every outcome is recorded in
+                     it. This makes reruns of an interrupted or partly failed batch only convert what is left.
+    :param claims_path: If not None, directory of the claim files shared with concurrent batches. Jobs claimed by
+                        another batch are skipped. See convert_file.
+    :param trace_memory: If True, the peak memory allocated through python and numpy by every conversion is traced
+                         with tracemalloc (see exrconverter.stats.ConversionStats). In a pool of threads, the files
+                         converted at the same time are traced together.
+    :return: a BatchResult object, with one FileResult per job, in the same order as jobs. BatchResult.stats adds up
+             the ConversionStats of every file, e.g. to export them with BatchResult.stats.to_dict().
+    :example: run(fits2exr.convert, list_directory('path/to/fits', ['fits'], 'exr'), workers=8)
+    """
+    if pool not in __POOL_TYPES:
+        raise Exception("Unsupported pool type " + str(pool))
+
+    start = time.perf_counter()
+    results = []
+    atomic = manifest is not None
+    options = __fingerprint(convert_function, args, kwargs) if manifest is not None else None
+
+    if workers is None or workers <= 1:
+        for input_path, output_path in jobs:
+            if manifest is not None and manifest.is_up_to_date(input_path, output_path, options):
+                results.append(FileResult(input_path, output_path, skipped=True))
+                continue
+            if verbose and claims_path is None:
+                print ("Converting: " + os.path.basename(input_path))
+            result = convert_file(convert_function, input_path, output_path, args, kwargs, atomic, claims_path,
+                                  trace_memory)
+            results.append(__report(result, verbose, manifest, options, claims_path))
+    else:
+        with __POOL_TYPES[pool](max_workers=workers) as executor:
+            futures = []
+            for input_path, output_path in jobs:
+                if manifest is not None and manifest.is_up_to_date(input_path, output_path, options):
+                    futures.append(FileResult(input_path, output_path, skipped=True))
+                    continue
+                if verbose and claims_path is None:
+                    print ("Converting: " + os.path.basename(input_path))
+                futures.append(executor.submit(convert_file, convert_function, input_path, output_path, args, kwargs,
+                                               atomic, claims_path, trace_memory))
+            for future in futures:
+                if isinstance(future, FileResult):
+                    results.append(future)
+                else:
+                    results.append(__report(future.result(), verbose, manifest, options, claims_path))
+
+    return BatchResult(results, time.perf_counter() - start)
+
+
+def __fingerprint(convert_function, args, kwargs):
+    # Options that change the output. The verbose flag does not, so it is left out.
+    options = dict((key, value) for key, value in (kwargs or {}).items() if key != 'verbose')
+    return repr((convert_function.__module__, convert_function.__name__, tuple(args), sorted(options.items())))
+
+
+def __report(result, verbose, manifest=None, options=None, claims_path=None):
+    # In work claiming mode, a file is only known to be converted by this batch once it is done.
+    if verbose and claims_path is not None and not result.skipped:
+        print ("Converted: " + os.path.basename(result.input_path))
+    if verbose and not result.succeeded:
+        warnings.warn("Failed to convert " + result.input_path + ": " + result.error)
+    if manifest is not None and not result.skipped:
+        manifest.record(result, options)
+    return result
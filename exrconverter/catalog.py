@@ -0,0 +1,276 @@
+import json
+import os
+import sqlite3
+import warnings
+import OpenEXR
+from .utils import __TIFF_HEADERS_ID, __decode_fits_headers, __get_fits_header_indexes
+from .router import EXTENSIONS
+
+# Numpy dtype names of the EXR channel types (Imath.PixelType values) and of the FITS BITPIX values.
+__EXR_DTYPES = {0: 'uint32', 1: 'float16', 2: 'float32'}
+__FITS_DTYPES = {8: 'uint8', 16: 'int16', 32: 'int32', 64: 'int64', -32: 'float32', -64: 'float64'}
+
+# Keywords that repeat within a FITS header, and are left out of the decoded headers.
+__FITS_COMMENTARY = ('', 'COMMENT', 'HISTORY')
+
+__SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, format TEXT, size INTEGER,
+                                  mtime_ns INTEGER, width INTEGER, height INTEGER, layers INTEGER, compression TEXT);
+CREATE TABLE IF NOT EXISTS layers (file_id INTEGER, layer INTEGER, name TEXT, dtype TEXT, width INTEGER,
+                                   height INTEGER);
+CREATE TABLE IF NOT EXISTS headers (file_id INTEGER, layer INTEGER, keyword TEXT, value TEXT);
+CREATE INDEX IF NOT EXISTS headers_keyword ON headers (keyword, value);
+CREATE INDEX IF NOT EXISTS headers_file ON headers (file_id);
+CREATE INDEX IF NOT EXISTS layers_file ON layers (file_id);
+"""
+
+
+def inspect(path):
+    """
+    Reads the headers of an EXR, FITS or TIFF file, without reading any pixel data.
+    :param path: path (string) of the file. The format is given by its extension.
+    :return: dictionary with the keys 'path', 'format' ('exr', 'fits' or 'tiff'), 'size' (bytes), 'width' and 'height'
+             (of the first image layer), 'compression' (EXR codec name, FITS tile compression type, or None), and
+             'layers': a list with one dictionary per EXR channel, FITS image HDU or TIFF page, holding its 'layer'
+             index, 'name', 'dtype' (numpy dtype name), 'width', 'height' and decoded 'header' (a dictionary from
+             keyword to value: the embedded fits_headers or tiff_headers of EXR files, the HDU header of FITS files, the
+             page tags of TIFF files, with the keywords of JSON ImageDescription tags decoded as by
+             image.from_tiff_header). TIFF files and EXR files written by tiff2exr also have a 'header' key with the
+             image-wide metadata. The tags of TIFF pages are only read if tifffile is installed.
+    :example: inspect("/path/to/image.exr")['layers'][0]['header']['FILTER']
+    """
+    extension = path.rsplit('.', 1)[-1].lower()
+    if extension not in EXTENSIONS:
+        raise Exception("Unsupported file type " + path)
+
+    info = {'path': path, 'format': EXTENSIONS[extension], 'size': os.path.getsize(path), 'compression': None}
+    if info['format'] == 'exr':
+        info.update(__inspect_exr(path))
+    elif info['format'] == 'fits':
+        info.update(__inspect_fits(path))
+    else:
+        info.update(__inspect_tiff(path))
+
+    images = [layer for layer in info['layers'] if layer['width'] is not None]
+    info['width'] = images[0]['width'] if images else None
+    info['height'] = images[0]['height'] if images else None
+    return info
+
+
+def build_catalog(path, catalog_path, verbose=True):
+    """
+    Indexes the headers of every EXR, FITS and TIFF file of a directory tree into a SQLite database, so that they can
+    be searched (see query) without opening the files. Files that did not change since the last build, by size and
+    modification time, are not read again, and files that no longer exist are removed from the catalog.
+    The database has three tables: files (id, path, format, size, mtime_ns, width, height, layers, compression),
+    layers (file_id, layer, name, dtype, width, height) and headers (file_id, layer, keyword, value), where header
+    values are stored as text and layer is NULL for image-wide metadata.
+    :param path: path of the root directory.
+    :param catalog_path: path of the SQLite file. It is created if it does not exist.
+    :param verbose: Boolean variable for deciding whether to print warning messages.
+    :return: number of files (re)indexed.
+    :example: build_catalog("/path/to/archive", "/path/to/archive.sqlite")
+    """
+    connection = sqlite3.connect(catalog_path)
+    indexed = 0
+    try:
+        connection.executescript(__SCHEMA)
+        known = dict((row[0], (row[1], row[2], row[3])) for row in
+                     connection.execute("SELECT path, id, size, mtime_ns FROM files"))
+        found = set()
+
+        for directory, directory_names, filenames in os.walk(path):
+            directory_names.sort()
+            for filename in sorted(filenames):
+                if filename.startswith('.') or filename.rsplit('.', 1)[-1].lower() not in EXTENSIONS:
+                    continue
+                file_path = os.path.join(directory, filename)
+                found.add(file_path)
+                status = os.stat(file_path)
+                if file_path in known and known[file_path][1:] == (status.st_size, status.st_mtime_ns):
+                    continue
+
+                try:
+                    info = inspect(file_path)
+                except Exception as e:
+                    if verbose:
+                        warnings.warn("Failed to inspect " + file_path + ": " + repr(e))
+                    continue
+                if file_path in known:
+                    __delete(connection, known[file_path][0])
+                __insert(connection, info, status.st_mtime_ns)
+                indexed += 1
+
+        for file_path, (file_id, size, mtime_ns) in known.items():
+            if file_path not in found:
+                __delete(connection, file_id)
+        connection.commit()
+    finally:
+        connection.close()
+    return indexed
+
+
+def query(catalog_path, file_format=None, **keywords):
+    """
+    Finds the files of a catalog built by build_catalog whose headers have the given keyword values.
+    :param catalog_path: path of the SQLite file.
+    :param file_format: If not None, only files of this format ('exr', 'fits' or 'tiff') are returned.
+    :param keywords: header keywords and values to match. A file matches if every keyword has the value, compared as
+                     text, in the header of any of its layers.
+    :return: sorted list of file paths.
+    :example: query("/path/to/archive.sqlite", file_format='exr', FILTER='r')
+    """
+    sql = "SELECT path FROM files WHERE 1"
+    parameters = []
+    if file_format is not None:
+        sql += " AND format = ?"
+        parameters.append(file_format)
+    for keyword, value in sorted(keywords.items()):
+        sql += " AND id IN (SELECT file_id FROM headers WHERE keyword = ? AND value = ?)"
+        parameters.extend([keyword, __to_text(value)])
+
+    connection = sqlite3.connect(catalog_path)
+    try:
+        return [row[0] for row in connection.execute(sql + " ORDER BY path", parameters)]
+    finally:
+        connection.close()
+
+
+def __inspect_exr(path):
+    exr_file = OpenEXR.InputFile(path)
+    try:
+        exr_header = exr_file.header()
+    finally:
+        exr_file.close()
+
+    data_window = exr_header['dataWindow']
+    width = data_window.max.x - data_window.min.x + 1
+    height = data_window.max.y - data_window.min.y + 1
+
+    fits_headers = __decode_fits_headers(exr_header)
+    tiff_headers = None
+    if fits_headers is not None:
+        from astropy.io import fits
+        fits_headers = [__fits_header_to_dict(fits.Header.fromstring(header)) for header in fits_headers]
+        header_indexes = __get_fits_header_indexes(exr_header)  # the channels of cubes share the header of their HDU
+    elif exr_header.get(__TIFF_HEADERS_ID) is not None:
+        from .image import from_tiff_header
+        tiff_headers = [from_tiff_header(tags) for tags in json.loads(exr_header[__TIFF_HEADERS_ID])]
+
+    layers = []
+    for name in sorted(exr_header['channels'].keys(), key=__channel_order):
+        layer = {'layer': len(layers), 'name': name, 'dtype': __EXR_DTYPES.get(exr_header['channels'][name].type.v),
+                 'width': width, 'height': height, 'header': {}}
+        if fits_headers is not None and header_indexes.get(name, len(fits_headers)) < len(fits_headers):
+            layer['header'] = fits_headers[header_indexes[name]]
+        elif tiff_headers is not None and name.isdigit() and int(name) + 1 < len(tiff_headers):
+            layer['header'] = tiff_headers[int(name) + 1]
+        layers.append(layer)
+
+    info = {'compression': str(exr_header['compression']).replace('_COMPRESSION', ''), 'layers': layers}
+    if tiff_headers:
+        info['header'] = tiff_headers[0]
+    return info
+
+
+def __inspect_fits(path):
+    from astropy.io import fits
+    layers = []
+    compression = None
+    with fits.open(path, lazy_load_hdus=True) as hdu_list:
+        for index, hdu in enumerate(hdu_list):
+            if not hdu.is_image:
+                continue
+            header = hdu.header
+            shape = hdu.shape
+            if getattr(hdu, 'compression_type', None) is not None:  # tile compressed image HDUs
+                compression = hdu.compression_type
+            layers.append({'layer': index, 'name': hdu.name, 'dtype': __FITS_DTYPES.get(header.get('BITPIX')),
+                           'width': shape[-1] if len(shape) > 0 else None,
+                           'height': shape[-2] if len(shape) > 1 else None,
+                           'header': __fits_header_to_dict(header)})
+    return {'compression': compression, 'layers': layers}
+
+
+def __inspect_tiff(path):
+    from . import tiffpages
+    if tiffpages.get_backend() == 'tifffile':
+        try:
+            reader = tiffpages.PageReader(path)
+        except Exception:
+            reader = None  # e.g. color images, which SimpleITK reads
+        if reader is not None:
+            with reader:
+                return __inspect_tiff_pages(reader)
+
+    import SimpleITK as sitk
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO("TIFFImageIO")
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+
+    size = reader.GetSize()
+    dtype = __get_dtype_from_pixelid(reader.GetPixelID())
+    pages = size[2] if len(size) > 2 else 1
+    layers = [{'layer': page, 'name': str(page), 'dtype': dtype, 'width': size[0], 'height': size[1], 'header': {}}
+              for page in range(pages)]
+    header = dict((key, reader.GetMetaData(key)) for key in reader.GetMetaDataKeys())
+    return {'layers': layers, 'header': header}
+
+
+def __inspect_tiff_pages(reader):
+    # Unlike SimpleITK, tifffile reads the tags of every page, which become the headers of the layers.
+    from .image import from_tiff_header
+    pages, height, width = reader.shape
+    layers = [{'layer': page, 'name': str(page), 'dtype': reader.dtype.name, 'width': width, 'height': height,
+               'header': from_tiff_header(reader.headers[page + 1])} for page in range(pages)]
+    return {'layers': layers, 'header': from_tiff_header(reader.headers[0])}
+
+
+def __get_dtype_from_pixelid(pixel_id):
+    import SimpleITK as sitk
+    dtypes = {sitk.sitkUInt8: 'uint8', sitk.sitkInt8: 'int8', sitk.sitkUInt16: 'uint16', sitk.sitkInt16: 'int16',
+              sitk.sitkUInt32: 'uint32', sitk.sitkInt32: 'int32', sitk.sitkUInt64: 'uint64', sitk.sitkInt64: 'int64',
+              sitk.sitkFloat32: 'float32', sitk.sitkFloat64: 'float64'}
+    return dtypes.get(pixel_id, sitk.GetPixelIDValueAsString(pixel_id))
+
+
+def __fits_header_to_dict(header):
+    return dict((keyword, value) for keyword, value in header.items() if keyword not in __FITS_COMMENTARY)
+
+
+def __channel_order(name):
+    # Channels written by the converters are named after their layer index.
+    return (0, int(name), name) if name.isdigit() else (1, 0, name)
+
+
+def __insert(connection, info, mtime_ns):
+    cursor = connection.execute(
+        "INSERT INTO files (path, format, size, mtime_ns, width, height, layers, compression) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (info['path'], info['format'], info['size'], mtime_ns, info['width'], info['height'], len(info['layers']),
+         info['compression']))
+    file_id = cursor.lastrowid
+
+    connection.executemany("INSERT INTO layers VALUES (?, ?, ?, ?, ?, ?)",
+                           [(file_id, layer['layer'], layer['name'], layer['dtype'], layer['width'], layer['height'])
+                            for layer in info['layers']])
+    rows = [(file_id, None, keyword, __to_text(value)) for keyword, value in info.get('header', {}).items()]
+    for layer in info['layers']:
+        rows.extend((file_id, layer['layer'], keyword, __to_text(value)) for keyword, value in layer['header'].items())
+    connection.executemany("INSERT INTO headers VALUES (?, ?, ?, ?)", rows)
+
+
+def __delete(connection, file_id):
+    for table, column in (('files', 'id'), ('layers', 'file_id'), ('headers', 'file_id')):
+        connection.execute("DELETE FROM " + table + " WHERE " + column + " = ?", (file_id,))
+
+
+def __to_text(value):
+    return value if isinstance(value, str) else str(value)
+
+
+if __name__ == '__main__':
+    import sys
+    for inspected_path in sys.argv[1:]:
+        print (json.dumps(inspect(inspected_path), indent=2, default=str))
@@ -0,0 +1,142 @@
+"""
+Command line interface, installed as the exrconvert console script (see setup.py) and run by python -m exrconverter.
+Only the converters that a command needs are imported.
+
+    exrconvert convert input.fits output.exr --compression ZIP --pixel-type float16
+    exrconvert inspect input.exr
+    exrconvert worker /path/to/spool --workers 8
+    exrconvert submit /path/to/spool input.fits output.exr --compression ZIP --wait
+"""
+import argparse
+import json
+import sys
+
+
+def main(argv=None):
+    """
+    Runs a command, e.g. main(['convert', 'input.fits', 'output.exr']).
+    :return: the exit status, 0 if the command succeeded.
+    """
+    arguments = __get_parser().parse_args(argv)
+    try:
+        return arguments.command(arguments)
+    except KeyboardInterrupt:
+        return 130
+
+
+def __convert(arguments):
+    from . import router
+    try:
+        router.convert(arguments.input, arguments.output, **__get_options(arguments))
+    except Exception as e:
+        sys.stderr.write("Failed to convert " + arguments.input + ": " + str(e) + "\n")
+        return 1
+    return 0
+
+
+def __inspect(arguments):
+    from . import catalog
+    status = 0
+    for path in arguments.paths:
+        try:
+            print (json.dumps(catalog.inspect(path), indent=2, default=str))
+        except Exception as e:
+            sys.stderr.write("Failed to inspect " + path + ": " + str(e) + "\n")
+            status = 1
+    return status
+
+
+def __worker(arguments):
+    from . import worker
+    worker.serve(arguments.spool, workers=arguments.workers, pool=arguments.pool, formats=arguments.formats,
+                 poll_interval=arguments.poll_interval, max_jobs=arguments.max_jobs,
+                 idle_timeout=arguments.idle_timeout, verbose=not arguments.quiet)
+    return 0
+
+
+def __submit(arguments):
+    from . import worker
+    job_id = worker.submit(arguments.spool, arguments.input, arguments.output, **__get_options(arguments))
+    if not arguments.wait:
+        print (job_id)
+        return 0
+    result = worker.get_result(arguments.spool, job_id, timeout=arguments.timeout)
+    if result is None:
+        sys.stderr.write("Job " + job_id + " was not converted within " + str(arguments.timeout) + " seconds\n")
+        return 1
+    if result['status'] != 'done':
+        sys.stderr.write("Failed to convert " + arguments.input + ": " + str(result.get('error')) + "\n")
+        return 1
+    return 0
+
+
+def __get_options(arguments):
+    # Keyword arguments of router.convert: only the options given, since every route takes different ones.
+    options = {}
+    for name in ('compression', 'compression_goal', 'output_pixel_type', 'backend', 'threads'):
+        if getattr(arguments, name) is not None:
+            options[name] = getattr(arguments, name)
+    if arguments.tile_size is not None:
+        options['tile_size'] = (arguments.tile_size, arguments.tile_size)
+    if arguments.quiet:
+        options['verbose'] = False
+    for option in arguments.options:
+        name, value = option.split('=', 1)
+        try:
+            options[name] = json.loads(value)
+        except ValueError:
+            options[name] = value
+    return options
+
+
+def __add_convert_options(parser):
+    parser.add_argument('input', help="input file; its format is given by its extension")
+    parser.add_argument('output', help="output file; its format is given by its extension")
+    parser.add_argument('--compression', help="EXR compression, e.g. ZIP, PIZ or auto")
+    parser.add_argument('--compression-goal', dest='compression_goal', help="goal of --compression auto")
+    parser.add_argument('--pixel-type', dest='output_pixel_type', help="output pixel type, e.g. float16 or float32")
+    parser.add_argument('--tile-size', dest='tile_size', type=int, help="write a tiled EXR file with square tiles")
+    parser.add_argument('--backend', help="TIFF backend, tifffile or sitk")
+    parser.add_argument('--threads', type=int, help="threads converting the channels of the file")
+    parser.add_argument('-o', '--option', dest='options', action='append', default=[], metavar='NAME=VALUE',
+                        help="any other keyword argument of the converter, with a JSON or string value")
+    parser.add_argument('-q', '--quiet', action='store_true', help="do not print warning messages")
+
+
+def __get_parser():
+    parser = argparse.ArgumentParser(prog='exrconvert', description="Converts images between EXR, FITS and TIFF.")
+    commands = parser.add_subparsers(dest='command_name', metavar='command')
+    commands.required = True
+
+    convert_parser = commands.add_parser('convert', help="convert a file")
+    __add_convert_options(convert_parser)
+    convert_parser.set_defaults(command=__convert)
+
+    inspect_parser = commands.add_parser('inspect', help="print the size, layers and headers of files")
+    inspect_parser.add_argument('paths', nargs='+')
+    inspect_parser.set_defaults(command=__inspect)
+
+    worker_parser = commands.add_parser('worker', help="convert the jobs submitted to a spool directory")
+    worker_parser.add_argument('spool', help="spool directory")
+    worker_parser.add_argument('--workers', type=int, default=1, help="jobs converted simultaneously")
+    worker_parser.add_argument('--pool', choices=['process', 'thread'], default='process')
+    worker_parser.add_argument('--formats', nargs='+', choices=['exr', 'fits', 'tiff'],
+                               help="formats whose converters are loaded up front, all by default")
+    worker_parser.add_argument('--poll-interval', dest='poll_interval', type=float, default=0.2)
+    worker_parser.add_argument('--max-jobs', dest='max_jobs', type=int, help="stop after this many jobs")
+    worker_parser.add_argument('--idle-timeout', dest='idle_timeout', type=float,
+                               help="stop after this many seconds without jobs")
+    worker_parser.add_argument('-q', '--quiet', action='store_true', help="do not print progress messages")
+    worker_parser.set_defaults(command=__worker)
+
+    submit_parser = commands.add_parser('submit', help="submit a conversion job to a spool directory")
+    submit_parser.add_argument('spool', help="spool directory")
+    __add_convert_options(submit_parser)
+    submit_parser.add_argument('--wait', action='store_true', help="wait for the job to be converted")
+    submit_parser.add_argument('--timeout', type=float, help="seconds to wait for with --wait")
+    submit_parser.set_defaults(command=__submit)
+    return parser
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+import os
+import shutil
+import tempfile
+import time
+import numpy
+import OpenEXR
+import Imath
+from .utils import __get_channel_from_pixeltype, __get_exrpixel_from_channel, __change_array_type
+from .pixeltype import PixelType
+
+COMPRESSION_OPTIONS = {'NO' : Imath.Compression.NO_COMPRESSION, 'RLE' : Imath.Compression.RLE_COMPRESSION, 'ZIPS' : Imath.Compression.ZIPS_COMPRESSION,
+                       'ZIP' : Imath.Compression.ZIP_COMPRESSION, 'PIZ' : Imath.Compression.PIZ_COMPRESSION, 'PXR24' : Imath.Compression.PXR24_COMPRESSION,
+                       'B44' : Imath.Compression.B44_COMPRESSION, 'B44A' : Imath.Compression.B44A_COMPRESSION,'DWAA' : Imath.Compression.DWAA_COMPRESSION,
+                       'DWAB' : Imath.Compression.DWAB_COMPRESSION
+                       }
+
+# Codecs that never alter the pixels. PXR24 is also lossless for FLOAT16 channels, but it rounds FLOAT32 ones.
+LOSSLESS_COMPRESSIONS = ['NO', 'RLE', 'ZIPS', 'ZIP', 'PIZ']
+
+GOALS = ['fastest', 'smallest', 'lossless']
+
+
+def benchmark(exr_data, compressions=None, repeat=1):
+    """
+    Encodes and decodes a set of channels with every EXR compression codec, and measures them.
+    :param exr_data: dictionary from channel name to 2D numpy array of type float16 or float32, all of the same shape.
+    :param compressions: list of codec names (keys of COMPRESSION_OPTIONS) to measure. If None, all of them.
+    :param repeat: number of times each codec is run. The fastest run is reported.
+    :return: list of dictionaries, one per codec, with the keys 'compression', 'encode_mb_s', 'decode_mb_s', 'ratio'
+             (uncompressed bytes over file bytes), 'max_error' (largest absolute difference between the decoded and the
+             original pixels) and 'lossless'.
+    :example: benchmark({'0': numpy.random.rand(512, 512).astype(numpy.float32)}, compressions=['ZIP', 'PIZ'])
+    """
+    if compressions is None:
+        compressions = list(COMPRESSION_OPTIONS.keys())
+
+    height, width = next(iter(exr_data.values())).shape
+    raw_bytes = sum(data.nbytes for data in exr_data.values())
+    temp_dir = tempfile.mkdtemp(prefix='exrconverter-')
+    results = []
+
+    try:
+        for compression in compressions:
+            path = os.path.join(temp_dir, compression + '.exr')
+            exr_header = OpenEXR.Header(width, height)
+            exr_header['compression'] = Imath.Compression(COMPRESSION_OPTIONS[compression])
+            exr_header['channels'] = dict((name, __get_channel_from_pixeltype(data.dtype.type))
+                                          for name, data in exr_data.items())
+
+            encode_time = decode_time = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                exr_file = OpenEXR.OutputFile(path, exr_header)
+                try:
+                    exr_file.writePixels(exr_data)
+                finally:
+                    exr_file.close()
+                encode_time = __fastest(encode_time, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                exr_file = OpenEXR.InputFile(path)
+                decoded = dict((name, exr_file.channel(name, __get_exrpixel_from_channel(exr_header['channels'][name])))
+                               for name in exr_data.keys())
+                exr_file.close()
+                decode_time = __fastest(decode_time, time.perf_counter() - start)
+
+            max_error = 0.0
+            for name, data in exr_data.items():
+                decoded_data = numpy.frombuffer(decoded[name], dtype=data.dtype).reshape(data.shape)
+                max_error = max(max_error, __max_error(data, decoded_data))
+
+            results.append({'compression': compression,
+                            'encode_mb_s': raw_bytes / 1e6 / encode_time,
+                            'decode_mb_s': raw_bytes / 1e6 / decode_time,
+                            'ratio': raw_bytes / float(os.path.getsize(path)),
+                            'max_error': max_error,
+                            'lossless': max_error == 0.0})
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return results
+
+
+def choose_compression(exr_data, goal='lossless', sample_rows=64, pixel_type=None):
+    """
+    Picks the EXR compression codec that best fits a goal, by benchmarking every codec on a strip of the image.
+    :param exr_data: dictionary from channel name to 2D array. Only the sample is read, so the arrays can be anything
+                     that supports numpy slicing and has a shape, such as the hdu.section of a FITS HDU.
+    :param goal: 'fastest' for the highest encoding throughput, 'smallest' for the highest compression ratio (lossy
+                 codecs included), or 'lossless' for the highest compression ratio among the lossless codecs.
+    :param sample_rows: number of scanlines, taken from the middle of the image, used as sample.
+    :param pixel_type: pixel type of the output channels (PixelType.FLOAT16 or PixelType.FLOAT32), to which the sample
+                       is converted. If None, the arrays must already have that type.
+    :return: a codec name, i.e. one of the keys of COMPRESSION_OPTIONS.
+    """
+    if goal not in GOALS:
+        raise Exception("Unsupported compression goal " + str(goal) + ". Options are " + ", ".join(GOALS))
+
+    sample = {}
+    for name, data in exr_data.items():
+        first_row = max(data.shape[0] // 2 - sample_rows // 2, 0)
+        sample_data = data[first_row:first_row + sample_rows]
+        sample[name] = __change_array_type(sample_data, pixel_type or sample_data.dtype.type)
+
+    compressions = list(COMPRESSION_OPTIONS.keys())
+    if goal == 'lossless':
+        compressions = list(LOSSLESS_COMPRESSIONS)
+        if all(data.dtype == numpy.float16 for data in sample.values()):
+            compressions.append('PXR24')
+
+    results = benchmark(sample, compressions)
+    if goal == 'fastest':
+        return max(results, key=lambda result: result['encode_mb_s'])['compression']
+    return max(results, key=lambda result: result['ratio'])['compression']
+
+
+def load_sample(path, output_pixel_type=None):
+    """
+    Loads the image layers of a FITS, TIFF or EXR file as EXR channels, to be used as benchmark input. For FITS files,
+    the 2D image HDUs of the same shape as the first one are used.
+    :param path: path (string) of the input file.
+    :param output_pixel_type: PixelType.FLOAT16 or PixelType.FLOAT32. If None, EXR channels keep their type and
+                              everything else is converted to FLOAT32.
+    :return: dictionary from channel name to 2D numpy array.
+    """
+    extension = path.rsplit('.', 1)[-1].lower()
+    if extension == 'exr':
+        from .region import read_region
+        return read_region(path, output_pixel_type=output_pixel_type)
+
+    if output_pixel_type is None:
+        output_pixel_type = PixelType.FLOAT32
+
+    layers = []
+    if extension in ('fits', 'fit'):
+        from astropy.io import fits
+        with fits.open(path) as hdu_list:
+            for hdu in hdu_list:
+                if hdu.is_image and len(hdu.shape) == 2 and (len(layers) == 0 or hdu.shape == layers[0].shape):
+                    layers.append(__change_array_type(hdu.data, output_pixel_type))
+    elif extension in ('tiff', 'tif'):
+        import SimpleITK as sitk
+        tiff_image_array = sitk.GetArrayFromImage(sitk.ReadImage(path))
+        if tiff_image_array.ndim == 2:
+            tiff_image_array = tiff_image_array[numpy.newaxis]
+        layers = [__change_array_type(page, output_pixel_type) for page in tiff_image_array]
+    else:
+        raise Exception("Unsupported file type " + path)
+
+    return dict((str(index), data) for index, data in enumerate(layers))
+
+
+def print_report(results):
+    """
+    Prints the output of benchmark as a table.
+    """
+    print ("%-8s %12s %12s %8s %12s" % ("codec", "encode MB/s", "decode MB/s", "ratio", "max error"))
+    for result in results:
+        print ("%-8s %12.1f %12.1f %8.2f %12.4g" % (result['compression'], result['encode_mb_s'], result['decode_mb_s'],
+                                                 result['ratio'], result['max_error']))
+
+
+def __fastest(best, elapsed):
+    return elapsed if best is None else min(best, elapsed)
+
+
+def __max_error(original, decoded):
+    original = original.astype(numpy.float64)
+    decoded = decoded.astype(numpy.float64)
+    both_nan = numpy.isnan(original) & numpy.isnan(decoded)
+    with numpy.errstate(invalid='ignore'):
+        error = numpy.where(both_nan | (original == decoded), 0.0, numpy.abs(original - decoded))
+    if error.size == 0:
+        return 0.0
+    error = numpy.where(numpy.isnan(error), numpy.inf, error)
+    return float(error.max())
+
+
+if __name__ == '__main__':
+    import sys
+    for sample_path in sys.argv[1:]:
+        print ("Benchmarking: " + sample_path)
+        print_report(benchmark(load_sample(sample_path)))
@@ -1,14 +1,19 @@
 from astropy.io import fits
+from astropy.io.fits.hdu.base import DTYPE2BITPIX
 import numpy
 import os
-import OpenEXR
 import json
+import threading
 import warnings
-from .utils import __FITS_HEADERS_ID, __get_pixeltype_from_channel, __get_exrpixel_from_channel,\
-    __change_array_type
+from .utils import __FITS_PLANES_ID, __decode_fits_headers, __get_fits_header_indexes, __get_pixeltype_from_channel,\
+    __change_array_type, __new_buffer, __get_channel_names, __get_window, __read_channel, __open_exr, __is_path, __set_threads, __map
 from .pixeltype import PixelType
+from . import batch
+from .stats import instrumented
 
-def convert_directory(path, output_pixel_type=None, verbose=True):
+def convert_directory(path, output_pixel_type=None, verbose=True, workers=1, pool='process', streaming=False,
+                      block_size=256, incremental=False, checksum=False,
+                      shard_index=0, shard_count=1, claim_run=None, threads=None, trace_memory=False):
     """
     Converts directory of EXR files to FITS.
     :param path: path of the directory.
@@ -19,27 +24,50 @@ def convert_directory(path, output_pixel_type=None, verbose=True):
                               Since the underlying implementation uses numpy arrays, output_pixel_type can also take
                               numpy dtypes values, For example, output_pixel_type=numpy.float32.
     :param verbose: Boolean variable for deciding whether to print warning messages.
+    :param streaming: If True, every file is converted in blocks of scanlines. See convert.
+    :param block_size: number of scanlines per block when streaming is True.
+    :param threads: If not None, number of threads converting the channels of every file. See convert.
+    :param workers: number of files converted simultaneously. If equal to 1, files are converted one at a time.
+    :param pool: 'process' to convert in a pool of processes, or 'thread' to convert in a pool of threads.
+    :param incremental: If True, a manifest of the converted files is kept in the directory (see
+                        exrconverter.batch.Manifest), files whose output is up to date are skipped, and outputs are
+                        written atomically through a temporary file. Reruns then only convert new, changed or
+                        previously failed files.
+    :param checksum: If True, in incremental mode, inputs with a new modification time are only converted again if
+                     their content changed.
+    :param shard_index: index, from 0 to shard_count - 1, of the part of the directory converted by this call.
+    :param shard_count: If greater than 1, the directory is split into shard_count parts of about the same total size,
+                        the same on every node, and only the part shard_index is converted. Run one call per shard,
+                        e.g. one per node of an array job (see exrconverter.batch.shard).
+    :param claim_run: If not None, a name shared by all the shards of the run, such as the array job id. Files are
+                      then claimed before being converted, and once its shard is done a call goes on with files of the
+                      other shards that nobody claimed yet, so that no file is converted twice. Files that failed
+                      are released for a retry. Remove the claims of a finished run with
+                      exrconverter.batch.clear_claims.
+    :param trace_memory: If True, the peak memory allocated by every conversion is traced with tracemalloc (see
+                         exrconverter.stats.ConversionStats).
+    :return: an exrconverter.batch.BatchResult object with the successes, failures, timings and
+             ConversionStats of every file (aggregated in BatchResult.stats).
     :example: convert_directory(path='path/to/exr', output_pixel_type=numpy.float32, verbose=True)
     """
-    
-    for filename in os.listdir(path):
-        if filename[-3:] == "exr":
-            output_filename = path + '/' + filename[:-4] + ".fits"
-        else:
-            continue
-        
-        if verbose:
-            print ("Converting: " + filename)
-         
-        convert(path + '/' + filename, output_filename, output_pixel_type, verbose)
-
-def convert(input_exr, output_fits, output_pixel_type=None, verbose=True):
+    options = dict(output_pixel_type=output_pixel_type, verbose=verbose, streaming=streaming, block_size=block_size,
+                   threads=threads)
+    return batch.convert_directory(convert, path, ['exr'], 'fits', options, workers=workers, pool=pool, verbose=verbose,
+                                   incremental=incremental, checksum=checksum, shard_index=shard_index,
+                                   shard_count=shard_count, claim_run=claim_run, trace_memory=trace_memory)
+
+@instrumented
+def convert(input_exr, output_fits, output_pixel_type=None, verbose=True, streaming=False, block_size=256,
+            window=None, channels=None, threads=None, stats=None):
     """
     Converts an input EXR file into a FITS file. Multiple layers in the input EXR file are created as multiple image
-    HDUs in the output FITS file. The pixels in the output image file can also be set to a different type as that of
+    HDUs in the output FITS file, except for the planes of a cube written by fits2exr, which are put back together
+    into a 3D image HDU. Cubes are written to FITS paths a plane at a time, in blocks of block_size scanlines, even
+    when streaming is False. The pixels in the output image file can also be set to a different type as that of
     the pixels in the input image file.
-    :param input_exr: path (string) of the input EXR file.
-    :param output_fits: path (string) to the output FITS file.
+    :param input_exr: path (string), binary file-like object or bytes of the input EXR file.
+    :param output_fits: path (string) to the output FITS file, or binary file-like object to write it to (except in
+                        streaming mode).
     :param output_pixel_type: If equal to None, the output file image will have the same pixel type or format
                               of that in the input file image. If changing the pixel type is desired, then
                               output_pixel_type can take the values defined by the fields in the class
@@ -47,45 +75,219 @@ def convert(input_exr, output_fits, output_pixel_type=None, verbose=True):
                               Since the underlying implementation uses numpy arrays, output_pixel_type can also take
                               numpy dtypes values, For example, output_pixel_type=numpy.float32.
     :param verbose: Boolean variable for deciding whether to print warning messages.
+    :param streaming: If True, each channel is read in blocks of block_size scanlines and appended to the output FITS
+                      file as it is read, instead of building the whole HDU list in memory. The peak memory then
+                      depends on the block size and not on the image size.
+    :param block_size: number of scanlines read and written at once when streaming is True.
+    :param window: If not None, only this region (x0, y0, x1, y1) of the image is converted, covering columns x0 to
+                   x1 - 1 and rows y0 to y1 - 1. Only the scanlines within the region are decoded, and the reference
+                   pixel (CRPIX1, CRPIX2) of the FITS headers is shifted accordingly.
+    :param channels: If not None, list of the EXR channels (names or layer indexes) to convert. Only these channels
+                     are decoded.
+    :param threads: If not None, the number of threads of the OpenEXR thread pool, which is process-wide, so that
+                    blocks of scanlines are decompressed in parallel. The channels are also converted to FITS by that
+                    many threads, except in streaming mode.
+    :param stats: optional exrconverter.stats.ConversionStats object, filled in with the time and bytes of the read,
+                  convert, headers and write stages of the conversion.
     :example: convert(input_exr="/path/to/input_exr.exr", output_fits="/path/to/input_exr.exr",
                       output_pixel_type=numpy.float32, verbose=True)
     """
 
-    exr_file = OpenEXR.InputFile(input_exr)
+    if streaming and not __is_path(output_fits):
+        raise Exception("FITS files can only be written in streaming mode to a path")
+
+    __set_threads(threads)
+    exr_file, exr_header, fits_headers, window, channel_names = __open(input_exr, window, channels, stats)
+
+    if streaming or (exr_header.get(__FITS_PLANES_ID) is not None and __is_path(output_fits)):
+        __convert_streaming(exr_file, exr_header, fits_headers, output_fits, output_pixel_type, verbose, block_size,
+                            window, channel_names, stats)
+        return
+
+    hdu_list = __read_hdulist(exr_file, exr_header, fits_headers, output_pixel_type, verbose, window, channel_names,
+                              threads, stats)
+
+    with stats.stage('write') as stage:
+        hdu_list.writeto(output_fits, overwrite=True)
+        stage.add(sum(hdu.data.nbytes for hdu in hdu_list))
+
+
+@instrumented
+def to_hdulist(input_exr, output_pixel_type=None, verbose=True, window=None, channels=None, threads=None,
+               stats=None):
+    """
+    Converts an EXR file into an astropy HDUList in memory, without writing a FITS file. The HDUs are the ones that
+    convert would write, so the HDUList can be served, inspected or chained with other conversions directly.
+    :param input_exr: path (string), binary file-like object or bytes of the input EXR file.
+    :param output_pixel_type: See convert.
+    :param verbose: Boolean variable for deciding whether to print warning messages.
+    :param window: See convert.
+    :param channels: See convert.
+    :param threads: See convert.
+    :param stats: optional exrconverter.stats.ConversionStats object. See convert.
+    :return: an astropy.io.fits.HDUList object with one image HDU per EXR channel, or per cube.
+    :example: hdu_list = to_hdulist(request_body, channels=[0])
+    """
+    __set_threads(threads)
+    exr_file, exr_header, fits_headers, window, channel_names = __open(input_exr, window, channels, stats)
+    return __read_hdulist(exr_file, exr_header, fits_headers, output_pixel_type, verbose, window, channel_names,
+                          threads, stats)
+
+
+def __open(input_exr, window, channels, stats):
+    exr_file = __open_exr(input_exr)
     exr_header = exr_file.header()
-    if exr_header.get(__FITS_HEADERS_ID) is not None:
-        fits_headers = json.loads(exr_header[__FITS_HEADERS_ID])
-    else:
-        fits_headers = None
+    window = __get_window(exr_header, window)
+    channel_names = __get_channel_names(exr_header, channels)
+    with stats.stage('headers'):
+        # Only the headers of the converted channels are rebuilt.
+        header_indexes = __get_fits_header_indexes(exr_header)
+        fits_headers = __decode_fits_headers(exr_header, set(header_indexes[name] for name in channel_names
+                                                             if name in header_indexes))
+    stats.add_pixels((window[2] - window[0]) * (window[3] - window[1]) * len(channel_names))
+    return exr_file, exr_header, fits_headers, window, channel_names
 
-    dw = exr_header['dataWindow']
-    image_size = (dw.max.x - dw.min.x + 1, dw.max.y - dw.min.y + 1)
+
+def __read_hdulist(exr_file, exr_header, fits_headers, output_pixel_type, verbose, window, channel_names, threads,
+                   stats):
+    x0, y0, x1, y1 = window
     hdu_list = fits.HDUList()
+    if output_pixel_type is None and len(channel_names) > 0:
+        output_pixel_type = __get_pixeltype_from_channel(exr_header['channels'][channel_names[0]])
+    if output_pixel_type == PixelType.FLOAT16 and verbose:
+        warnings.warn("Fits does not support float16 images. Converted to FLOAT32 instead.")
+    lock = threading.Lock()
 
-    exr_header = exr_file.header()
+    def read_channel(channel_index):
+        with stats.stage('read') as stage:
+            with lock:  # channels are decoded one at a time, by the OpenEXR thread pool
+                hdu_data = __read_channel(exr_file, exr_header, channel_index, y0, y1, x0, x1)
+            stage.add(hdu_data.nbytes)
+
+        # FITS data is big-endian, so the byte swap is done here together with the type conversion.
+        with stats.stage('convert') as stage:
+            if output_pixel_type == PixelType.FLOAT16:
+                hdu_data = __change_array_type(hdu_data, numpy.float32, byteorder='>')
+            else:
+                hdu_data = __change_array_type(hdu_data, output_pixel_type, byteorder='>')
+            stage.add(hdu_data.nbytes)
+        return hdu_data
+
+    for header, hdu_channel_names, cube in __get_hdus(exr_header, fits_headers, channel_names):
+        planes = __map(read_channel, hdu_channel_names, threads)
+        hdu_data = planes[0]
+
+        if cube:
+            with stats.stage('convert') as stage:
+                hdu_data = numpy.stack(planes)
+                stage.add(hdu_data.nbytes)
+
+        if header is None:
+            hdu_list.append(fits.ImageHDU(data=hdu_data))
+        else:
+            with stats.stage('headers'):
+                hdu_header = __shift_reference_pixel(fits.Header.fromstring(header), x0, y0)
+            hdu_list.append(fits.ImageHDU(data=hdu_data, header=hdu_header))
+
+    return hdu_list
+
+
+def __convert_streaming(exr_file, exr_header, fits_headers, output_fits, output_pixel_type, verbose, block_size,
+                        window, channel_names, stats):
+    x0, y0, x1, y1 = window
+    image_size = (x1 - x0, y1 - y0)
+
+    # StreamingHDU appends to existing files, so an old output has to be removed first (as overwrite=True would do).
+    if os.path.exists(output_fits):
+        os.remove(output_fits)
 
-    for channel_index in sorted(exr_header['channels'].keys(), key=lambda x: float(x)):
-        channel_type = exr_header['channels'][channel_index]
-        byte_image = exr_file.channel(str(channel_index), __get_exrpixel_from_channel(channel_type))
-        pixel_type = __get_pixeltype_from_channel(channel_type)
+    for hdu_index, (header, hdu_channel_names, cube) in enumerate(__get_hdus(exr_header, fits_headers,
+                                                                              channel_names)):
+        pixel_type = __get_pixeltype_from_channel(exr_header['channels'][hdu_channel_names[0]])
 
         if output_pixel_type is None:
             output_pixel_type = pixel_type
 
-        hdu_data = numpy.frombuffer(byte_image, dtype=pixel_type)
-        hdu_data.shape = (image_size[1], image_size[0])
-
+        hdu_pixel_type = output_pixel_type
         if output_pixel_type == PixelType.FLOAT16:
-            hdu_data = __change_array_type(hdu_data, numpy.float32)
+            hdu_pixel_type = PixelType.FLOAT32
             if verbose:
-                warnings.warn("Fits does not support " + str(hdu_data.dtype) + " images. Converted to FLOAT32 instead.")
-        else:
-            hdu_data = __change_array_type(hdu_data, output_pixel_type)
+                warnings.warn("Fits does not support float16 images. Converted to FLOAT32 instead.")
 
-        if fits_headers is None:
-            hdu_list.append(fits.ImageHDU(data=hdu_data))
+        with stats.stage('headers'):
+            if header is None:
+                hdu_header = fits.Header()
+            else:
+                hdu_header = __shift_reference_pixel(fits.Header.fromstring(header), x0, y0)
+            hdu_header = __get_streaming_header(hdu_header, hdu_index == 0, image_size, hdu_pixel_type,
+                                                len(hdu_channel_names) if cube else None)
+
+        # A big-endian buffer is reused for every block, so that StreamingHDU.write does not byte swap it again.
+        # The planes of a cube are consecutive in the FITS data, so they are simply written one after the other.
+        buffer = __new_buffer((min(block_size, image_size[1]), image_size[0]), hdu_pixel_type, byteorder='>')
+        hdu = fits.StreamingHDU(output_fits, hdu_header)
+        try:
+            for channel_index in hdu_channel_names:
+                for first_row in range(y0, y1, block_size):
+                    last_row = min(first_row + block_size, y1)
+                    with stats.stage('read') as stage:
+                        hdu_data = __read_channel(exr_file, exr_header, channel_index, first_row, last_row, x0, x1)
+                        stage.add(hdu_data.nbytes)
+                    with stats.stage('convert') as stage:
+                        hdu_data = __change_array_type(hdu_data, hdu_pixel_type, out=buffer[:last_row - first_row])
+                        stage.add(hdu_data.nbytes)
+                    with stats.stage('write') as stage:
+                        hdu.write(hdu_data)
+                        stage.add(hdu_data.nbytes)
+        finally:
+            hdu.close()
+
+
+def __get_hdus(exr_header, fits_headers, channel_names):
+    # Returns the (header, channel names, cube) of the HDUs to write. Every channel is a 2D HDU with the header of the
+    # same index, unless the file has fits_planes (see fits2exr), in which case the planes of a cube are gathered.
+    if exr_header.get(__FITS_PLANES_ID) is None:
+        return [(None if fits_headers is None else fits_headers[int(name)], [name], False) for name in channel_names]
+
+    planes = json.loads(exr_header[__FITS_PLANES_ID])
+    hdus = []
+    for name in channel_names:
+        header_index, plane = planes[int(name)]
+        if plane is not None and hdus and hdus[-1][0] == header_index and hdus[-1][2]:
+            hdus[-1][1].append(name)
         else:
-            hdu_header = fits.Header.fromstring(fits_headers[int(channel_index)])
-            hdu_list.append(fits.ImageHDU(data=hdu_data, header=hdu_header))
+            hdus.append((header_index, [name], plane is not None))
+    return [(None if fits_headers is None else fits_headers[header_index], names, cube)
+            for header_index, names, cube in hdus]
+
+
+def __shift_reference_pixel(header, x0, y0):
+    # Keeps the WCS of a cutout pointing at the same sky positions.
+    if x0 != 0 and 'CRPIX1' in header:
+        header['CRPIX1'] -= x0
+    if y0 != 0 and 'CRPIX2' in header:
+        header['CRPIX2'] -= y0
+    return header
 
-    hdu_list.writeto(output_fits, overwrite=True)
+
+def __get_streaming_header(header, primary, image_size, pixel_type, planes=None):
+    # Builds the header that fits.ImageHDU(data=...) would have built, without having the data at hand.
+    if primary:
+        header = fits.PrimaryHDU(header=header).header
+    else:
+        header = fits.ImageHDU(header=header).header
+
+    for keyword in ['BSCALE', 'BZERO', 'BLANK']:
+        header.remove(keyword, ignore_missing=True)
+
+    header['BITPIX'] = DTYPE2BITPIX[numpy.dtype(pixel_type).name]
+    header['NAXIS'] = 2 if planes is None else 3
+    header.set('NAXIS1', image_size[0], after='NAXIS')
+    header.set('NAXIS2', image_size[1], after='NAXIS1')
+    if planes is None:
+        header.remove('NAXIS3', ignore_missing=True)
+    else:
+        header.set('NAXIS3', planes, after='NAXIS2')
+    if primary:
+        header.set('EXTEND', True, after='NAXIS' + str(header['NAXIS']))
+    return header
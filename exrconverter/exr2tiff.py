@@ -1,15 +1,18 @@
-import SimpleITK as sitk
 import numpy
-import OpenEXR
 import json
-import os
+import threading
 import warnings
-from .utils import __TIFF_HEADERS_ID, __get_pixeltype_from_channel, __get_exrpixel_from_channel,\
-    __change_array_type
+from .utils import __TIFF_HEADERS_ID, __decode_fits_headers, __get_fits_header_indexes,\
+    __get_pixeltype_from_channel, __change_array_type, __get_channel_names, __get_window, __read_channel, __open_exr,\
+    __set_threads, __map
 from .pixeltype import PixelType
+from . import batch, tiffpages
+from .stats import instrumented
 
 
-def convert_directory(path, output_pixel_type=None, verbose=True):
+def convert_directory(path, output_pixel_type=None, verbose=True, workers=1, pool='process', incremental=False,
+                      checksum=False, shard_index=0, shard_count=1, claim_run=None, backend=None, threads=None,
+                      trace_memory=False):
     """
     Converts directory of EXR files to TIFF.
     :param path: path of the directory.
@@ -20,23 +23,43 @@ def convert_directory(path, output_pixel_type=None, verbose=True):
                               Since the underlying implementation uses numpy arrays, output_pixel_type can also take
                               numpy dtypes values, For example, output_pixel_type=numpy.float32.
     :param verbose: Boolean variable for deciding whether to print warning messages.
+    :param backend: None, 'tifffile' or 'sitk'. See convert.
+    :param threads: If not None, number of threads converting the channels of every file. See convert.
+    :param workers: number of files converted simultaneously. If equal to 1, files are converted one at a time.
+    :param pool: 'process' to convert in a pool of processes, or 'thread' to convert in a pool of threads.
+    :param incremental: If True, a manifest of the converted files is kept in the directory (see
+                        exrconverter.batch.Manifest), files whose output is up to date are skipped, and outputs are
+                        written atomically through a temporary file. Reruns then only convert new, changed or
+                        previously failed files.
+    :param checksum: If True, in incremental mode, inputs with a new modification time are only converted again if
+                     their content changed.
+    :param shard_index: index, from 0 to shard_count - 1, of the part of the directory converted by this call.
+    :param shard_count: If greater than 1, the directory is split into shard_count parts of about the same total size,
+                        the same on every node, and only the part shard_index is converted. Run one call per shard,
+                        e.g. one per node of an array job (see exrconverter.batch.shard).
+    :param claim_run: If not None, a name shared by all the shards of the run, such as the array job id. Files are
+                      then claimed before being converted, and once its shard is done a call goes on with files of the
+                      other shards that nobody claimed yet, so that no file is converted twice. Files that failed
+                      are released for a retry. Remove the claims of a finished run with
+                      exrconverter.batch.clear_claims.
+    :param trace_memory: If True, the peak memory allocated by every conversion is traced with tracemalloc (see
+                         exrconverter.stats.ConversionStats).
+    :return: an exrconverter.batch.BatchResult object with the successes, failures, timings and
+             ConversionStats of every file (aggregated in BatchResult.stats).
     :example: convert_directory(path='path/to/exr', output_pixel_type=numpy.float32, verbose=True)
     """
-    for filename in os.listdir(path):
-        if filename[-3:] != 'exr':
-            continue
-        if verbose:
-            print ("Converting: " + filename)
-    
-        output_filename = path + '/' + filename[:-4] + ".tif"
-         
-        convert(path + '/' + filename, output_filename, output_pixel_type, verbose)
+    options = dict(output_pixel_type=output_pixel_type, verbose=verbose, backend=backend, threads=threads)
+    return batch.convert_directory(convert, path, ['exr'], 'tif', options, workers=workers, pool=pool, verbose=verbose,
+                                   incremental=incremental, checksum=checksum, shard_index=shard_index,
+                                   shard_count=shard_count, claim_run=claim_run, trace_memory=trace_memory)
 
-def convert(input_exr, output_tiff, output_pixel_type=None, verbose=True):
+@instrumented
+def convert(input_exr, output_tiff, output_pixel_type=None, verbose=True, window=None, channels=None, backend=None,
+            threads=None, stats=None):
     """
     Converts an input EXR file into a TIFF file. Multiple layers in the input EXR file are created as multiple layers in the output Tiff file. The pixels in the output image file can also be set to a different type as that of
     the pixels in the input image file.
-    :param input_exr: path (string) of the input EXR file.
+    :param input_exr: path (string), binary file-like object or bytes of the input EXR file.
     :param output_tiff: path (string) to the output TIFF file.
     :param output_pixel_type: If equal to None, the output file image will have the same pixel type or format
                               of that in the input file image. If changing the pixel type is desired, then
@@ -45,47 +68,165 @@ def convert(input_exr, output_tiff, output_pixel_type=None, verbose=True):
                               Since the underlying implementation uses numpy arrays, output_pixel_type can also take
                               numpy dtypes values, For example, output_pixel_type=numpy.float32.
     :param verbose: Boolean variable for deciding whether to print warning messages.
+    :param window: If not None, only this region (x0, y0, x1, y1) of the image is converted, covering columns x0 to
+                   x1 - 1 and rows y0 to y1 - 1. Only the scanlines within the region are decoded.
+    :param channels: If not None, list of the EXR channels (names or layer indexes) to convert. Only these channels
+                     are decoded.
+    :param backend: 'tifffile' to write the TIFF file page by page (see exrconverter.tiffpages), so that only one
+                    page is held in memory, or 'sitk' to build the whole image with SimpleITK and write it at once.
+                    If None, tifffile is used when it is installed.
+    :param threads: If not None, the number of threads of the OpenEXR thread pool, which is process-wide, so that
+                    blocks of scanlines are decompressed in parallel. The channels are also converted by that many
+                    threads.
+    :param stats: optional exrconverter.stats.ConversionStats object, filled in with the time and bytes of the read,
+                  convert, headers and write stages of the conversion.
     :example: convert(input_exr="/path/to/input_exr.exr", output_tiff="/path/to/output_tiff.tiff",
                       output_pixel_type=numpy.float32, verbose=True)
     """
-    exr_file = OpenEXR.InputFile(input_exr)
+    __set_threads(threads)
+    if tiffpages.get_backend(backend) == 'tifffile':
+        __write_pages(input_exr, output_tiff, output_pixel_type, verbose, window, channels, threads, stats)
+        return
+
+    import SimpleITK as sitk  # only imported by the backend that uses it
+    tiff_image_final, tiff_image = __read_image(input_exr, output_pixel_type, verbose, window, channels, threads,
+                                                stats)
+
+    with stats.stage('write') as stage:
+        sitk.WriteImage(tiff_image_final, output_tiff)
+        stage.add(tiff_image.nbytes)
+
+
+@instrumented
+def to_image(input_exr, output_pixel_type=None, verbose=True, window=None, channels=None, threads=None, stats=None):
+    """
+    Converts an EXR file into a 3D SimpleITK image in memory, without writing a TIFF file. The image and its metadata
+    are the ones that convert would write, so it can be handed to SimpleITK, or turned into a numpy array with
+    SimpleITK.GetArrayFromImage, directly.
+    :param input_exr: path (string), binary file-like object or bytes of the input EXR file.
+    :param output_pixel_type: See convert.
+    :param verbose: Boolean variable for deciding whether to print warning messages.
+    :param window: See convert.
+    :param channels: See convert.
+    :param threads: See convert.
+    :param stats: optional exrconverter.stats.ConversionStats object. See convert.
+    :return: a SimpleITK.Image object with one page per EXR channel.
+    :example: array = sitk.GetArrayFromImage(to_image(request_body))
+    """
+    __set_threads(threads)
+    return __read_image(input_exr, output_pixel_type, verbose, window, channels, threads, stats)[0]
+
+
+def __read_image(input_exr, output_pixel_type, verbose, window, channels, threads, stats):
+    # Returns the SimpleITK image, and the (pages, rows, columns) array it was built from.
+    import SimpleITK as sitk
+    exr_file, exr_header, tiff_headers, window, channel_names = __open(input_exr, window, channels, stats)
+    x0, y0, x1, y1 = window
+    output_pixel_type = __get_output_pixel_type(exr_header, channel_names, output_pixel_type, verbose)
+    lock = threading.Lock()
+
+    # The pages are converted straight into one preallocated array, instead of being stacked from a list.
+    tiff_image = numpy.empty((len(channel_names), y1 - y0, x1 - x0), dtype=output_pixel_type)
+    __map(lambda page: __read_page(exr_file, exr_header, channel_names[page], output_pixel_type, window, lock, stats,
+                                   out=tiff_image[page]), range(len(channel_names)), threads)
+
+    with stats.stage('convert') as stage:
+        tiff_image_final = sitk.GetImageFromArray(tiff_image)
+        stage.add(tiff_image.nbytes)
+
+    # SimpleITK only keeps the metadata of the whole image, setting it on slices of the image (copies) is lost.
+    with stats.stage('headers'):
+        for key in tiff_headers[0].keys():
+            tiff_image_final.SetMetaData(key, tiff_headers[0][key])
+
+    return tiff_image_final, tiff_image
+
+
+def __write_pages(input_exr, output_tiff, output_pixel_type, verbose, window, channels, threads, stats):
+    exr_file, exr_header, tiff_headers, window, channel_names = __open(input_exr, window, channels, stats)
+    x0, y0, x1, y1 = window
+    output_pixel_type = __get_output_pixel_type(exr_header, channel_names, output_pixel_type, verbose)
+    lock = threading.Lock()
+
+    # Pages are written in order, so with several threads they are converted a batch of one page per thread at a time.
+    batch_size = max(threads or 1, 1)
+    with tiffpages.PageWriter(output_tiff, (len(channel_names), y1 - y0, x1 - x0), output_pixel_type,
+                              tiff_headers[0]) as writer:
+        for first_page in range(0, len(channel_names), batch_size):
+            batch_channel_names = channel_names[first_page:first_page + batch_size]
+            pages = __map(lambda channel_index: __read_page(exr_file, exr_header, channel_index, output_pixel_type,
+                                                            window, lock, stats), batch_channel_names, threads)
+            for channel_index, image_data in zip(batch_channel_names, pages):
+                with stats.stage('write') as stage:
+                    writer.write(image_data, __get_page_header(tiff_headers, channel_index))
+                    stage.add(image_data.nbytes)
+
+
+def __open(input_exr, window, channels, stats):
+    exr_file = __open_exr(input_exr)
     exr_header = exr_file.header()
-    tiff_headers = json.loads(exr_header[__TIFF_HEADERS_ID])
-    
-    dw = exr_header['dataWindow']
-    image_size = (dw.max.x - dw.min.x + 1, dw.max.y - dw.min.y + 1)
-    
-    tiff_image = []
-    for channel_index in sorted(exr_header['channels'].keys(), key=lambda x: float(x)): 
-        channel_type = exr_header['channels'][channel_index]
-        byte_image = exr_file.channel(str(channel_index), __get_exrpixel_from_channel(channel_type))
-        pixel_type = __get_pixeltype_from_channel(channel_type)
-        if output_pixel_type is None:
-            output_pixel_type = pixel_type
-        
-        image_data = numpy.frombuffer(byte_image, dtype=pixel_type)
-        image_data = numpy.reshape(image_data, (image_size[1], image_size[0]))
-        
-        if output_pixel_type == PixelType.FLOAT16:
-            image_data = __change_array_type(image_data, numpy.float32)
-            if verbose:
-                warnings.warn("Tiff does not support " + str(image_data.dtype) + " images. Converted to FLOAT32 instead.")
-        else:          
-            image_data = __change_array_type(image_data, output_pixel_type)
-
-        tiff_image.append(image_data)
-    
-    tiff_image_final = sitk.GetImageFromArray(tiff_image)
-
-    for key in tiff_headers[0].keys():
-        tiff_image_final.SetMetaData(key, tiff_headers[0][key])
-
-    for channel in range(tiff_image_final.GetDepth()):
-        for key in tiff_headers[channel + 1].keys():
-            tiff_image_final[:,:,channel].SetMetaData(key, tiff_headers[channel + 1][key])
-    
-    sitk.WriteImage(tiff_image_final, output_tiff)
-
-    
-        
-            
\ No newline at end of file
+    window = __get_window(exr_header, window)
+    channel_names = __get_channel_names(exr_header, channels)
+    with stats.stage('headers'):
+        tiff_headers = __get_tiff_headers(exr_header, channel_names)
+    stats.add_pixels((window[2] - window[0]) * (window[3] - window[1]) * len(channel_names))
+    return exr_file, exr_header, tiff_headers, window, channel_names
+
+
+def __get_tiff_headers(exr_header, channel_names):
+    # tiff_headers is [image header] + [header of each channel]. EXR files converted from FITS have FITS headers
+    # instead, which are stored in the ImageDescription of the pages (see exrconverter.image.to_tiff_header), and other
+    # EXR files no headers at all. Only the headers of the converted channels are rebuilt.
+    if exr_header.get(__TIFF_HEADERS_ID) is not None:
+        return json.loads(exr_header[__TIFF_HEADERS_ID])
+
+    channel_count = max([int(name) + 1 for name in exr_header['channels'] if name.isdigit()] + [0])
+    tiff_headers = [{}] + [{} for index in range(channel_count)]
+    header_indexes = __get_fits_header_indexes(exr_header)
+    fits_headers = __decode_fits_headers(exr_header, set(header_indexes[name] for name in channel_names
+                                                         if name in header_indexes))
+    if fits_headers is not None:
+        from astropy.io import fits
+        from .image import fits_header_to_dict, to_tiff_header
+        decoded = {}  # the channels of cubes share the header of their HDU
+        for name in channel_names:
+            header_index = header_indexes.get(name)
+            if header_index is None or header_index >= len(fits_headers) or int(name) >= channel_count:
+                continue
+            if header_index not in decoded:
+                decoded[header_index] = to_tiff_header(fits_header_to_dict(
+                    fits.Header.fromstring(fits_headers[header_index])))
+            tiff_headers[int(name) + 1] = decoded[header_index]
+    return tiff_headers
+
+
+def __get_page_header(tiff_headers, channel_name):
+    # Channels written by the converters are named after their layer index, other channels have no header.
+    if channel_name.isdigit() and int(channel_name) + 1 < len(tiff_headers):
+        return tiff_headers[int(channel_name) + 1]
+    return {}
+
+
+def __get_output_pixel_type(exr_header, channel_names, output_pixel_type, verbose):
+    # The type of the first channel if output_pixel_type is None, FLOAT32 instead of FLOAT16.
+    if output_pixel_type is None and len(channel_names) > 0:
+        output_pixel_type = __get_pixeltype_from_channel(exr_header['channels'][channel_names[0]])
+    if output_pixel_type == PixelType.FLOAT16:
+        if verbose:
+            warnings.warn("Tiff does not support float16 images. Converted to FLOAT32 instead.")
+        output_pixel_type = PixelType.FLOAT32
+    return output_pixel_type
+
+
+def __read_page(exr_file, exr_header, channel_index, output_pixel_type, window, lock, stats, out=None):
+    # Returns the pixels of a channel, converted to output_pixel_type (into out, if given).
+    x0, y0, x1, y1 = window
+    with stats.stage('read') as stage:
+        with lock:  # channels are decoded one at a time, by the OpenEXR thread pool
+            image_data = __read_channel(exr_file, exr_header, channel_index, y0, y1, x0, x1)
+        stage.add(image_data.nbytes)
+
+    with stats.stage('convert') as stage:
+        image_data = __change_array_type(image_data, output_pixel_type, out=out)
+        stage.add(image_data.nbytes)
+    return image_data
@@ -1,17 +1,30 @@
 from astropy.io import fits
 import OpenEXR
-import os
+import io
 import json
 import Imath
+import threading
 import warnings
-from .utils import __FITS_HEADERS_ID, __get_pixeltype_from_bitpix, __change_array_type, __get_channel_from_pixeltype
+from . import batch
+from .compression import COMPRESSION_OPTIONS, choose_compression
+from .stats import instrumented
+from .utils import __CHANNEL_STATS_ID, __FITS_PLANES_ID, __encode_fits_headers, __get_pixeltype_from_bitpix, __change_array_type,\
+    __get_channel_from_pixeltype, __new_buffer, __write_tiled, __write_scanlines, __is_path, __set_threads, __map
+from .verification import ChannelStats, encode_channel_stats
 
-def convert_directory(path, compression=None, output_pixel_type=None, verbose=True):
+def convert_directory(path, compression=None, output_pixel_type=None, verbose=True, workers=1, pool='process',
+                      streaming=False, block_size=256, tile_size=None, levels=None, compression_goal='lossless',
+                      incremental=False, checksum=False,
+                      shard_index=0, shard_count=1, claim_run=None, threads=None, channel_stats=False,
+                      trace_memory=False):
     """
     Converts directory of FITS files to EXR.
     :param path: path of the directory.
     :param compression: If equal to None, the output file will have ZIP_COMPRESSION (this is the exr default). 
                         Options are 'NONE', 'RLE', 'ZIPS', 'ZIPS', 'PIZ', 'PXR24', 'B44'. 'B44A', 'DWAA', or 'DWAB'.
+                        If equal to 'auto', the codec is picked according to compression_goal by benchmarking all of
+                        them on a strip of the image (see exrconverter.compression.choose_compression).
+    :param compression_goal: 'fastest', 'smallest' or 'lossless'. Only used when compression is 'auto'.
     :param output_pixel_type: If equal to None, the output file image will have the same pixel type or format
                               of that in the input file image. If changing the pixel type is desired, then
                               output_pixel_type can take the values defined by the fields in the class
@@ -19,30 +32,62 @@ def convert_directory(path, compression=None, output_pixel_type=None, verbose=Tr
                               Since the underlying implementation uses numpy arrays, output_pixel_type can also take
                               numpy dtypes values, For example, output_pixel_type=numpy.float32.
     :param verbose: Boolean variable for deciding whether to print warning messages.
+    :param streaming: If True, every file is converted in blocks of scanlines. See convert.
+    :param block_size: number of scanlines per block when streaming is True.
+    :param tile_size: If not None, the output files are tiled. See convert.
+    :param levels: None, 'mipmap' or 'ripmap'. See convert.
+    :param threads: If not None, number of threads converting the channels of every file. See convert.
+    :param channel_stats: If True, a checksum and statistics of every channel are stored in the files. See convert.
+    :param workers: number of files converted simultaneously. If equal to 1, files are converted one at a time.
+    :param pool: 'process' to convert in a pool of processes, or 'thread' to convert in a pool of threads.
+    :param incremental: If True, a manifest of the converted files is kept in the directory (see
+                        exrconverter.batch.Manifest), files whose output is up to date are skipped, and outputs are
+                        written atomically through a temporary file. Reruns then only convert new, changed or
+                        previously failed files.
+    :param checksum: If True, in incremental mode, inputs with a new modification time are only converted again if
+                     their content changed.
+    :param shard_index: index, from 0 to shard_count - 1, of the part of the directory converted by this call.
+    :param shard_count: If greater than 1, the directory is split into shard_count parts of about the same total size,
+                        the same on every node, and only the part shard_index is converted. Run one call per shard,
+                        e.g. one per node of an array job (see exrconverter.batch.shard).
+    :param claim_run: If not None, a name shared by all the shards of the run, such as the array job id. Files are
+                      then claimed before being converted, and once its shard is done a call goes on with files of the
+                      other shards that nobody claimed yet, so that no file is converted twice. Files that failed
+                      are released for a retry. Remove the claims of a finished run with
+                      exrconverter.batch.clear_claims.
+    :param trace_memory: If True, the peak memory allocated by every conversion is traced with tracemalloc (see
+                         exrconverter.stats.ConversionStats).
+    :return: an exrconverter.batch.BatchResult object with the successes, failures, timings and
+             ConversionStats of every file (aggregated in BatchResult.stats).
     :example: convert_directory(path='path/to/fits', output_pixel_type=numpy.float32, verbose=True)
     """
-    
-    for filename in os.listdir(path):
-        if filename[-4:] == 'fits':
-            output_filename = path + '/' + filename[:-5] + ".exr"
-        else:
-            continue
-        
-        if verbose:
-            print ("Converting: " + filename)
-         
-        convert(path + '/' + filename, output_filename, compression, output_pixel_type, verbose)
+    options = dict(compression=compression, output_pixel_type=output_pixel_type, verbose=verbose,
+                   streaming=streaming, block_size=block_size, tile_size=tile_size, levels=levels,
+                   compression_goal=compression_goal, threads=threads, channel_stats=channel_stats)
+    return batch.convert_directory(convert, path, ['fits'], 'exr', options, workers=workers, pool=pool, verbose=verbose,
+                                   incremental=incremental, checksum=checksum, shard_index=shard_index,
+                                   shard_count=shard_count, claim_run=claim_run, trace_memory=trace_memory)
 
-def convert(input_fits, output_exr, compression=None, output_pixel_type=None, verbose=True):
+@instrumented
+def convert(input_fits, output_exr, compression=None, output_pixel_type=None, verbose=True, streaming=False,
+            block_size=256, tile_size=None, levels=None, compression_goal='lossless', threads=None, channel_stats=False,
+            stats=None):
     """
     Converts an input FITS file into an EXR file. If the FITS file contains several HDUs, the code finds the
-    first 2D image HDUs that are of the same dimensions, and writes them as layers in the output EXR file.
+    first 2D image HDUs that are of the same dimensions, and writes them as layers in the output EXR file. Every plane
+    of a 3D image HDU (a cube) becomes a layer of its own, and the cube is read and written a block of scanlines at a
+    time across its planes, so that only about one plane is held in memory. exr2fits puts the cube back together.
     The pixels in the output image file can also be set to a different type as that of the pixels in the input
     image file.
-    :param input_fits: path (string) of the input FITS file.
-    :param output_exr: path (string) to the output EXR file.
+    :param input_fits: path (string) or binary file-like object of the input FITS file.
+    :param output_exr: path (string) to the output EXR file, or binary file-like object (with write, seek and tell)
+                       to write it to, such as io.BytesIO. File-like outputs require the OpenEXR python bindings
+                       version 3 or later, and cannot be written in streaming mode.
     :param compression: If equal to None, the output file will have ZIP_COMPRESSION (this is the exr default). 
                         Options are 'NONE', 'RLE', 'ZIPS', 'ZIPS', 'PIZ', 'PXR24', 'B44'. 'B44A', 'DWAA', or 'DWAB'.
+                        If equal to 'auto', the codec is picked according to compression_goal by benchmarking all of
+                        them on a strip of the image (see exrconverter.compression.choose_compression).
+    :param compression_goal: 'fastest', 'smallest' or 'lossless'. Only used when compression is 'auto'.
     :param output_pixel_type: If equal to None, the output file image will have the same pixel type or format
                               of that in the input file image. If changing the pixel type is desired, then
                               output_pixel_type can take the values defined by the fields in the class
@@ -50,60 +95,245 @@ def convert(input_fits, output_exr, compression=None, output_pixel_type=None, ve
                               Since the underlying implementation uses numpy arrays, output_pixel_type can also take
                               numpy dtypes values, For example, output_pixel_type=numpy.float32.
     :param verbose: Boolean variable for deciding whether to print warning messages.
+    :param streaming: If True, the HDUs are read and the EXR file is written in blocks of block_size scanlines, so
+                      that the peak memory depends on the block size and not on the image size. Use it for very
+                      large images such as co-added mosaics.
+    :param block_size: number of scanlines converted and written at once when streaming is True.
+    :param tile_size: If not None, the output EXR file is tiled instead of made of scanlines, so that random access
+                      readers only decode the tiles they need. Either the tile width and height in pixels, as an
+                      integer, or a (width, height) tuple. Tiled files cannot be written in streaming mode, and
+                      require the OpenEXR python bindings version 3 or later.
+    :param levels: If equal to 'mipmap' or 'ripmap', reduced resolution levels of the image are written as additional
+                   tiled parts of the EXR file, for zoomed out previews (see utils.__write_tiled). Implies tiles,
+                   64x64 by default.
+    :param threads: If not None, the number of threads of the OpenEXR thread pool, which is process-wide, and of the
+                    EXR file, so that blocks of scanlines are compressed in parallel. The HDUs are also decoded and
+                    converted by that many threads, each one with its own handle of the input file.
+    :param channel_stats: If True, the CRC-32 checksum of every channel, and the min, max, NaN, inf and float16
+                          overflow counts of its source pixels, are stored in the channel_stats attribute of the EXR
+                          header (see exrconverter.verification), for verify to check the file against. The header is
+                          written before the pixels, so when writing in blocks of scanlines (streaming mode and cubes)
+                          the HDUs are read twice.
+    :param stats: optional exrconverter.stats.ConversionStats object, filled in with the time and bytes of the read,
+                  convert, headers and write stages of the conversion.
     :example: convert(input_fits="/path/to/input_fits.fits", output_exr="/path/to/output_exr.exr",
                       output_pixel_type=numpy.float32, verbose=True)
     """
 
-    fits_image_indexes = []  # will contain the indexes of HDUs (within the fits file) that contain images.
+    if streaming and not __is_path(output_exr):
+        raise Exception("EXR files can only be written in streaming mode to a path")
+
+    __set_threads(threads)
+    with fits.open(input_fits, memmap=False) as hdu_list:
+        __convert_hdulist(hdu_list, output_exr, compression, output_pixel_type, verbose, streaming, block_size,
+                          tile_size, levels, compression_goal, threads, input_fits if __is_path(input_fits) else None,
+                          channel_stats, stats)
+
+
+@instrumented
+def from_hdulist(hdu_list, compression=None, output_pixel_type=None, verbose=True, tile_size=None, levels=None,
+                 compression_goal='lossless', threads=None, channel_stats=False, stats=None):
+    """
+    Converts an astropy HDUList, such as one built in memory or opened from an uploaded stream, into the bytes of an
+    EXR file, without going through the disk. The HDUs are selected as in convert. Requires the OpenEXR python
+    bindings version 3 or later.
+    :param hdu_list: astropy.io.fits.HDUList object.
+    :param compression: See convert.
+    :param output_pixel_type: See convert.
+    :param verbose: Boolean variable for deciding whether to print warning messages.
+    :param tile_size: See convert.
+    :param levels: See convert.
+    :param compression_goal: See convert.
+    :param threads: See convert. The HDUs are converted, but not decoded, in parallel.
+    :param channel_stats: See convert.
+    :param stats: optional exrconverter.stats.ConversionStats object. See convert.
+    :return: the EXR file as bytes, or None if the HDUList has no images.
+    :example: exr_bytes = from_hdulist(fits.HDUList([fits.PrimaryHDU(data)]), compression='ZIP')
+    """
+    __set_threads(threads)
+    output_exr = io.BytesIO()
+    if not __convert_hdulist(hdu_list, output_exr, compression, output_pixel_type, verbose, False, 256, tile_size,
+                             levels, compression_goal, threads, None, channel_stats, stats):
+        return None
+    return output_exr.getvalue()
+
+
+def __convert_hdulist(hdu_list, output_exr, compression, output_pixel_type, verbose, streaming, block_size, tile_size,
+                      levels, compression_goal, threads, input_path, channel_stats, stats):
+    # Returns False if the HDUList has no images, and nothing is written. input_path is the path of the FITS file the
+    # HDUList was opened from, if any, which worker threads open again to decode HDUs in parallel.
+    tiled = tile_size is not None or levels is not None
+    if tiled and streaming:
+        raise Exception("Tiled EXR files cannot be written in streaming mode")
+
+    # Every EXR channel is a layer (HDU index, plane). A 2D HDU is a single layer, with plane None, and every plane
+    # of a 3D HDU (a cube) is a layer of its own.
+    layers = []
     image_array_shape = None
 
-    with fits.open(input_fits) as hdu_list:
-
-        for index, hdu in enumerate(hdu_list):
-            if hdu.is_image:
-                if len(hdu.data.shape) == 2:  # only 2D arrays for now
-
-                    if image_array_shape is None:
-                        image_array_shape = hdu.data.shape
-                        fits_image_indexes.append(index)
-                        if output_pixel_type is None:
-                            output_pixel_type = __get_pixeltype_from_bitpix(bitpix=hdu.header["BITPIX"])
-                    else:
-                        if hdu.data.shape == image_array_shape \
-                                and output_pixel_type == __get_pixeltype_from_bitpix(bitpix=hdu.header["BITPIX"]):
-                            fits_image_indexes.append(index)
-
-        if len(fits_image_indexes) == 0:
-            if verbose:
-                warnings.warn("Fits file has no images.")
-            return
-
-        exr_header = OpenEXR.Header(image_array_shape[1], image_array_shape[0])
-
-        compression_options = {'NO' : Imath.Compression.NO_COMPRESSION, 'RLE' : Imath.Compression.RLE_COMPRESSION, 'ZIPS' : Imath.Compression.ZIPS_COMPRESSION,
-                            'ZIP' : Imath.Compression.ZIP_COMPRESSION, 'PIZ' : Imath.Compression.PIZ_COMPRESSION, 'PXR24' : Imath.Compression.PXR24_COMPRESSION,
-                            'B44' : Imath.Compression.B44_COMPRESSION, 'B44A' : Imath.Compression.B44A_COMPRESSION,'DWAA' : Imath.Compression.DWAA_COMPRESSION, 
-                            'DWAB' : Imath.Compression.DWAB_COMPRESSION
-                            }
-    
-        if compression:
-            exr_header['compression'] = Imath.Compression(compression_options[compression])
-
-        exr_header['channels'] = {}
-        exr_data = {}
-        fits_headers = []
-
-        for exr_index, fits_index in enumerate(fits_image_indexes):
-            hdu = hdu_list[fits_index]
-            exr_data[str(exr_index)] = __change_array_type(hdu.data, output_pixel_type)
-            exr_header['channels'][str(exr_index)] = __get_channel_from_pixeltype(output_pixel_type)
-            fits_headers.append(
-                hdu.header.tostring())
-
-        exr_header[__FITS_HEADERS_ID] = str.encode(json.dumps(fits_headers))
-
-        try:
-            exr_file = OpenEXR.OutputFile(output_exr, exr_header)
-            exr_file.writePixels(exr_data)
-        finally:
-            exr_file.close()
+    for index, hdu in enumerate(hdu_list):
+        if hdu.is_image:
+            if len(hdu.shape) in (2, 3):  # images and cubes
+
+                if image_array_shape is None:
+                    image_array_shape = hdu.shape[-2:]
+                    if output_pixel_type is None:
+                        output_pixel_type = __get_pixeltype_from_bitpix(bitpix=hdu.header["BITPIX"])
+                elif hdu.shape[-2:] != image_array_shape \
+                        or output_pixel_type != __get_pixeltype_from_bitpix(bitpix=hdu.header["BITPIX"]):
+                    continue
+                planes = range(hdu.shape[0]) if len(hdu.shape) == 3 else [None]
+                layers.extend((index, plane) for plane in planes)
+
+    if len(layers) == 0:
+        if verbose:
+            warnings.warn("Fits file has no images.")
+        return False
+
+    fits_image_indexes = sorted(set(index for index, plane in layers))
+    cubes = any(plane is not None for index, plane in layers)
+
+    # Cubes are written in blocks of scanlines across all of their planes, about one plane at a time, unless the whole
+    # file has to be in memory anyway (tiled files and file-like outputs).
+    blocks = (streaming or cubes) and not tiled and __is_path(output_exr)
+    if blocks and not streaming:
+        block_size = max(1, image_array_shape[0] // len(layers))
+
+    exr_header = OpenEXR.Header(image_array_shape[1], image_array_shape[0])
+
+    if compression == 'auto':
+        # Only the first plane of the cubes is sampled.
+        compression = choose_compression(dict((str(exr_index), __get_plane(hdu_list[fits_index], plane))
+                                              for exr_index, (fits_index, plane) in enumerate(layers)
+                                              if plane in (None, 0)),
+                                         compression_goal, pixel_type=output_pixel_type)
+        if verbose:
+            print ("Selected compression: " + compression)
+
+    if compression:
+        exr_header['compression'] = Imath.Compression(COMPRESSION_OPTIONS[compression])
+
+    exr_header['channels'] = dict((str(exr_index), __get_channel_from_pixeltype(output_pixel_type))
+                                  for exr_index in range(len(layers)))
+    exr_data = {}
+    layer_stats = [ChannelStats() for layer in layers] if channel_stats else [None] * len(layers)
+
+    if not blocks:
+        lock = threading.Lock()
+        exr_data = dict((str(exr_index), layer_data) for exr_index, layer_data in enumerate(
+            __map(lambda exr_index: __read_layer(hdu_list, layers[exr_index], output_pixel_type, threads, input_path,
+                                                 lock, layer_stats[exr_index], stats),
+                  range(len(layers)), threads)))
+    elif channel_stats:
+        # The statistics go in the header, which is written before the first block: a first pass computes them.
+        __write_blocks(None, [(hdu_list[index], plane) for index, plane in layers], image_array_shape,
+                       output_pixel_type, block_size, threads, stats, layer_stats)
+    stats.add_pixels(image_array_shape[0] * image_array_shape[1] * len(layers))
+
+    with stats.stage('headers') as stage:
+        # One header per HDU, with the cards they share stored once (see __encode_fits_headers).
+        attributes = __encode_fits_headers([hdu_list[index].header.tostring() for index in fits_image_indexes])
+        if cubes:
+            # fits_planes then gives the header index and the plane (None for 2D HDUs) of every channel.
+            attributes[__FITS_PLANES_ID] = json.dumps([[fits_image_indexes.index(index), plane]
+                                                       for index, plane in layers])
+        if channel_stats:
+            attributes[__CHANNEL_STATS_ID] = encode_channel_stats(layer_stats)
+        stage.add(sum(len(value) for value in attributes.values()))
+
+    if not blocks and (tiled or not __is_path(output_exr)):
+        with stats.stage('write') as stage:
+            if tiled:
+                __write_tiled(output_exr, exr_data, attributes, compression, tile_size, levels, threads)
+            else:
+                __write_scanlines(output_exr, exr_data, attributes, compression, threads)
+            stage.add(sum(data.nbytes for data in exr_data.values()))
+        return True
+
+    for key, value in attributes.items():
+        exr_header[key] = str.encode(value)
+
+    exr_file = OpenEXR.OutputFile(output_exr, exr_header)
+    try:
+        if blocks:
+            __write_blocks(exr_file, [(hdu_list[index], plane) for index, plane in layers], image_array_shape,
+                           output_pixel_type, block_size, threads, stats)
+        else:
+            with stats.stage('write') as stage:
+                exr_file.writePixels(exr_data)
+                stage.add(sum(data.nbytes for data in exr_data.values()))
+    finally:
+        exr_file.close()
+    return True
+
+
+def __read_layer(hdu_list, layer, output_pixel_type, threads, input_path, lock, layer_stats, stats):
+    # Reads and converts the pixels of a (HDU index, plane) layer, and updates its ChannelStats if any. The HDUs of an
+    # HDUList share a file handle, so worker threads either open the file again or take turns to read.
+    fits_index, plane = layer
+    with stats.stage('read') as stage:
+        if threads is not None and threads > 1 and input_path is not None:
+            with fits.open(input_path, memmap=False, lazy_load_hdus=True) as thread_hdu_list:
+                hdu = thread_hdu_list[fits_index]
+                hdu_data = hdu.data if plane is None else hdu.section[plane]
+        else:
+            with lock:
+                hdu_data = hdu_list[fits_index].data
+            if plane is not None:
+                hdu_data = hdu_data[plane]
+        stage.add(hdu_data.nbytes)
+    with stats.stage('convert') as stage:
+        layer_data = __change_array_type(hdu_data, output_pixel_type)
+        stage.add(layer_data.nbytes)
+    if layer_stats is not None:
+        with stats.stage('headers'):
+            layer_stats.update(hdu_data, layer_data)
+    return layer_data
+
+
+def __get_section(hdu):
+    # hdu.section reads rows straight from the file. HDUs built in memory have no file, and their data is at hand.
+    return hdu.section if hdu.fileinfo() is not None else hdu.data
+
+
+def __get_plane(hdu, plane):
+    section = __get_section(hdu)
+    return section if plane is None else section[plane]
+
+
+def __write_blocks(exr_file, layers, image_array_shape, output_pixel_type, block_size, threads, stats,
+                   layer_stats=None):
+    # hdu.section only reads (and scales) the requested rows, so that only one block per layer is held in memory.
+    # The file is opened without memmap, since mapped pages would otherwise stay resident and count towards RSS. Whole
+    # HDUs are copied by the type conversion anyway, so memmap saves nothing there. If layer_stats is given, the
+    # ChannelStats of every layer are updated with the blocks, and nothing is written if exr_file is None.
+    height, width = image_array_shape
+    buffers = [__new_buffer((min(block_size, height), width), output_pixel_type) for layer in layers]
+    lock = threading.Lock()
+
+    def convert_block(exr_index, first_row, last_row):
+        hdu, plane = layers[exr_index]
+        with stats.stage('read') as stage:
+            with lock:  # the HDUs share a file handle
+                if plane is None:
+                    block = __get_section(hdu)[first_row:last_row, :]
+                else:
+                    block = __get_section(hdu)[plane, first_row:last_row, :]
+            stage.add(block.nbytes)
+        with stats.stage('convert') as stage:
+            converted = __change_array_type(block, output_pixel_type, out=buffers[exr_index][:last_row - first_row])
+            stage.add(converted.nbytes)
+        if layer_stats is not None:
+            with stats.stage('headers'):
+                layer_stats[exr_index].update(block, converted)
+        return converted
+
+    for first_row in range(0, height, block_size):
+        last_row = min(first_row + block_size, height)
+        exr_data = dict((str(exr_index), block) for exr_index, block in enumerate(
+            __map(lambda exr_index: convert_block(exr_index, first_row, last_row), range(len(layers)), threads)))
+        if exr_file is None:
+            continue
+        with stats.stage('write') as stage:
+            exr_file.writePixels(exr_data, last_row - first_row)
+            stage.add(sum(data.nbytes for data in exr_data.values()))
@@ -0,0 +1,317 @@
+"""
+Format neutral image model shared by the FITS and TIFF readers and writers of exrconverter.router: a stack of 2D
+layers of the same shape and type, a header per layer and a header of the whole image. Headers are dictionaries from
+keyword to value, as decoded by exrconverter.catalog, so the HDUs of a FITS file can become the pages of a TIFF file,
+and back, without going through EXR. Layers are read lazily, and written one at a time.
+"""
+import json
+import threading
+import warnings
+import numpy
+from astropy.io import fits
+from . import tiffpages
+from .router import get_format
+from .stats import ConversionStats
+from .utils import __change_array_type, __get_pixeltype_from_bitpix
+
+FORMATS = ['fits', 'tiff']
+
+# FITS keywords that describe the layout of the data, which the FITS writer derives from the arrays, and keywords that
+# repeat within a header. Neither is part of the decoded headers.
+FITS_STRUCTURAL = ('SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'EXTEND', 'PCOUNT', 'GCOUNT', 'BSCALE', 'BZERO', 'BLANK',
+                   'CHECKSUM', 'DATASUM', 'END')
+FITS_COMMENTARY = ('', 'COMMENT', 'HISTORY')
+
+
+class Image(object):
+    """
+    Stack of 2D layers of the same shape and type, with their headers.
+    :param layers: list of the layers: 2D numpy arrays, or lazy views such as exrconverter.tiffpages.Page that have
+                   shape and dtype attributes and read the rows they are sliced with.
+    :param headers: optional list of the header (dictionary) of every layer.
+    :param header: optional header (dictionary) of the whole image, which applies to every layer.
+    :param close: optional function that releases the files the layers are read from.
+    :example: with read("/path/to/input.fits") as image: write(image, "/path/to/output.tif")
+    """
+
+    def __init__(self, layers, headers=None, header=None, close=None):
+        self.layers = list(layers)
+        self.headers = list(headers) if headers is not None else [{} for layer in self.layers]
+        self.header = header or {}
+        self.__close = close
+        if len(self.headers) != len(self.layers):
+            raise Exception("Image with " + str(len(self.layers)) + " layers and " + str(len(self.headers)) +
+                            " headers")
+        for layer in self.layers[1:]:
+            if layer.shape != self.layers[0].shape or layer.dtype != self.layers[0].dtype:
+                raise Exception("Layers of shape " + str(layer.shape) + " and " + str(self.layers[0].shape) +
+                                ", or of type " + str(layer.dtype) + " and " + str(self.layers[0].dtype))
+
+    @property
+    def shape(self):
+        """
+        (layers, rows, columns) of the image.
+        """
+        return (len(self.layers),) + (tuple(self.layers[0].shape) if self.layers else (0, 0))
+
+    @property
+    def dtype(self):
+        return numpy.dtype(self.layers[0].dtype) if self.layers else None
+
+    def get_header(self, index):
+        """
+        Returns the header of a layer, merged with the header of the image.
+        """
+        header = dict(self.header)
+        header.update(self.headers[index])
+        return header
+
+    def close(self):
+        if self.__close is not None:
+            self.__close()
+            self.__close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+
+class FitsLayer(object):
+    """
+    Lazy view of a 2D HDU, or of a plane of a 3D HDU, of an HDUList opened from a file. Slicing its rows reads (and
+    scales) only those rows.
+    """
+
+    def __init__(self, hdu, plane=None, lock=None):
+        self.hdu = hdu
+        self.plane = plane
+        self.shape = tuple(hdu.shape[-2:])
+        self.__lock = lock or threading.Lock()
+        self.dtype = self[0:1, 0:1].dtype
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        with self.__lock:  # the HDUs share a file handle
+            section = self.hdu.section if self.hdu.fileinfo() is not None else self.hdu.data
+            return section[key if self.plane is None else (self.plane,) + key]
+
+
+def read(path):
+    """
+    Opens a FITS or TIFF file as an Image, according to its extension. Pixels are only read when the layers are sliced.
+    """
+    file_format = get_format(path)
+    if file_format == 'fits':
+        return read_fits(path)
+    if file_format == 'tiff':
+        return read_tiff(path)
+    raise Exception("Unsupported image format " + file_format + ". Options are " + ", ".join(FORMATS))
+
+
+def write(image, path, output_pixel_type=None, verbose=True, stats=None):
+    """
+    Writes an Image to a FITS or TIFF file, according to its extension. See write_fits and write_tiff.
+    """
+    file_format = get_format(path)
+    if file_format == 'fits':
+        return write_fits(image, path, output_pixel_type, verbose, stats)
+    if file_format == 'tiff':
+        return write_tiff(image, path, output_pixel_type, verbose, stats)
+    raise Exception("Unsupported image format " + file_format + ". Options are " + ", ".join(FORMATS))
+
+
+def read_fits(path, pixel_type=None):
+    """
+    Opens a FITS file as an Image. As in fits2exr, every 2D image HDU is a layer, and every plane of a 3D one (a
+    cube), as long as they have the same size and type as the first one. Each layer has the header of its HDU.
+    :param pixel_type: If not None, the layers are the HDUs that fits2exr converts into an EXR file of this pixel type:
+                       the first image HDU, and the following ones of the same size whose BITPIX is of this type.
+    """
+    hdu_list = fits.open(path, memmap=False, lazy_load_hdus=True)
+    lock = threading.Lock()
+    layers = []
+    headers = []
+    try:
+        for hdu in hdu_list:
+            if not hdu.is_image or len(hdu.shape) not in (2, 3):
+                continue
+            if pixel_type is not None and layers and (tuple(hdu.shape[-2:]) != layers[0].shape or
+                                                      __get_pixeltype_from_bitpix(hdu.header['BITPIX']) != pixel_type):
+                continue
+            planes = range(hdu.shape[0]) if len(hdu.shape) == 3 else [None]
+            for plane in planes:
+                layer = FitsLayer(hdu, plane, lock)
+                if layers and (layer.shape != layers[0].shape or layer.dtype != layers[0].dtype):
+                    break
+                layers.append(layer)
+                headers.append(fits_header_to_dict(hdu.header))
+    except Exception:
+        hdu_list.close()
+        raise
+    return Image(layers, headers, close=hdu_list.close)
+
+
+def read_tiff(path):
+    """
+    Opens a TIFF file as an Image, with one layer per page. With the tifffile backend (see exrconverter.tiffpages)
+    pages are read lazily, and each one has its own header. Otherwise the image is read by SimpleITK, which only keeps
+    the metadata of the whole image.
+    """
+    if tiffpages.get_backend() == 'tifffile':
+        reader = tiffpages.PageReader(path)
+        # The header of the image is made of the keywords that all the pages share, once decoded.
+        headers = [from_tiff_header(tags) for tags in reader.headers[1:]]
+        header = dict((keyword, value) for keyword, value in headers[0].items()
+                      if all(keyword in other and other[keyword] == value for other in headers[1:]))
+        return Image([reader.page(index) for index in range(reader.shape[0])],
+                     [dict((keyword, value) for keyword, value in page_header.items() if keyword not in header)
+                      for page_header in headers], header, close=reader.close)
+
+    import SimpleITK as sitk
+    sitk_image = sitk.ReadImage(path)
+    array = sitk.GetArrayFromImage(sitk_image)  # a view would not keep the image alive
+    layers = list(array) if array.ndim == 3 else [array]
+    return Image(layers, header=from_tiff_header(dict((key, sitk_image.GetMetaData(key))
+                                                      for key in sitk_image.GetMetaDataKeys())))
+
+
+def write_fits(image, path, output_pixel_type=None, verbose=True, stats=None):
+    """
+    Writes an Image to a FITS file, one layer at a time: the first layer is the primary HDU, and every other one an
+    image extension. Each HDU gets the header of its layer, merged with the header of the image.
+    :param output_pixel_type: If None, the type of the layers. Otherwise, one of the fields of the class
+                              exrconverter.pixeltype.PixelType, or the equivalent numpy dtype.
+    :param stats: optional exrconverter.stats.ConversionStats object.
+    """
+    stats = stats if stats is not None else ConversionStats()
+    if not image.layers:
+        if verbose:
+            warnings.warn("Image has no layers.")
+        return False
+
+    for index in range(len(image.layers)):
+        layer_data = __read_layer(image, index, output_pixel_type, stats)
+        with stats.stage('headers'):
+            header = to_fits_header(image.get_header(index))
+        with stats.stage('write') as stage:
+            if index == 0:
+                fits.PrimaryHDU(layer_data, header).writeto(path, overwrite=True)
+            else:
+                fits.append(path, layer_data, header)
+            stage.add(layer_data.nbytes)
+    return True
+
+
+def write_tiff(image, path, output_pixel_type=None, verbose=True, stats=None):
+    """
+    Writes an Image to a multi-page TIFF file, one page per layer. With the tifffile backend, pages are written one
+    at a time, each one with its whole header (see Image.get_header). Otherwise the image is built and written by SimpleITK, with the header of the
+    image only. See to_tiff_header for the way headers are stored in TIFF tags.
+    :param output_pixel_type: See write_fits.
+    :param stats: optional exrconverter.stats.ConversionStats object.
+    """
+    stats = stats if stats is not None else ConversionStats()
+    if not image.layers:
+        if verbose:
+            warnings.warn("Image has no layers.")
+        return False
+
+    if tiffpages.get_backend() == 'tifffile':
+        dtype = image.dtype if output_pixel_type is None else numpy.dtype(output_pixel_type)
+        with tiffpages.PageWriter(path, image.shape, dtype) as writer:
+            for index in range(len(image.layers)):
+                layer_data = __read_layer(image, index, output_pixel_type, stats)
+                with stats.stage('headers'):
+                    tags = to_tiff_header(image.get_header(index))
+                    # Pages with an empty header get an empty description too, so that readers that fill in the
+                    # missing tags of a page from the first one, as older versions did, do not give it another header.
+                    tags.setdefault('ImageDescription', '{}')
+                with stats.stage('write') as stage:
+                    writer.write(layer_data, tags)
+                    stage.add(layer_data.nbytes)
+        return True
+
+    import SimpleITK as sitk
+    array = numpy.stack([__read_layer(image, index, output_pixel_type, stats) for index in range(len(image.layers))])
+    with stats.stage('write') as stage:
+        sitk_image = sitk.GetImageFromArray(array)
+        for key, value in to_tiff_header(image.header).items():
+            sitk_image.SetMetaData(key, value)
+        sitk.WriteImage(sitk_image, path)
+        stage.add(array.nbytes)
+    return True
+
+
+def fits_header_to_dict(header):
+    """
+    Decodes an astropy.io.fits.Header, leaving out the structural and commentary keywords.
+    """
+    return dict((keyword, value) for keyword, value in header.items()
+                if keyword not in FITS_COMMENTARY and keyword not in FITS_STRUCTURAL
+                and not keyword.startswith('NAXIS'))
+
+
+def to_fits_header(header):
+    """
+    Encodes a decoded header as an astropy.io.fits.Header. Keywords longer than 8 characters become HIERARCH cards,
+    values that are not strings, numbers or booleans are stored as JSON, and non-printable characters as spaces.
+    """
+    fits_header = fits.Header()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', fits.verify.VerifyWarning)  # HIERARCH cards
+        for keyword, value in header.items():
+            if keyword.upper() in FITS_COMMENTARY or keyword.upper() in FITS_STRUCTURAL \
+                    or keyword.upper().startswith('NAXIS'):
+                continue
+            if not isinstance(value, (str, bool, int, float)):
+                value = json.dumps(value, default=str)
+            if isinstance(value, str):
+                value = ''.join(character if ' ' <= character <= '~' else ' ' for character in value)
+            fits_header[keyword] = value
+    return fits_header
+
+
+def to_tiff_header(header):
+    """
+    Encodes a decoded header as TIFF tags: keywords that are exrconverter.tiffpages.TEXT_TAGS are written as such, and
+    all the others as a JSON object in the ImageDescription tag (which then includes the original description).
+    """
+    tags = dict((keyword, str(value)) for keyword, value in header.items() if keyword in tiffpages.TEXT_TAGS)
+    others = dict((keyword, value) for keyword, value in header.items() if keyword not in tiffpages.TEXT_TAGS)
+    if others:
+        if 'ImageDescription' in tags:
+            others['ImageDescription'] = tags['ImageDescription']
+        tags['ImageDescription'] = json.dumps(others, default=str)
+    return tags
+
+
+def from_tiff_header(tags):
+    """
+    Decodes TIFF tags written by to_tiff_header. Tags whose ImageDescription is not a JSON object are kept as they are.
+    """
+    header = dict(tags)
+    try:
+        description = json.loads(header.get('ImageDescription', ''))
+    except ValueError:
+        description = None
+    if isinstance(description, dict):
+        del header['ImageDescription']
+        header.update(description)
+    return header
+
+
+def __read_layer(image, index, output_pixel_type, stats):
+    # Reads a whole layer, in native byte order, converted to output_pixel_type if it is not None.
+    with stats.stage('read') as stage:
+        layer_data = numpy.asarray(image.layers[index][:])
+        stage.add(layer_data.nbytes)
+    with stats.stage('convert') as stage:
+        if output_pixel_type is not None:
+            layer_data = __change_array_type(layer_data, output_pixel_type)
+        else:
+            layer_data = numpy.ascontiguousarray(layer_data, dtype=layer_data.dtype.newbyteorder('='))
+        stage.add(layer_data.nbytes)
+    return layer_data
@@ -0,0 +1,198 @@
+import threading
+import uuid
+import numpy
+from .utils import __get_pixeltype_from_channel, __change_array_type, __get_channel_names, __get_window, \
+    __read_channel, __open_exr
+
+# Names starting with two underscores are mangled inside classes, so ExrArray uses these aliases of the helpers.
+_get_pixeltype_from_channel, _change_array_type, _get_channel_names, _get_window, _read_channel, _open_exr = \
+    __get_pixeltype_from_channel, __change_array_type, __get_channel_names, __get_window, __read_channel, __open_exr
+
+
+def read_region(input_exr, window=None, channels=None, output_pixel_type=None):
+    """
+    Reads a region of interest of an EXR file into memory. Only the scanlines that intersect the region, and only the
+    requested channels, are decoded, so the cost of a cutout scales with its size rather than with the image size.
+    :param input_exr: path (string), binary file-like object or bytes of the input EXR file.
+    :param window: region (x0, y0, x1, y1) to read, covering columns x0 to x1 - 1 and rows y0 to y1 - 1 relative to
+                   the corner of the data window. If equal to None, the whole image is read.
+    :param channels: list of the EXR channels (names or layer indexes) to read. If equal to None, all channels are read.
+    :param output_pixel_type: If equal to None, the arrays will have the same pixel type as the channels in the EXR
+                              file. Otherwise, one of the fields of the class exrconverter.pixeltype.PixelType, or the
+                              equivalent numpy dtype.
+    :return: dictionary from channel name to a 2D numpy array of shape (y1 - y0, x1 - x0), in layer order.
+    :example: read_region("/path/to/input_exr.exr", window=(100, 200, 164, 264), channels=[0, 2])
+    """
+    exr_file = __open_exr(input_exr)
+    try:
+        exr_header = exr_file.header()
+        x0, y0, x1, y1 = __get_window(exr_header, window)
+
+        region = {}
+        for channel_index in __get_channel_names(exr_header, channels):
+            pixel_type = output_pixel_type
+            if pixel_type is None:
+                pixel_type = __get_pixeltype_from_channel(exr_header['channels'][channel_index])
+            data = __read_channel(exr_file, exr_header, channel_index, y0, y1, x0, x1)
+            region[channel_index] = __change_array_type(data, pixel_type)
+    finally:
+        exr_file.close()
+    return region
+
+
+class ExrArray(object):
+    """
+    Lazy, read-only 3D array view of the channels of an EXR file, of shape (channels, height, width). Nothing is
+    decoded until the array is sliced, and then only the scanlines and channels that the slice touches are read. It
+    supports numpy basic indexing (integers, slices with any step and Ellipsis), numpy.asarray, and can be used as
+    the source of a dask array (see to_dask and stack), so that stacks of EXR files can be reduced out of core.
+    The EXR file stays open for the lifetime of the object. Reads are serialized with a lock, so the object can be
+    shared by threads, and the file is opened again in each process the object is pickled to.
+    :param input_exr: path (string), or bytes, of the EXR file.
+    :param channels: list of the EXR channels (names or layer indexes) exposed by the array. If equal to None, all of
+                     them, in layer order.
+    :param output_pixel_type: If equal to None, the type of the EXR channels. Otherwise, one of the fields of the class
+                              exrconverter.pixeltype.PixelType, or the equivalent numpy dtype.
+    :example: cube = ExrArray("/path/to/input_exr.exr"); cutout = cube[0, 100:164, 200:264]
+    """
+
+    # Scanlines compressed together by each EXR codec: reading a slice decodes whole blocks of this many rows.
+    BLOCK_ROWS = {'NO_COMPRESSION': 1, 'RLE_COMPRESSION': 1, 'ZIPS_COMPRESSION': 1, 'ZIP_COMPRESSION': 16,
+                  'PXR24_COMPRESSION': 16, 'PIZ_COMPRESSION': 32, 'B44_COMPRESSION': 32, 'B44A_COMPRESSION': 32,
+                  'DWAA_COMPRESSION': 32, 'DWAB_COMPRESSION': 256}
+
+    def __init__(self, input_exr, channels=None, output_pixel_type=None):
+        self.input_exr = input_exr
+        self.__exr_file = None
+        self.__lock = threading.Lock()
+
+        exr_header = self.__open().header()
+        self.channel_names = _get_channel_names(exr_header, channels)
+        x0, y0, x1, y1 = _get_window(exr_header)
+        self.shape = (len(self.channel_names), y1 - y0, x1 - x0)
+        if output_pixel_type is None:
+            output_pixel_type = numpy.result_type(*[_get_pixeltype_from_channel(exr_header['channels'][name])
+                                                    for name in self.channel_names])
+        self.dtype = numpy.dtype(output_pixel_type)
+        self.block_rows = self.BLOCK_ROWS.get(str(exr_header['compression']), 32)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1] * self.shape[2]
+
+    @property
+    def chunks(self):
+        """
+        Natural chunk shape of the array: one channel, and whole compression blocks of rows totalling at least a
+        megapixel (or the whole image, if smaller). Used by to_dask.
+        """
+        rows = max(self.block_rows, (1 << 20) // max(self.shape[2], 1) // self.block_rows * self.block_rows)
+        return 1, min(rows, self.shape[1]), self.shape[2]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        channel_key, row_key, column_key = self.__normalize(key)
+
+        channel_indexes = range(self.shape[0])[channel_key]
+        rows = range(self.shape[1])[row_key]
+        channel_list = [channel_indexes] if isinstance(channel_indexes, int) else list(channel_indexes)
+        row_range = range(rows, rows + 1) if isinstance(rows, int) else rows
+
+        if len(channel_list) == 0 or len(row_range) == 0:
+            width = len(range(self.shape[2])[column_key]) if isinstance(column_key, slice) else None
+            shape = [len(channel_list)] if not isinstance(channel_indexes, int) else []
+            shape += [len(row_range)] if not isinstance(rows, int) else []
+            shape += [width] if width is not None else []
+            return numpy.empty(shape, dtype=self.dtype)
+
+        first_row, last_row = min(row_range), max(row_range) + 1
+        block = numpy.empty((len(channel_list), last_row - first_row, self.shape[2]), dtype=self.dtype)
+        with self.__lock:
+            exr_file = self.__open()
+            exr_header = exr_file.header()
+            for index, channel_index in enumerate(channel_list):
+                data = _read_channel(exr_file, exr_header, self.channel_names[channel_index], first_row, last_row)
+                _change_array_type(data, self.dtype.type, out=block[index])
+
+        local_rows = slice(None) if row_range.step == 1 else numpy.array(row_range) - first_row
+        if isinstance(rows, int):
+            local_rows = 0
+        return block[0 if isinstance(channel_indexes, int) else slice(None), local_rows, column_key]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:, :, :]
+        return data if dtype is None else data.astype(dtype)
+
+    def to_dask(self, chunks=None):
+        """
+        Returns a dask array reading from this one, chunk by chunk.
+        :param chunks: dask chunk specification. If equal to None, self.chunks.
+        """
+        import dask.array
+        return dask.array.from_array(self, chunks=chunks or self.chunks, asarray=False, fancy=False,
+                                     name='exr-' + uuid.uuid4().hex)
+
+    def close(self):
+        with self.__lock:
+            if self.__exr_file is not None:
+                self.__exr_file.close()
+                self.__exr_file = None
+
+    def __open(self):
+        if self.__exr_file is None:
+            self.__exr_file = _open_exr(self.input_exr)
+        return self.__exr_file
+
+    def __normalize(self, key):
+        # Expands the key to one integer or slice per axis.
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(item is Ellipsis for item in key):
+            position = key.index(Ellipsis)
+            key = key[:position] + (slice(None),) * (self.ndim - len(key) + 1) + key[position + 1:]
+        if len(key) > self.ndim:
+            raise IndexError("too many indices for a " + str(self.ndim) + "-dimensional ExrArray")
+        key = key + (slice(None),) * (self.ndim - len(key))
+        for item in key:
+            if not isinstance(item, (slice, int, numpy.integer)):
+                raise IndexError("ExrArray only supports integers, slices and Ellipsis as indices")
+        return tuple(int(item) if isinstance(item, numpy.integer) else item for item in key)
+
+    def __getstate__(self):
+        # The open file and the lock cannot be pickled. They are created again on the other side.
+        state = self.__dict__.copy()
+        state['_ExrArray__exr_file'] = None
+        state['_ExrArray__lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return "ExrArray(" + str(self.input_exr)[:80] + ", shape=" + str(self.shape) + ", dtype=" + str(self.dtype) + ")"
+
+
+def stack(input_exrs, channels=None, output_pixel_type=None, chunks=None):
+    """
+    Stacks EXR files of the same size into a lazy dask array of shape (files, channels, height, width), so that
+    reductions over many files (e.g. dask.array.median(cube, axis=0)) run out of core, chunk by chunk. Requires dask.
+    :param input_exrs: list of paths (strings) of EXR files.
+    :param channels: channels to include from each file. See ExrArray.
+    :param output_pixel_type: See ExrArray.
+    :param chunks: dask chunk shape of each file. If equal to None, the natural chunks of the first file.
+    :return: a dask.array.Array.
+    :example: stack(sorted(glob.glob("/path/to/archive/*.exr")), channels=[0]).mean(axis=0).compute()
+    """
+    import dask.array
+    arrays = [ExrArray(input_exr, channels, output_pixel_type) for input_exr in input_exrs]
+    if len(arrays) == 0:
+        raise Exception("No EXR files to stack")
+    chunks = chunks or arrays[0].chunks
+    return dask.array.stack([array.to_dask(chunks) for array in arrays])
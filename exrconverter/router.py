@@ -0,0 +1,91 @@
+"""
+Converts a file between any two of the supported formats (EXR, FITS and TIFF), choosing the format of both files from
+their extensions, along the cheapest route: pairs with an EXR file go through the converter of the pair, and FITS and
+TIFF files are converted into each other directly through exrconverter.image, without an EXR file in between.
+Converters are only imported when a route needs them, since astropy, OpenEXR and SimpleITK take a while to import.
+"""
+import importlib
+import numpy
+from .stats import instrumented
+
+# Format of the files with each extension.
+EXTENSIONS = {'exr': 'exr', 'fits': 'fits', 'fit': 'fits', 'tiff': 'tiff', 'tif': 'tiff'}
+
+FORMATS = ['exr', 'fits', 'tiff']
+
+# Module of the convert function of every (input format, output format) pair. Other pairs of FITS and TIFF files use
+# convert_image.
+ROUTES = {('fits', 'exr'): 'fits2exr', ('exr', 'fits'): 'exr2fits', ('tiff', 'exr'): 'tiff2exr',
+          ('exr', 'tiff'): 'exr2tiff'}
+
+
+@instrumented
+def convert_image(input_path, output_path, output_pixel_type=None, verbose=True, stats=None):
+    """
+    Converts a FITS or TIFF file into a FITS or TIFF file through an exrconverter.image.Image, one layer at a time. The
+    headers of the HDUs become the headers of the pages, and back (see exrconverter.image.to_tiff_header).
+    :param input_path: path (string) of the input FITS or TIFF file.
+    :param output_path: path (string) of the output FITS or TIFF file.
+    :param output_pixel_type: If equal to None, the output file image will have the same pixel type as the input file
+                              image. Otherwise, one of the fields of the class exrconverter.pixeltype.PixelType, or the
+                              equivalent numpy dtype.
+    :param verbose: Boolean variable for deciding whether to print warning messages.
+    :param stats: optional exrconverter.stats.ConversionStats object, filled in with the time and bytes of the read,
+                  convert, headers and write stages of the conversion.
+    :return: False if the input file has no images, and nothing was written.
+    :example: convert_image("/path/to/input.fits", "/path/to/output.tif")
+    """
+    from . import image
+    with image.read(input_path) as source:
+        stats.add_pixels(source.shape[0] * source.shape[1] * source.shape[2])
+        return image.write(source, output_path, output_pixel_type, verbose, stats)
+
+
+def get_format(path):
+    """
+    Returns the format of a file ('exr', 'fits' or 'tiff') from its extension.
+    """
+    extension = path.rsplit('.', 1)[-1].lower() if '.' in path else ''
+    if extension not in EXTENSIONS:
+        raise Exception("Unsupported file extension of " + path + ". Options are " + ", ".join(sorted(EXTENSIONS)))
+    return EXTENSIONS[extension]
+
+
+def get_route(input_format, output_format):
+    """
+    Returns the convert function from input_format to output_format ('exr', 'fits' or 'tiff'), importing its module.
+    """
+    if (input_format, output_format) in ROUTES:
+        return importlib.import_module('.' + ROUTES[(input_format, output_format)], __package__).convert
+    if input_format in FORMATS and output_format in FORMATS and 'exr' not in (input_format, output_format):
+        return convert_image
+    raise Exception("Unsupported conversion from " + input_format + " to " + output_format)
+
+
+def preload(formats=None):
+    """
+    Imports the converters of all the routes between formats (all the FORMATS if None), e.g. in a long running worker,
+    so that conversions do not pay for importing them.
+    """
+    formats = FORMATS if formats is None else formats
+    for (input_format, output_format), module_name in ROUTES.items():
+        if input_format in formats and output_format in formats:
+            importlib.import_module('.' + module_name, __package__)
+    if 'fits' in formats or 'tiff' in formats:
+        importlib.import_module('.image', __package__)
+
+
+def convert(input_path, output_path, **options):
+    """
+    Converts a file into another format, as given by the extensions of both paths (see EXTENSIONS).
+    :param input_path: path (string) of the input file.
+    :param output_path: path (string) of the output file.
+    :param options: keyword arguments of the convert function of the route (see get_route), such as compression for
+                    FITS or TIFF to EXR, or output_pixel_type, verbose and stats for any of them. The pixel type can
+                    also be given by name, e.g. output_pixel_type='float16', as in command lines and worker jobs.
+    :example: convert("/path/to/input.fits", "/path/to/output.tif", output_pixel_type=numpy.float32)
+    """
+    if isinstance(options.get('output_pixel_type'), str):
+        options['output_pixel_type'] = numpy.dtype(options['output_pixel_type']).type
+    route = get_route(get_format(input_path), get_format(output_path))
+    return route(input_path, output_path, **options)
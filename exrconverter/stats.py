@@ -0,0 +1,212 @@
+import functools
+import inspect
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Stages reported by the convert functions.
+STAGES = ['read', 'convert', 'headers', 'write']
+
+# tracemalloc is process-wide, so it is started by the first ConversionStats tracing memory, and stopped by the last
+# one, however many conversions trace it at once (e.g. in a pool of threads).
+_tracing = {'count': 0, 'started': False, 'lock': threading.Lock()}
+
+
+def _start_tracing():
+    with _tracing['lock']:
+        if _tracing['count'] == 0:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _tracing['started'] = True
+            elif hasattr(tracemalloc, 'reset_peak'):  # python 3.9 or later
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.stop()
+                tracemalloc.start()
+        _tracing['count'] += 1
+
+
+def _stop_tracing():
+    # Returns the peak traced memory since tracing started, or since the peak was last reset.
+    with _tracing['lock']:
+        peak = tracemalloc.get_traced_memory()[1]
+        _tracing['count'] -= 1
+        if _tracing['count'] == 0 and _tracing['started']:
+            tracemalloc.stop()
+            _tracing['started'] = False
+        return peak
+
+
+def _get_max_rss():
+    # High-water mark of the resident memory of the process. ru_maxrss is in kilobytes on Linux, in bytes on macOS.
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class Stage(object):
+    """
+    Context manager that times one occurrence of a stage. Bytes processed within it are reported through add().
+    """
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.bytes = 0
+        self.start = None
+
+    def add(self, nbytes):
+        self.bytes += nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stats.record(self.name, time.perf_counter() - self.start, self.bytes)
+        return False
+
+
+class ConversionStats(object):
+    """
+    Wall time and bytes of each stage of a conversion ('read', 'convert', 'headers' and 'write'), plus the number of
+    pixels converted and the peak memory. Pass an instance as the stats argument of any convert function to fill it in.
+    When channels are converted by several threads, the time of a stage adds up the time spent in it by every thread.
+    Memory is reported by:
+    - peak_traced_bytes: with trace_memory, the peak memory allocated through python and numpy during the conversion.
+      Conversions running at the same time in other threads of the process are traced together, and count towards it.
+    - peak_rss_bytes: the high-water mark of the resident memory of the whole process at the end of the conversion,
+      which includes the imports and any earlier, larger conversion of the same process.
+    - rss_growth_bytes: how much the conversion raised that high-water mark. It is the memory a conversion added on top
+      of everything before it, and 0 when it stayed below an earlier peak, so it is a lower bound of its own peak.
+    The RSS figures are None on platforms without the resource module (Windows).
+    :param trace_memory: If True, the peak memory allocated through python and numpy during the conversion is traced
+                         with tracemalloc (which slows the conversion down). Allocations made inside OpenEXR,
+                         SimpleITK or cfitsio are not seen by tracemalloc.
+    :param callback: optional function called as callback(stage, seconds, nbytes) at the end of each stage.
+    :example: stats = ConversionStats(); fits2exr.convert("in.fits", "out.exr", stats=stats); print(stats.to_dict())
+    """
+
+    def __init__(self, trace_memory=False, callback=None):
+        self.trace_memory = trace_memory
+        self.callback = callback
+        self.stages = OrderedDict((name, {'seconds': 0.0, 'bytes': 0, 'calls': 0}) for name in STAGES)
+        self.pixels = 0
+        self.files = 0
+        self.elapsed = 0.0
+        self.peak_traced_bytes = None
+        self.peak_rss_bytes = None
+        self.rss_growth_bytes = None
+        self.__start = None
+        self.__start_rss = None
+        self.__lock = threading.Lock()
+
+    def stage(self, name):
+        """
+        Returns a context manager that times a stage: with stats.stage('read') as stage: ...; stage.add(nbytes)
+        """
+        return Stage(self, name)
+
+    def record(self, name, seconds, nbytes=0):
+        with self.__lock:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'bytes': 0, 'calls': 0})
+            stage['seconds'] += seconds
+            stage['bytes'] += nbytes
+            stage['calls'] += 1
+        if self.callback is not None:
+            self.callback(name, seconds, nbytes)
+
+    def add_pixels(self, pixels):
+        self.pixels += int(pixels)
+
+    def start(self):
+        """
+        Called by the convert functions when the conversion starts.
+        """
+        self.__start = time.perf_counter()
+        self.__start_rss = _get_max_rss()
+        if self.trace_memory:
+            _start_tracing()
+
+    def finish(self):
+        """
+        Called by the convert functions when the conversion ends, even if it failed.
+        """
+        self.elapsed += time.perf_counter() - self.__start
+        self.files += 1
+        if self.trace_memory:
+            self.peak_traced_bytes = max(self.peak_traced_bytes or 0, _stop_tracing())
+        max_rss = _get_max_rss()
+        if max_rss is not None:
+            self.peak_rss_bytes = max(self.peak_rss_bytes or 0, max_rss)
+            self.rss_growth_bytes = max(self.rss_growth_bytes or 0, max_rss - self.__start_rss)
+
+    def merge(self, other):
+        """
+        Adds the figures of another ConversionStats object to this one. Peaks are combined with max.
+        """
+        for name, other_stage in other.stages.items():
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'bytes': 0, 'calls': 0})
+            for key in stage:
+                stage[key] += other_stage[key]
+        self.pixels += other.pixels
+        self.files += other.files
+        self.elapsed += other.elapsed
+        for peak in ('peak_traced_bytes', 'peak_rss_bytes', 'rss_growth_bytes'):
+            if getattr(other, peak) is not None:
+                setattr(self, peak, max(getattr(self, peak) or 0, getattr(other, peak)))
+        return self
+
+    def to_dict(self):
+        """
+        Returns the statistics as a plain dictionary, e.g. to be exported as JSON to a metrics system.
+        """
+        return {'files': self.files, 'pixels': self.pixels, 'seconds': self.elapsed,
+                'stages': dict((name, dict(stage)) for name, stage in self.stages.items()),
+                'peak_traced_bytes': self.peak_traced_bytes, 'peak_rss_bytes': self.peak_rss_bytes,
+                'rss_growth_bytes': self.rss_growth_bytes}
+
+    def __getstate__(self):
+        # The callback is usually a closure, which cannot be sent back from a worker process. Locks cannot either.
+        state = self.__dict__.copy()
+        state['callback'] = None
+        del state['_ConversionStats__lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        stages = ", ".join("%s=%.3fs" % (name, stage['seconds']) for name, stage in self.stages.items())
+        return "ConversionStats(files=%d, pixels=%d, %.3fs: %s)" % (self.files, self.pixels, self.elapsed, stages)
+
+
+def instrumented(convert_function):
+    """
+    Decorator for the convert functions. It makes sure that the stats argument of the conversion is a ConversionStats
+    object (a throwaway one if the caller passed None), and starts and finishes it around the conversion.
+    """
+    signature = inspect.signature(convert_function)
+
+    @functools.wraps(convert_function)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs)
+        stats = arguments.arguments.get('stats')
+        if stats is None:
+            stats = arguments.arguments['stats'] = ConversionStats()
+        stats.start()
+        try:
+            return convert_function(*arguments.args, **arguments.kwargs)
+        finally:
+            stats.finish()
+
+    return wrapper
@@ -1,19 +1,27 @@
-import SimpleITK as sitk
-import numpy
 import OpenEXR
 import Imath
+import io
 import json
-import warnings
-import os
-from .utils import __get_pixeltype_from_channel, __get_exrpixel_from_channel, __change_array_type, __get_channel_from_pixeltype, __TIFF_HEADERS_ID, __get_pixeltype_from_tiff
-from .pixeltype import PixelType
+from .utils import __change_array_type, __get_channel_from_pixeltype, __TIFF_HEADERS_ID, __CHANNEL_STATS_ID, \
+    __get_pixeltype_from_tiff, __write_tiled, __write_scanlines, __is_path, __get_pixeltype_from_dtype, __new_buffer, \
+    __set_threads, __map
+from . import batch, tiffpages
+from .compression import COMPRESSION_OPTIONS, choose_compression
+from .stats import instrumented
+from .verification import ChannelStats, encode_channel_stats
     
-def convert_directory(path, compression=None, output_pixel_type=None, verbose=True):
+def convert_directory(path, compression=None, output_pixel_type=None, verbose=True, workers=1, pool='process',
+                      tile_size=None, levels=None, compression_goal='lossless', incremental=False, checksum=False,
+                      shard_index=0, shard_count=1, claim_run=None, backend=None, threads=None, channel_stats=False,
+                      trace_memory=False):
     """
     Converts directory of TIFF files to EXR.
     :param path: path of the directory.
     :param compression: If equal to None, the output file will have ZIP_COMPRESSION (this is the exr default). 
                         Options are 'NONE', 'RLE', 'ZIPS', 'ZIPS', 'PIZ', 'PXR24', 'B44'. 'B44A', 'DWAA', or 'DWAB'.
+                        If equal to 'auto', the codec is picked according to compression_goal by benchmarking all of
+                        them on a strip of the image (see exrconverter.compression.choose_compression).
+    :param compression_goal: 'fastest', 'smallest' or 'lossless'. Only used when compression is 'auto'.
     :param output_pixel_type: If equal to None, the output file image will have the same pixel type or format
                               of that in the input file image. If changing the pixel type is desired, then
                               output_pixel_type can take the values defined by the fields in the class
@@ -21,30 +29,57 @@ def convert_directory(path, compression=None, output_pixel_type=None, verbose=Tr
                               Since the underlying implementation uses numpy arrays, output_pixel_type can also take
                               numpy dtypes values, For example, output_pixel_type=numpy.float32.
     :param verbose: Boolean variable for deciding whether to print warning messages.
+    :param tile_size: If not None, the output files are tiled. See convert.
+    :param levels: None, 'mipmap' or 'ripmap'. See convert.
+    :param backend: None, 'tifffile' or 'sitk'. See convert.
+    :param threads: If not None, number of threads converting the pages of every file. See convert.
+    :param channel_stats: If True, a checksum and statistics of every channel are stored in the files. See convert.
+    :param workers: number of files converted simultaneously. If equal to 1, files are converted one at a time.
+    :param pool: 'process' to convert in a pool of processes, or 'thread' to convert in a pool of threads.
+    :param incremental: If True, a manifest of the converted files is kept in the directory (see
+                        exrconverter.batch.Manifest), files whose output is up to date are skipped, and outputs are
+                        written atomically through a temporary file. Reruns then only convert new, changed or
+                        previously failed files.
+    :param checksum: If True, in incremental mode, inputs with a new modification time are only converted again if
+                     their content changed.
+    :param shard_index: index, from 0 to shard_count - 1, of the part of the directory converted by this call.
+    :param shard_count: If greater than 1, the directory is split into shard_count parts of about the same total size,
+                        the same on every node, and only the part shard_index is converted. Run one call per shard,
+                        e.g. one per node of an array job (see exrconverter.batch.shard).
+    :param claim_run: If not None, a name shared by all the shards of the run, such as the array job id. Files are
+                      then claimed before being converted, and once its shard is done a call goes on with files of the
+                      other shards that nobody claimed yet, so that no file is converted twice. Files that failed
+                      are released for a retry. Remove the claims of a finished run with
+                      exrconverter.batch.clear_claims.
+    :param trace_memory: If True, the peak memory allocated by every conversion is traced with tracemalloc (see
+                         exrconverter.stats.ConversionStats).
+    :return: an exrconverter.batch.BatchResult object with the successes, failures, timings and
+             ConversionStats of every file (aggregated in BatchResult.stats).
     :example: convert_directory(path='path/to/tif', output_pixel_type=numpy.float32, verbose=True)
     """
-    
-    for filename in os.listdir(path):
-        if filename[-4:] == 'tiff':
-            output_filename = path + '/' + filename[:-5] + ".exr"
-        elif filename[-3:] == 'tif':
-            output_filename = path + '/' + filename[:-4] + ".exr"
-        else:
-            continue
-        
-        if verbose:
-            print ("Converting: " + filename)
-         
-        convert(path + '/' + filename, output_filename, compression, output_pixel_type, verbose)
+    options = dict(compression=compression, output_pixel_type=output_pixel_type, verbose=verbose,
+                   tile_size=tile_size, levels=levels, compression_goal=compression_goal, backend=backend,
+                   threads=threads, channel_stats=channel_stats)
+    return batch.convert_directory(convert, path, ['tiff', 'tif'], 'exr', options, workers=workers, pool=pool,
+                                   verbose=verbose, incremental=incremental, checksum=checksum,
+                                   shard_index=shard_index, shard_count=shard_count, claim_run=claim_run,
+                                   trace_memory=trace_memory)
 
-def convert(input_tiff, output_exr, compression=None, output_pixel_type=None, verbose=True):
+@instrumented
+def convert(input_tiff, output_exr, compression=None, output_pixel_type=None, verbose=True, tile_size=None,
+            levels=None, compression_goal='lossless', backend=None, threads=None, channel_stats=False, stats=None):
     """
     Converts an input Tiff file into a EXR file. Multiple layers in the input Tiff file are created as multiple layers in the output EXR file. The pixels in the output image file can also be set to a different type as that of
     the pixels in the input image file.
     :param input_tiff: path (string) of the input TIFF file.
-    :param output_exr: path (string) to the output EXR file.
+    :param output_exr: path (string) to the output EXR file, or binary file-like object (with write, seek and tell)
+                       to write it to, such as io.BytesIO. File-like outputs require the OpenEXR python bindings
+                       version 3 or later.
     :param compression: If equal to None, the output file will have ZIP_COMPRESSION (this is the exr default). 
                         Options are 'NONE', 'RLE', 'ZIPS', 'ZIPS', 'PIZ', 'PXR24', 'B44'. 'B44A', 'DWAA', or 'DWAB'.
+                        If equal to 'auto', the codec is picked according to compression_goal by benchmarking all of
+                        them on a strip of the image (see exrconverter.compression.choose_compression).
+    :param compression_goal: 'fastest', 'smallest' or 'lossless'. Only used when compression is 'auto'.
     :param output_pixel_type: If equal to None, the output file image will have the same pixel type or format
                               of that in the input file image. If changing the pixel type is desired, then
                               output_pixel_type can take the values defined by the fields in the class
@@ -52,14 +87,80 @@ def convert(input_tiff, output_exr, compression=None, output_pixel_type=None, ve
                               Since the underlying implementation uses numpy arrays, output_pixel_type can also take
                               numpy dtypes values, For example, output_pixel_type=numpy.float32.
     :param verbose: Boolean variable for deciding whether to print warning messages.
+    :param tile_size: If not None, the output EXR file is tiled instead of made of scanlines, so that random access
+                      readers only decode the tiles they need. Either the tile width and height in pixels, as an
+                      integer, or a (width, height) tuple. Requires the OpenEXR python bindings version 3 or later.
+    :param levels: If equal to 'mipmap' or 'ripmap', reduced resolution levels of the image are written as additional
+                   tiled parts of the EXR file, for zoomed out previews (see utils.__write_tiled). Implies tiles,
+                   64x64 by default.
+    :param backend: 'tifffile' to read the TIFF file page by page (see exrconverter.tiffpages), so that a multi-page
+                    stack is converted with about one page in memory when writing scanlines to a path, or 'sitk' to
+                    read the whole image with SimpleITK. If None, tifffile is used when it is installed.
+    :param threads: If not None, the number of threads of the OpenEXR thread pool, which is process-wide, and of the
+                    EXR file, so that blocks of scanlines are compressed in parallel. The pages are also decoded (with
+                    the tifffile backend) and converted by that many threads.
+    :param channel_stats: If True, the CRC-32 checksum of every channel, and the min, max, NaN, inf and float16
+                          overflow counts of its source pixels, are stored in the channel_stats attribute of the EXR
+                          header (see exrconverter.verification), for verify to check the file against. The header is
+                          written before the pixels, so when the tifffile backend writes a path in blocks of rows the
+                          pages are read twice.
+    :param stats: optional exrconverter.stats.ConversionStats object, filled in with the time and bytes of the read,
+                  convert, headers and write stages of the conversion.
     :example: convert(input_tiff="/path/to/input_tiff.tiff", output_exr="/path/to/output_exr.exr",
                       output_pixel_type=numpy.float32, verbose=True)
     """
-    reader = sitk.ImageFileReader()
-    reader.SetImageIO("TIFFImageIO")
-    reader.SetFileName(input_tiff)
-    tiff_image = reader.Execute()
-    tiff_image_array = sitk.GetArrayFromImage(tiff_image)
+    __set_threads(threads)
+    if tiffpages.get_backend(backend) == 'tifffile':
+        __convert_pages(input_tiff, output_exr, compression, output_pixel_type, verbose, tile_size, levels,
+                        compression_goal, threads, channel_stats, stats)
+        return
+
+    import SimpleITK as sitk  # only imported by the backend that uses it
+    with stats.stage('read'):
+        reader = sitk.ImageFileReader()
+        reader.SetImageIO("TIFFImageIO")
+        reader.SetFileName(input_tiff)
+        tiff_image = reader.Execute()
+
+    __convert_image(tiff_image, output_exr, compression, output_pixel_type, verbose, tile_size, levels,
+                    compression_goal, threads, channel_stats, stats)
+
+
+@instrumented
+def from_image(tiff_image, compression=None, output_pixel_type=None, verbose=True, tile_size=None, levels=None,
+               compression_goal='lossless', threads=None, channel_stats=False, stats=None):
+    """
+    Converts a 3D SimpleITK image, such as a multi-page TIFF already in memory, into the bytes of an EXR file, without
+    going through the disk. Every page becomes a layer, and the image metadata is kept as in convert. Requires the
+    OpenEXR python bindings version 3 or later.
+    :param tiff_image: SimpleITK.Image object, e.g. built with SimpleITK.GetImageFromArray from a (pages, rows,
+                       columns) numpy array.
+    :param compression: See convert.
+    :param output_pixel_type: See convert.
+    :param verbose: Boolean variable for deciding whether to print warning messages.
+    :param tile_size: See convert.
+    :param levels: See convert.
+    :param compression_goal: See convert.
+    :param threads: See convert.
+    :param channel_stats: See convert.
+    :param stats: optional exrconverter.stats.ConversionStats object. See convert.
+    :return: the EXR file as bytes.
+    :example: exr_bytes = from_image(sitk.GetImageFromArray(stack), compression='PIZ')
+    """
+    __set_threads(threads)
+    output_exr = io.BytesIO()
+    __convert_image(tiff_image, output_exr, compression, output_pixel_type, verbose, tile_size, levels,
+                    compression_goal, threads, channel_stats, stats)
+    return output_exr.getvalue()
+
+
+def __convert_image(tiff_image, output_exr, compression, output_pixel_type, verbose, tile_size, levels,
+                    compression_goal, threads, channel_stats, stats):
+    import SimpleITK as sitk
+    # A view of the image buffer (which stays alive during the whole conversion) instead of a copy.
+    with stats.stage('read') as stage:
+        tiff_image_array = sitk.GetArrayViewFromImage(tiff_image)
+        stage.add(tiff_image_array.nbytes)
     
     if not output_pixel_type:
         output_pixel_type = __get_pixeltype_from_tiff(tiff_image.GetPixelIDTypeAsString())
@@ -70,41 +171,157 @@ def convert(input_tiff, output_exr, compression=None, output_pixel_type=None, ve
     exr_header = OpenEXR.Header(image_array_shape[0], image_array_shape[1])
     # exr_header['compression'] = Imath.Compression(Imath.Compression.PIZ_COMPRESSION)
 
-    compression_options = {'NO' : Imath.Compression.NO_COMPRESSION, 'RLE' : Imath.Compression.RLE_COMPRESSION, 'ZIPS' : Imath.Compression.ZIPS_COMPRESSION,
-                            'ZIP' : Imath.Compression.ZIP_COMPRESSION, 'PIZ' : Imath.Compression.PIZ_COMPRESSION, 'PXR24' : Imath.Compression.PXR24_COMPRESSION,
-                            'B44' : Imath.Compression.B44_COMPRESSION, 'B44A' : Imath.Compression.B44A_COMPRESSION,'DWAA' : Imath.Compression.DWAA_COMPRESSION, 
-                            'DWAB' : Imath.Compression.DWAB_COMPRESSION
-                            }
     
+    if compression == 'auto':
+        compression = choose_compression(dict((str(channel), tiff_image_array[channel])
+                                              for channel in range(tiff_image.GetDepth())),
+                                         compression_goal, pixel_type=output_pixel_type)
+        if verbose:
+            print ("Selected compression: " + compression)
+
     if compression:
-        exr_header['compression'] = Imath.Compression(compression_options[compression])
+        exr_header['compression'] = Imath.Compression(COMPRESSION_OPTIONS[compression])
 
     exr_header['channels'] = {}
     exr_data = {}
     tiff_headers = []
+    page_stats = [ChannelStats() for channel in range(tiff_image.GetDepth())] if channel_stats else None
     
-    meta_data = {}
-    for key in tiff_image.GetMetaDataKeys():
-        meta_data[key] = tiff_image.GetMetaData(key)
-    tiff_headers.append(meta_data)
-    
-    for channel in range(tiff_image.GetDepth()):
-        exr_data[str(channel)] = __change_array_type(tiff_image_array[channel], output_pixel_type)
-        exr_header['channels'][str(channel)] = __get_channel_from_pixeltype(output_pixel_type)
-        
+    with stats.stage('headers'):
         meta_data = {}
-        for key in tiff_image[:,:,channel].GetMetaDataKeys():
-            meta_data[key] = tiff_image[:,:,channel].GetMetaData(key)
+        for key in tiff_image.GetMetaDataKeys():
+            meta_data[key] = tiff_image.GetMetaData(key)
         tiff_headers.append(meta_data)
+    
+    def convert_page(channel):
+        with stats.stage('convert') as stage:
+            page_data = __change_array_type(tiff_image_array[channel], output_pixel_type)
+            stage.add(page_data.nbytes)
+        if page_stats is not None:
+            with stats.stage('headers'):
+                page_stats[channel].update(tiff_image_array[channel], page_data)
+        return page_data
+
+    for channel, page_data in enumerate(__map(convert_page, range(tiff_image.GetDepth()), threads)):
+        exr_data[str(channel)] = page_data
+        exr_header['channels'][str(channel)] = __get_channel_from_pixeltype(output_pixel_type)
         
-    exr_header[__TIFF_HEADERS_ID] = str.encode(json.dumps(tiff_headers))
+        # Slices of a SimpleITK image carry no metadata, so pages are not sliced (and copied) to read it.
+        tiff_headers.append({})
+    stats.add_pixels(image_array_shape[0] * image_array_shape[1] * tiff_image.GetDepth())
+
+    with stats.stage('headers') as stage:
+        attributes = {__TIFF_HEADERS_ID: json.dumps(tiff_headers)}
+        if page_stats is not None:
+            attributes[__CHANNEL_STATS_ID] = encode_channel_stats(page_stats)
+        stage.add(sum(len(value) for value in attributes.values()))
+
+    if tile_size is not None or levels is not None or not __is_path(output_exr):
+        with stats.stage('write') as stage:
+            if tile_size is not None or levels is not None:
+                __write_tiled(output_exr, exr_data, attributes, compression, tile_size, levels, threads)
+            else:
+                __write_scanlines(output_exr, exr_data, attributes, compression, threads)
+            stage.add(sum(data.nbytes for data in exr_data.values()))
+        return
+
+    for key, value in attributes.items():
+        exr_header[key] = str.encode(value)
     
     try:
         
-        exr_file = OpenEXR.OutputFile(output_exr, exr_header)
-        exr_file.writePixels(exr_data)
+        with stats.stage('write') as stage:
+            exr_file = OpenEXR.OutputFile(output_exr, exr_header)
+            exr_file.writePixels(exr_data)
+            stage.add(sum(data.nbytes for data in exr_data.values()))
 
     finally:
         exr_file.close()
 
-        
\ No newline at end of file
+
+def __convert_pages(input_tiff, output_exr, compression, output_pixel_type, verbose, tile_size, levels,
+                    compression_goal, threads, channel_stats, stats):
+    with stats.stage('read'):
+        reader = tiffpages.PageReader(input_tiff)
+
+    try:
+        pages, height, width = reader.shape
+        if not output_pixel_type:
+            output_pixel_type = __get_pixeltype_from_dtype(reader.dtype)
+
+        exr_header = OpenEXR.Header(width, height)
+
+        if compression == 'auto':
+            compression = choose_compression(dict((str(page), reader.page(page)) for page in range(pages)),
+                                             compression_goal, pixel_type=output_pixel_type)
+            if verbose:
+                print ("Selected compression: " + compression)
+
+        if compression:
+            exr_header['compression'] = Imath.Compression(COMPRESSION_OPTIONS[compression])
+
+        exr_header['channels'] = dict((str(page), __get_channel_from_pixeltype(output_pixel_type))
+                                      for page in range(pages))
+        stats.add_pixels(width * height * pages)
+
+        with stats.stage('headers') as stage:
+            attributes = {__TIFF_HEADERS_ID: json.dumps(reader.headers)}
+            stage.add(len(attributes[__TIFF_HEADERS_ID]))
+        page_stats = [ChannelStats() for page in range(pages)] if channel_stats else None
+
+        def convert_rows(page, first_row, last_row, out=None):
+            # Updates the ChannelStats of the page too, if any, so rows must be converted in order.
+            with stats.stage('read') as stage:
+                rows = reader.read_rows(page, first_row, last_row)
+                stage.add(rows.nbytes)
+            with stats.stage('convert') as stage:
+                converted = __change_array_type(rows, output_pixel_type, out=out)
+                stage.add(converted.nbytes)
+            if page_stats is not None:
+                with stats.stage('headers'):
+                    page_stats[page].update(rows, converted)
+            return converted
+
+        if tile_size is not None or levels is not None or not __is_path(output_exr):
+            exr_data = dict((str(page), page_data) for page, page_data in enumerate(
+                __map(lambda page: convert_rows(page, 0, height), range(pages), threads)))
+            if page_stats is not None:
+                attributes[__CHANNEL_STATS_ID] = encode_channel_stats(page_stats)
+
+            with stats.stage('write') as stage:
+                if tile_size is not None or levels is not None:
+                    __write_tiled(output_exr, exr_data, attributes, compression, tile_size, levels, threads)
+                else:
+                    __write_scanlines(output_exr, exr_data, attributes, compression, threads)
+                stage.add(sum(data.nbytes for data in exr_data.values()))
+            return
+
+        # Scanlines hold the rows of every page, so the pages are read in blocks of rows, about one page at a time.
+        block_size = max(1, height // max(pages, 1))
+        buffers = [__new_buffer((min(block_size, height), width), output_pixel_type) for page in range(pages)]
+
+        if page_stats is not None:
+            # The statistics go in the header, which is written before the first block: a first pass computes them.
+            for first_row in range(0, height, block_size):
+                last_row = min(first_row + block_size, height)
+                __map(lambda page: convert_rows(page, first_row, last_row, buffers[page][:last_row - first_row]),
+                      range(pages), threads)
+            attributes[__CHANNEL_STATS_ID] = encode_channel_stats(page_stats)
+
+        for key, value in attributes.items():
+            exr_header[key] = str.encode(value)
+
+        exr_file = OpenEXR.OutputFile(output_exr, exr_header)
+        try:
+            for first_row in range(0, height, block_size):
+                last_row = min(first_row + block_size, height)
+                exr_data = dict((str(page), block) for page, block in enumerate(
+                    __map(lambda page: convert_rows(page, first_row, last_row, buffers[page][:last_row - first_row]),
+                          range(pages), threads)))
+                with stats.stage('write') as stage:
+                    exr_file.writePixels(exr_data, last_row - first_row)
+                    stage.add(sum(data.nbytes for data in exr_data.values()))
+        finally:
+            exr_file.close()
+    finally:
+        reader.close()
@@ -0,0 +1,216 @@
+"""
+Page streaming TIFF backend of tiff2exr and exr2tiff, built on the tifffile package. Unlike SimpleITK, which decodes a
+whole multi-page TIFF into one image and copies it again into numpy, pages are read and written one at a time, and
+the metadata is read from the TIFF tags without decoding any pixel. Uncompressed pages are memory-mapped.
+"""
+import json
+import threading
+import numpy
+
+try:
+    import tifffile
+except ImportError:  # optional, see the 'tifffile' extra in setup.py
+    tifffile = None
+
+BACKENDS = ['tifffile', 'sitk']
+
+# ASCII TIFF tags kept as metadata (the tiff_headers of the EXR files).
+TEXT_TAGS = ['ImageDescription', 'DocumentName', 'PageName', 'Make', 'Model', 'Software', 'DateTime', 'Artist',
+             'HostComputer', 'Copyright']
+
+
+def get_backend(backend=None):
+    """
+    Returns the TIFF backend to use: 'tifffile' (this module) or 'sitk' (SimpleITK). If backend is None, tifffile is
+    used when it is installed.
+    """
+    if backend is None:
+        return 'tifffile' if tifffile is not None else 'sitk'
+    if backend not in BACKENDS:
+        raise Exception("Unsupported TIFF backend " + str(backend) + ". Options are " + ", ".join(BACKENDS))
+    if backend == 'tifffile' and tifffile is None:
+        raise Exception("The tifffile package is required by the tifffile TIFF backend")
+    return backend
+
+
+class PageReader(object):
+    """
+    Reads the pages of a TIFF file one at a time, or a block of rows of a page at a time. Uncompressed pages are
+    memory-mapped, compressed ones are decoded one strip at a time, and only the strips of the last rows read from
+    every page are kept. Pages must be single sample (grayscale) images of the same size and type. Different pages
+    can be read by different threads at once.
+    :param path: path (string) of the TIFF file.
+    :example: with PageReader("/path/to/stack.tif") as reader: first_rows = reader.read_rows(0, 0, 16)
+    """
+
+    def __init__(self, path):
+        get_backend('tifffile')
+        self.path = path
+        self.__tiff = tifffile.TiffFile(path)
+        self.__strips = {}
+        self.__lock = threading.Lock()
+
+        pages = self.__tiff.pages
+        first = pages.first
+        if first.samplesperpixel != 1 or len(first.shape) != 2:
+            self.close()
+            raise Exception("Only single sample TIFF pages are supported, " + path + " has pages of shape " +
+                            str(first.shape))
+        self.shape = (len(pages), first.shape[0], first.shape[1])
+        self.dtype = first.dtype
+
+        # Every page keeps all of its tags (tiff_headers[1:]), so that a page without a tag of the others stays without
+        # it, and the tags that all the pages share are the image metadata (tiff_headers[0]).
+        page_tags = [self.__read_tags(pages[index]) for index in range(self.shape[0])]
+        self.headers = [dict((key, value) for key, value in page_tags[0].items()
+                             if all(tags.get(key) == value for tags in page_tags[1:]))] + page_tags
+
+    def page(self, index):
+        """
+        Returns a Page view of a page, which reads rows when it is sliced.
+        """
+        return Page(self, index)
+
+    def read_page(self, index):
+        return self.read_rows(index, 0, self.shape[1])
+
+    def read_rows(self, index, first_row, last_row):
+        """
+        Returns rows first_row to last_row - 1 of a page, as a read-only memory-mapped array if the page is not
+        compressed.
+        """
+        with self.__lock:  # pages are loaded lazily, through the shared file handle
+            page = self.__tiff.pages[index]
+        if page.shape != self.shape[1:] or page.dtype != self.dtype:
+            raise Exception("Page " + str(index) + " of " + self.path + " differs in shape or type from the first one")
+
+        if page.is_memmappable:
+            # A new map per call, so that the pages already converted are unmapped and do not count towards RSS.
+            mapped = numpy.memmap(self.path, dtype=page.dtype.newbyteorder(self.__tiff.byteorder), mode='r',
+                                  offset=page.dataoffsets[0], shape=page.shape)
+            return mapped[first_row:last_row]
+
+        cached = self.__strips.get(index)
+        if cached is None or not cached[0] <= first_row or last_row > cached[0] + cached[1].shape[0]:
+            cached = self.__strips[index] = self.__decode(page, first_row, last_row)
+        return cached[1][first_row - cached[0]:last_row - cached[0]]
+
+    def close(self):
+        self.__strips = {}
+        self.__tiff.close()
+
+    def __decode(self, page, first_row, last_row):
+        # Returns the first row and the rows of the strips that cover first_row to last_row - 1.
+        if page.is_tiled:
+            with self.__lock:
+                return 0, page.asarray()
+
+        rows_per_strip = page.rowsperstrip
+        first_strip = first_row // rows_per_strip
+        last_strip = (last_row - 1) // rows_per_strip + 1
+        filehandle = self.__tiff.filehandle
+        strips = []
+        for strip_index in range(first_strip, last_strip):
+            with self.__lock:  # the pages share a file handle, but are decompressed in parallel
+                filehandle.seek(page.dataoffsets[strip_index])
+                data = filehandle.read(page.databytecounts[strip_index])
+            strips.append(page.decode(data, strip_index)[0].reshape(-1, page.shape[1]))
+        return first_strip * rows_per_strip, numpy.concatenate(strips)[:page.shape[0] - first_strip * rows_per_strip]
+
+    @staticmethod
+    def __read_tags(page):
+        tags = {}
+        for name in TEXT_TAGS:
+            tag = page.tags.get(name)
+            if tag is not None:
+                tags[name] = tag.value if isinstance(tag.value, str) else tag.value.decode('latin-1')
+        return _remove_shape(tags)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+
+class Page(object):
+    """
+    View of a page of a PageReader. Slicing its rows, e.g. page[first_row:last_row], reads them.
+    """
+
+    def __init__(self, reader, index):
+        self.reader = reader
+        self.index = index
+        self.shape = reader.shape[1:]
+        self.dtype = reader.dtype
+
+    def __getitem__(self, key):
+        rows = key[0] if isinstance(key, tuple) else key
+        first_row, last_row, step = rows.indices(self.shape[0])
+        data = self.reader.read_rows(self.index, first_row, max(first_row, last_row))[::step]
+        return data[(slice(None),) + key[1:]] if isinstance(key, tuple) else data
+
+
+class PageWriter(object):
+    """
+    Writes a multi-page TIFF file one page at a time. Pages are written uncompressed, each one as soon as write is
+    called, and the file switches to BigTIFF when it would exceed 4 GB.
+    :param path: path (string) of the TIFF file.
+    :param shape: (pages, rows, columns) of the image.
+    :param dtype: numpy dtype of the pages.
+    :param header: optional dictionary of metadata written in every page. Keys that are TEXT_TAGS are written as tags,
+                   others are ignored.
+    :example: with PageWriter("/path/to/stack.tif", (2, 512, 512), numpy.float32) as writer: writer.write(page)
+    """
+
+    def __init__(self, path, shape, dtype, header=None):
+        get_backend('tifffile')
+        self.path = path
+        self.header = header or {}
+        bigtiff = shape[0] * shape[1] * shape[2] * numpy.dtype(dtype).itemsize > 2 ** 32 - 2 ** 25
+        self.__writer = tifffile.TiffWriter(path, bigtiff=bigtiff)
+
+    def write(self, page, header=None):
+        """
+        Appends a page to the file.
+        :param page: 2D numpy array.
+        :param header: optional dictionary of page metadata, added to the header of the writer.
+        """
+        tags = dict(self.header)
+        tags.update(header or {})
+        tags = _remove_shape(tags)
+        extratags = [(tifffile.TIFF.TAGS[name], 's', 0, tags[name], True) for name in TEXT_TAGS
+                     if name in tags and name not in ('ImageDescription', 'Software', 'DateTime')]
+        self.__writer.write(page, photometric='minisblack', metadata=None, description=tags.get('ImageDescription'),
+                            software=tags.get('Software', False), datetime=tags.get('DateTime'),
+                            extratags=extratags)
+
+    def close(self):
+        self.__writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+
+def _remove_shape(tags):
+    # tifffile records the shape of the arrays it writes in a JSON ImageDescription (a "shaped" series), which no longer
+    # matches once pages are cut out or left out, and makes tifffile warn. The shape is removed, and so is the
+    # description if nothing else is left in it.
+    try:
+        description = json.loads(tags.get('ImageDescription', ''))
+    except ValueError:
+        return tags
+    if not isinstance(description, dict) or 'shape' not in description:
+        return tags
+    tags = dict(tags)
+    del description['shape']
+    if description:
+        tags['ImageDescription'] = json.dumps(description)
+    else:
+        del tags['ImageDescription']
+    return tags
@@ -1,3 +1,9 @@
+import base64
+import concurrent.futures
+import io
+import json
+import os
+import zlib
 import numpy
 import Imath
 import OpenEXR
@@ -5,6 +11,10 @@ from .pixeltype import PixelType
 
 __FITS_HEADERS_ID = "fits_headers"
 __TIFF_HEADERS_ID = "tiff_headers"
+__FITS_PLANES_ID = "fits_planes"
+__FITS_CARDS_ID = "fits_cards"
+__FITS_HEADER_INDEX_ID = "fits_header_index"
+__CHANNEL_STATS_ID = "channel_stats"
 
 
 def __get_pixeltype_from_bitpix(bitpix):
@@ -22,25 +32,46 @@ def __get_pixeltype_from_bitpix(bitpix):
         raise Exception("Unsupported bitpix value " + str(bitpix))
 
 
-def __change_array_type(array, pixel_type):
-    if pixel_type == PixelType.FLOAT64:
-        return numpy.float32(array)
-    if pixel_type == PixelType.FLOAT32:
-        return numpy.float32(array)
-    elif pixel_type == PixelType.FLOAT16:
-        return numpy.float16(array)
-    elif pixel_type == PixelType.INT32:
-        return numpy.int32(array)
-    elif pixel_type == PixelType.INT16:
-        return numpy.int16(array)
-    elif pixel_type == PixelType.INT8:
-        return numpy.int8(array)
-    elif pixel_type == PixelType.UINT16:
-        return numpy.uint16(array)
+def __get_dtype_from_pixeltype(pixel_type, byteorder='='):
+    if pixel_type in (PixelType.FLOAT16, PixelType.FLOAT32, PixelType.FLOAT64, PixelType.INT8, PixelType.INT16,
+                      PixelType.INT32, PixelType.UINT16):
+        return numpy.dtype(pixel_type).newbyteorder(byteorder)
     else:
         raise Exception("Unsupported pixel_format value " + str(pixel_type))
 
 
+def __new_buffer(shape, pixel_type, byteorder='='):
+    """
+    Allocates an uninitialized array that can be reused as the out argument of __change_array_type.
+    """
+    return numpy.empty(shape, dtype=__get_dtype_from_pixeltype(pixel_type, byteorder))
+
+
+def __change_array_type(array, pixel_type, out=None, byteorder='='):
+    """
+    Converts an array to the given pixel type. The cast and the byte swap (e.g. from big-endian FITS data) are done in
+    a single pass, and no copy at all is made when the array already has the requested type, byte order and a
+    C-contiguous layout.
+    :param array: numpy array.
+    :param pixel_type: one of the fields of exrconverter.pixeltype.PixelType, or the equivalent numpy dtype.
+    :param out: optional preallocated array (see __new_buffer) of the same shape as array. If given, the converted
+                pixels are written into it and it is returned, so that buffers can be reused across blocks.
+    :param byteorder: byte order of the result, '=' for native (as required by OpenEXR) or '>' for big-endian
+                      (as stored in FITS files). Ignored if out is given.
+    :return: the converted array, which might be array itself.
+    """
+    dtype = __get_dtype_from_pixeltype(pixel_type, byteorder)
+    if out is None:
+        if array.dtype == dtype and array.flags['C_CONTIGUOUS']:
+            return array
+        return numpy.ascontiguousarray(array, dtype=dtype)
+    if out.shape != array.shape or out.dtype.newbyteorder('=') != dtype.newbyteorder('='):
+        raise Exception("Output buffer of type " + str(out.dtype) + " and shape " + str(out.shape) +
+                        " does not match " + str(dtype) + " and shape " + str(array.shape))
+    numpy.copyto(out, array, casting='unsafe')
+    return out
+
+
 def __get_channel_from_pixeltype(pixel_type):
     if pixel_type == PixelType.FLOAT32:
         return Imath.Channel(Imath.PixelType(OpenEXR.FLOAT))
@@ -68,6 +99,258 @@ def __get_exrpixel_from_channel(channel_type):
         raise Exception("Unsupported channel type " + str(channel_type))
 
 
+def __get_channel_names(exr_header, channels=None):
+    """
+    Returns the names of the channels of an EXR file, in layer order.
+    :param exr_header: header of the EXR file.
+    :param channels: optional list of channel names or layer indexes. If given, only these channels are returned, in
+                     the given order.
+    """
+    if channels is None:
+        return sorted(exr_header['channels'].keys(), key=lambda x: float(x))
+
+    channel_names = []
+    for channel in channels:
+        if str(channel) not in exr_header['channels']:
+            raise Exception("Channel " + str(channel) + " not found in the EXR file")
+        channel_names.append(str(channel))
+    return channel_names
+
+
+def __get_window(exr_header, window=None):
+    """
+    Validates a region of interest (x0, y0, x1, y1) of an EXR file. Coordinates are relative to the corner of the data
+    window and follow the numpy slicing convention, so the region covers columns x0 to x1 - 1 and rows y0 to y1 - 1.
+    If window is None, the whole data window is returned.
+    """
+    dw = exr_header['dataWindow']
+    width, height = dw.max.x - dw.min.x + 1, dw.max.y - dw.min.y + 1
+    if window is None:
+        return 0, 0, width, height
+
+    x0, y0, x1, y1 = window
+    if not (0 <= x0 < x1 <= width and 0 <= y0 < y1 <= height):
+        raise Exception("Window " + str(window) + " is outside the " + str(width) + "x" + str(height) + " image")
+    return x0, y0, x1, y1
+
+
+def __read_channel(exr_file, exr_header, channel_name, first_row, last_row, first_column=0, last_column=None):
+    """
+    Reads a channel of an EXR file, decoding only the scanlines from first_row to last_row - 1 (relative to the data
+    window). The returned array is read-only, and it is a non-contiguous view when the columns are cropped.
+    """
+    dw = exr_header['dataWindow']
+    channel_type = exr_header['channels'][channel_name]
+    byte_image = exr_file.channel(channel_name, __get_exrpixel_from_channel(channel_type), dw.min.y + first_row,
+                                  dw.min.y + last_row - 1)
+    data = numpy.frombuffer(byte_image, dtype=__get_pixeltype_from_channel(channel_type))
+    data.shape = (last_row - first_row, dw.max.x - dw.min.x + 1)
+    if first_column != 0 or last_column is not None:
+        data = data[:, first_column:last_column]
+    return data
+
+
+def __is_path(value):
+    return isinstance(value, (str, os.PathLike))
+
+
+def __encode_fits_headers(headers):
+    """
+    Compact encoding of FITS headers, as EXR attributes. Cards shared by several headers (e.g. by all the HDUs of a
+    file) are stored once, in a table of 80 character cards compressed with zlib and encoded in base64 (fits_cards),
+    since EXR string attributes end at the first null byte. Every header is then the list of the [first, last + 1]
+    ranges of the indexes of its cards in the table (fits_header_index), so headers can be rebuilt one at a time.
+    :param headers: list of FITS headers as strings of 80 character cards (see astropy.io.fits.Header.tostring). The
+                    blank cards that pad headers after the END card are left out.
+    :return: dictionary from attribute name to value.
+    """
+    card_indexes = {}
+    cards = []
+    header_index = []
+    for header in headers:
+        end = len(header.rstrip(' '))
+        ranges = []
+        for position in range(0, end, 80):
+            card = header[position:position + 80].ljust(80)
+            if card not in card_indexes:
+                card_indexes[card] = len(cards)
+                cards.append(card)
+            card_index = card_indexes[card]
+            if ranges and ranges[-1][1] == card_index:
+                ranges[-1][1] += 1
+            else:
+                ranges.append([card_index, card_index + 1])
+        header_index.append(ranges)
+    return {__FITS_CARDS_ID: base64.b64encode(zlib.compress(''.join(cards).encode('ascii'), 9)).decode('ascii'),
+            __FITS_HEADER_INDEX_ID: json.dumps(header_index, separators=(',', ':'))}
+
+
+def __decode_fits_headers(exr_header, header_indexes=None):
+    """
+    Returns the FITS headers embedded in an EXR file, as strings of 80 character cards: the compact encoding of
+    __encode_fits_headers, or the fits_headers JSON list of older files. None if the file has no FITS headers.
+    :param header_indexes: If not None, only the headers of these indexes are rebuilt, and the others are None.
+    """
+    if exr_header.get(__FITS_CARDS_ID) is not None:
+        cards = zlib.decompress(base64.b64decode(exr_header[__FITS_CARDS_ID])).decode('ascii')
+        return [None if header_indexes is not None and index not in header_indexes
+                else ''.join(cards[first * 80:last * 80] for first, last in ranges)
+                for index, ranges in enumerate(json.loads(exr_header[__FITS_HEADER_INDEX_ID]))]
+    if exr_header.get(__FITS_HEADERS_ID) is not None:
+        return json.loads(exr_header[__FITS_HEADERS_ID])
+    return None
+
+
+def __get_fits_header_indexes(exr_header):
+    """
+    Returns a dictionary from the name of every channel of an EXR file converted from FITS to the index of its FITS
+    header: the channel index itself, unless the file has fits_planes (cubes), which gives it.
+    """
+    if exr_header.get(__FITS_PLANES_ID) is not None:
+        return dict((str(channel_index), header_index) for channel_index, (header_index, plane)
+                    in enumerate(json.loads(exr_header[__FITS_PLANES_ID])))
+    return dict((name, int(name)) for name in exr_header['channels'] if name.isdigit())
+
+
+def __open_exr(input_exr):
+    """
+    Opens an EXR file for reading with OpenEXR.InputFile, which reads paths and binary file-like objects alike.
+    :param input_exr: path (string), binary file-like object (with read, seek and tell), or bytes of the EXR file.
+    """
+    if isinstance(input_exr, (bytes, bytearray, memoryview)):
+        input_exr = io.BytesIO(input_exr)
+    return OpenEXR.InputFile(input_exr)
+
+
+def __write_scanlines(output_exr, exr_data, attributes, compression=None, threads=None):
+    """
+    Writes 2D arrays as the channels of a scanline EXR file to a binary file-like object (with write, seek and tell),
+    such as io.BytesIO. OpenEXR.OutputFile only writes to paths, so this goes through the OpenEXR.File interface of
+    the OpenEXR >= 3 bindings, as __write_tiled does.
+    :param output_exr: binary file-like object, or path (string), of the output EXR file.
+    :param exr_data: dictionary from channel name to 2D numpy array of type float16 or float32.
+    :param attributes: dictionary of extra string attributes for the header, e.g. the FITS headers.
+    :param compression: compression name, as in the compression_options of fits2exr and tiff2exr.
+    :param threads: optional number of threads encoding the file.
+    """
+    if not hasattr(OpenEXR, 'File'):
+        raise Exception("EXR output to file-like objects requires the OpenEXR python bindings version 3 or later")
+
+    header = {'type': OpenEXR.scanlineimage}
+    if compression:
+        header['compression'] = getattr(OpenEXR, compression + '_COMPRESSION')
+    header.update(attributes)
+    OpenEXR.File(header, dict(exr_data), **__get_file_options(threads)).write(output_exr)
+
+
+def __write_tiled(output_exr, exr_data, attributes, compression=None, tile_size=None, levels=None, threads=None):
+    """
+    Writes 2D arrays as the channels of a tiled EXR file. The OutputFile interface of the python bindings can only
+    write scanline files, so this goes through the OpenEXR.File interface of the OpenEXR >= 3 bindings. These cannot
+    write the reduced levels of a multi-level part either, so mip-map or rip-map levels are written as additional
+    tiled parts, named 'level_<x>_<y>', holding the image averaged over boxes of 2^x by 2^y pixels (rounding sizes
+    down, as OpenEXR does). Part 0 always holds the full resolution image, which is what single-part readers such as
+    OpenEXR.InputFile see.
+    :param output_exr: path (string) to the output EXR file.
+    :param exr_data: dictionary from channel name to 2D numpy array of type float16 or float32.
+    :param attributes: dictionary of extra string attributes for the header, e.g. the FITS headers.
+    :param compression: compression name, as in the compression_options of fits2exr and tiff2exr.
+    :param tile_size: tile width and height in pixels, either as a single integer or as a (width, height) tuple.
+                      If equal to None, 64x64 tiles are used.
+    :param levels: None for a single level, 'mipmap' or 'ripmap'.
+    :param threads: optional number of threads encoding the file.
+    """
+    if not hasattr(OpenEXR, 'File'):
+        raise Exception("Tiled EXR output requires the OpenEXR python bindings version 3 or later")
+    if levels not in (None, 'mipmap', 'ripmap'):
+        raise Exception("Unsupported levels value " + str(levels))
+
+    if tile_size is None:
+        tile_size = 64
+    if isinstance(tile_size, int):
+        tile_size = (tile_size, tile_size)
+
+    tiles = OpenEXR.TileDescription()
+    tiles.xSize, tiles.ySize = tile_size
+    tiles.mode = OpenEXR.ONE_LEVEL
+    tiles.roundingMode = OpenEXR.ROUND_DOWN
+
+    height, width = next(iter(exr_data.values())).shape
+    header = {'type': OpenEXR.tiledimage, 'tiles': tiles,
+              'displayWindow': (numpy.array([0, 0], dtype=numpy.int32),
+                                numpy.array([width - 1, height - 1], dtype=numpy.int32))}
+    if compression:
+        header['compression'] = getattr(OpenEXR, compression + '_COMPRESSION')
+
+    if levels is None:
+        header.update(attributes)
+        OpenEXR.File(header, dict(exr_data), **__get_file_options(threads)).write(output_exr)
+        return
+
+    x_levels = int(numpy.log2(width)) + 1
+    y_levels = int(numpy.log2(height)) + 1
+    if levels == 'mipmap':
+        level_indexes = [(level, level) for level in range(max(x_levels, y_levels))]
+    else:
+        level_indexes = [(x, y) for y in range(y_levels) for x in range(x_levels)]
+
+    parts = []
+    level_data = {(0, 0): exr_data}
+    for x, y in level_indexes:
+        if (x, y) not in level_data:
+            # Each level is reduced from a level that is already computed, halving one axis or both.
+            previous = (max(x - 1, 0), max(y - 1, 0)) if levels == 'mipmap' else ((x - 1, y) if x > 0 else (x, y - 1))
+            level_data[(x, y)] = dict((name, __reduce_level(data, x > previous[0], y > previous[1]))
+                                      for name, data in level_data[previous].items())
+        part_header = dict(header)
+        if (x, y) == (0, 0):
+            part_header.update(attributes)
+        # OpenEXR.Part replaces the arrays of the dictionary it is given by Channel objects, hence the copy.
+        parts.append(OpenEXR.Part(part_header, dict(level_data[(x, y)]), "level_" + str(x) + "_" + str(y)))
+
+    OpenEXR.File(parts, **__get_file_options(threads)).write(output_exr)
+
+
+def __get_file_options(threads):
+    # Keyword arguments of OpenEXR.File, whose num_threads defaults to the size of the global thread pool.
+    return {} if threads is None else {'num_threads': threads}
+
+
+def __set_threads(threads):
+    """
+    Sets the size of the process-wide thread pool of OpenEXR, which OpenEXR.InputFile and OpenEXR.OutputFile use to
+    decode and encode blocks of scanlines in parallel. Nothing is changed if threads is None, or with OpenEXR python
+    bindings older than version 3.
+    """
+    if threads is not None and hasattr(OpenEXR, 'set_global_thread_count'):
+        OpenEXR.set_global_thread_count(threads)
+
+
+def __map(function, items, threads=None):
+    """
+    Returns [function(item) for item in items], computed by a pool of threads if threads is greater than 1. The
+    channels of a file are converted this way, since numpy casts and byte swaps, file reads and the OpenEXR, cfitsio
+    and zlib codecs release the GIL.
+    """
+    items = list(items)
+    if threads is None or threads <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(threads, len(items))) as executor:
+        return list(executor.map(function, items))
+
+
+def __reduce_level(data, reduce_x, reduce_y):
+    # Averages boxes of 2x2, 2x1 or 1x2 pixels, dropping the last row or column of odd sizes (ROUND_DOWN).
+    reduced = data.astype(numpy.float32)
+    if reduce_x and reduced.shape[1] > 1:
+        width = reduced.shape[1] // 2 * 2
+        reduced = (reduced[:, 0:width:2] + reduced[:, 1:width:2]) / 2
+    if reduce_y and reduced.shape[0] > 1:
+        height = reduced.shape[0] // 2 * 2
+        reduced = (reduced[0:height:2, :] + reduced[1:height:2, :]) / 2
+    return numpy.ascontiguousarray(reduced, dtype=data.dtype)
+
+
 def __get_bitpix_from_channel(channel_type):
     if channel_type == Imath.Channel(Imath.PixelType(OpenEXR.FLOAT)):
         return -32
@@ -83,4 +366,13 @@ def __get_pixeltype_from_tiff(pixel_type):
     elif pixel_type == '64-bit float':
         return PixelType.FLOAT64
     else:
-        raise Exception("Unsupported pixel value " + str(pixel_type))
\ No newline at end of file
+        raise Exception("Unsupported pixel value " + str(pixel_type))
+
+def __get_pixeltype_from_dtype(dtype):
+    # Same types as __get_pixeltype_from_tiff, for pages read with tifffile.
+    if dtype == numpy.float32:
+        return PixelType.FLOAT32
+    elif dtype == numpy.float64:
+        return PixelType.FLOAT64
+    else:
+        raise Exception("Unsupported pixel value " + str(dtype))
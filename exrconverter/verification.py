@@ -0,0 +1,167 @@
+"""
+Per-channel checksums and summary statistics, which fits2exr and tiff2exr store in the EXR header with
+channel_stats=True, and verification of converted files against them, or against their source file, one block of
+rows at a time, so that neither image is ever held in memory as a whole.
+"""
+import json
+import math
+import zlib
+import numpy
+from .utils import __CHANNEL_STATS_ID, __open_exr, __read_channel, __get_channel_names, __get_window,\
+    __get_pixeltype_from_channel
+
+# Magnitude from which values round to inf in float16: its largest value, 65504, plus half a unit in the last place.
+FLOAT16_OVERFLOW = 65520.0
+
+
+class ChannelStats(object):
+    """
+    Checksum and summary statistics of a channel, accumulated one block of rows at a time, in row order. The checksum
+    is the CRC-32 of the pixels as stored in the EXR file (in little-endian byte order), so it changes if the file is
+    corrupted or decoded differently, or if a lossy codec altered the pixels. The statistics are those of the source
+    pixels: the min and max of the finite values, the NaN and inf counts, and the float16_overflow count of the finite
+    values too large for float16, which become inf when converted to FLOAT16.
+    """
+
+    def __init__(self):
+        self.crc32 = 0
+        self.min = None
+        self.max = None
+        self.nan = 0
+        self.inf = 0
+        self.float16_overflow = 0
+
+    def update(self, source, stored=None):
+        """
+        Adds a block of rows.
+        :param source: the rows of the source image.
+        :param stored: the same rows, as stored in the EXR file. If None, the source rows.
+        """
+        stored = source if stored is None else stored
+        self.crc32 = zlib.crc32(numpy.ascontiguousarray(stored, dtype=stored.dtype.newbyteorder('<')), self.crc32)
+
+        finite = source
+        if source.dtype.kind == 'f':
+            nan = numpy.isnan(source)
+            inf = numpy.isinf(source)
+            self.nan += int(numpy.count_nonzero(nan))
+            self.inf += int(numpy.count_nonzero(inf))
+            finite = source[~(nan | inf)]
+        if finite.size > 0:
+            block_min, block_max = finite.min().item(), finite.max().item()
+            self.min = block_min if self.min is None else min(self.min, block_min)
+            self.max = block_max if self.max is None else max(self.max, block_max)
+            if block_min <= -FLOAT16_OVERFLOW or block_max >= FLOAT16_OVERFLOW:
+                self.float16_overflow += int(numpy.count_nonzero(numpy.abs(finite.astype(numpy.float64)) >=
+                                                                 FLOAT16_OVERFLOW))
+
+    def to_dict(self):
+        return {'crc32': self.crc32, 'min': self.min, 'max': self.max, 'nan': self.nan, 'inf': self.inf,
+                'float16_overflow': self.float16_overflow}
+
+
+def encode_channel_stats(channel_stats):
+    """
+    Returns the channel_stats EXR attribute of a list of ChannelStats objects, one per channel in layer order.
+    """
+    return json.dumps(dict((str(channel), stats.to_dict()) for channel, stats in enumerate(channel_stats)),
+                      separators=(',', ':'))
+
+
+def read_channel_stats(input_exr):
+    """
+    Returns the checksums and statistics stored in an EXR file, as a dictionary from channel name to the to_dict() of
+    its ChannelStats, without decoding any pixel. Empty if the file was written without channel_stats.
+    :param input_exr: path (string), binary file-like object or bytes of the EXR file.
+    """
+    exr_file = __open_exr(input_exr)
+    try:
+        exr_header = exr_file.header()
+    finally:
+        exr_file.close()
+    if exr_header.get(__CHANNEL_STATS_ID) is None:
+        return {}
+    return json.loads(exr_header[__CHANNEL_STATS_ID])
+
+
+def verify(output_exr, source=None, tolerance=None, block_size=256):
+    """
+    Verifies a converted EXR file, one block of rows of every channel at a time. The checksum of every channel is
+    computed again and compared to the one stored in the file, if any. If the source file is given, the channels are
+    also compared to its layers (the HDUs or pages, in the order fits2exr and tiff2exr convert them), and the maximum
+    and RMS quantization errors of the finite pixels are reported, e.g. after a FLOAT16 conversion. The HDUs of a FITS
+    source are selected as fits2exr does for the pixel type of the EXR file, so that HDUs it skipped are skipped too.
+    :param output_exr: path (string), binary file-like object or bytes of the EXR file.
+    :param source: optional path of the FITS or TIFF file the EXR file was converted from, or an
+                   exrconverter.image.Image.
+    :param tolerance: If not None, the largest absolute error allowed. Channels whose error is larger, or whose NaN
+                      and inf pixels do not match those of the source (e.g. float16 overflows), do not match.
+    :param block_size: number of rows read at a time.
+    :return: a dictionary with 'match', True if every check passed, and 'channels', a dictionary from channel name to
+             its 'match', 'checksum' (True, False, or None when no checksum is stored), 'stored' statistics and
+             recomputed 'stats' (of the EXR pixels), and with a source, its 'max_error', 'rms_error' and
+             'nonfinite_mismatch' count.
+    :example: report = verify("/path/to/output.exr", source="/path/to/input.fits", tolerance=1e-3)
+    """
+    exr_file = __open_exr(output_exr)
+    exr_header = exr_file.header()
+    stored_stats = {}
+    if exr_header.get(__CHANNEL_STATS_ID) is not None:
+        stored_stats = json.loads(exr_header[__CHANNEL_STATS_ID])
+    channel_names = __get_channel_names(exr_header)
+    x0, y0, x1, y1 = __get_window(exr_header)
+
+    source_image = source
+    if isinstance(source, str):
+        from . import image
+        if image.get_format(source) == 'fits' and channel_names:
+            pixel_type = __get_pixeltype_from_channel(exr_header['channels'][channel_names[0]])
+            source_image = image.read_fits(source, pixel_type)
+        else:
+            source_image = image.read(source)
+
+    try:
+        if source_image is not None and source_image.shape != (len(channel_names), y1 - y0, x1 - x0):
+            raise Exception("Source of shape " + str(source_image.shape) + " for an EXR file of shape " +
+                            str((len(channel_names), y1 - y0, x1 - x0)))
+
+        report = {'match': True, 'channels': {}}
+        for layer, channel_name in enumerate(channel_names):
+            channel_stats = ChannelStats()
+            max_error = squared_error = 0.0
+            compared = nonfinite_mismatch = 0
+            for first_row in range(y0, y1, block_size):
+                last_row = min(first_row + block_size, y1)
+                exr_rows = __read_channel(exr_file, exr_header, channel_name, first_row, last_row)
+                channel_stats.update(exr_rows)
+                if source_image is None:
+                    continue
+
+                source_rows = numpy.asarray(source_image.layers[layer][first_row - y0:last_row - y0])
+                exr_rows = exr_rows.astype(numpy.float64)
+                source_rows = source_rows.astype(numpy.float64)
+                finite = numpy.isfinite(exr_rows) & numpy.isfinite(source_rows)
+                same = (exr_rows == source_rows) | (numpy.isnan(exr_rows) & numpy.isnan(source_rows))
+                nonfinite_mismatch += int(numpy.count_nonzero(~finite & ~same))
+                errors = numpy.abs(exr_rows[finite] - source_rows[finite])
+                if errors.size > 0:
+                    max_error = max(max_error, errors.max().item())
+                    squared_error += numpy.dot(errors, errors).item()
+                    compared += errors.size
+
+            channel = {'stats': channel_stats.to_dict(), 'stored': stored_stats.get(channel_name), 'checksum': None}
+            if channel['stored'] is not None:
+                channel['checksum'] = channel['stored']['crc32'] == channel_stats.crc32
+            channel['match'] = channel['checksum'] is not False
+            if source_image is not None:
+                channel.update({'max_error': max_error, 'rms_error': math.sqrt(squared_error / max(compared, 1)),
+                                'nonfinite_mismatch': nonfinite_mismatch})
+                if tolerance is not None:
+                    channel['match'] = channel['match'] and max_error <= tolerance and nonfinite_mismatch == 0
+            report['channels'][channel_name] = channel
+            report['match'] = report['match'] and channel['match']
+        return report
+    finally:
+        exr_file.close()
+        if isinstance(source, str):
+            source_image.close()
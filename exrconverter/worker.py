@@ -0,0 +1,232 @@
+"""
+Long running conversion worker. It keeps the converters, and astropy, OpenEXR and SimpleITK, loaded, so that a small
+file costs its conversion rather than the start up of an interpreter and the imports. Jobs are JSON files in a spool
+directory, written by submit (or by any program, as long as they are renamed into incoming once complete):
+
+    <spool>/incoming/<job id>.json  {"id": ..., "input": ..., "output": ..., "options": {...}}
+    <spool>/running/<job id>.json   jobs claimed by a worker, which renames them out of incoming (only one worker wins)
+    <spool>/done/<job id>.json      the job and its result (time, ConversionStats) once converted
+    <spool>/failed/<job id>.json    the job and its error if it failed
+
+Jobs are converted by exrconverter.router.convert, with the options of the job as keyword arguments. Several workers,
+on one or several nodes sharing the filesystem, can serve the same spool directory.
+"""
+import json
+import os
+import socket
+import time
+import traceback
+import uuid
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from . import batch, router
+
+__POOL_TYPES = {'process': ProcessPoolExecutor, 'thread': ThreadPoolExecutor}
+
+SPOOL_DIRECTORIES = ['incoming', 'running', 'done', 'failed']
+
+
+def submit(spool_path, input_path, output_path, **options):
+    """
+    Submits a conversion job to a spool directory, which is created if needed.
+    :param spool_path: path of the spool directory.
+    :param input_path: path of the input file. Relative paths are made absolute, since the worker runs elsewhere.
+    :param output_path: path of the output file.
+    :param options: keyword arguments of exrconverter.router.convert. They must be JSON serializable, so pixel types
+                    are given by name, e.g. output_pixel_type='float16'.
+    :return: the id of the job, see get_result.
+    :example: job_id = submit("/path/to/spool", "frame.fits", "frame.exr", compression='ZIP')
+    """
+    __make_spool(spool_path)
+    job_id = uuid.uuid4().hex
+    job = {'id': job_id, 'input': os.path.abspath(input_path), 'output': os.path.abspath(output_path),
+           'options': options, 'submitted': time.time()}
+    __write_json(os.path.join(spool_path, 'incoming', job_id + '.json'), job)
+    return job_id
+
+
+def get_result(spool_path, job_id, timeout=None, poll_interval=0.1):
+    """
+    Waits for a job to be converted.
+    :param timeout: If not None, the number of seconds to wait for.
+    :return: the job, with its 'status' ('done' or 'failed'), 'error', 'elapsed' time and 'stats', or None if it was
+             not converted within timeout seconds.
+    """
+    start = time.time()
+    while True:
+        for status in ('done', 'failed'):
+            path = os.path.join(spool_path, status, job_id + '.json')
+            if os.path.exists(path):
+                with open(path) as result_file:
+                    return json.load(result_file)
+        if timeout is not None and time.time() - start >= timeout:
+            return None
+        time.sleep(poll_interval)
+
+
+def run_job(job):
+    """
+    Converts a job, capturing any error, and returns the job with its result (see get_result).
+    """
+    result = batch.convert_file(router.convert, job['input'], job['output'], kwargs=job.get('options') or {},
+                                atomic=True)
+    job = dict(job)
+    job.update({'status': 'done' if result.succeeded else 'failed', 'error': result.error,
+                'traceback': result.error_traceback, 'elapsed': result.elapsed,
+                'stats': result.stats.to_dict() if result.stats is not None else None,
+                'host': socket.gethostname(), 'pid': os.getpid(), 'finished': time.time()})
+    return job
+
+
+def serve(spool_path, workers=1, pool='process', formats=None, poll_interval=0.2, max_jobs=None, idle_timeout=None,
+          verbose=True):
+    """
+    Converts the jobs submitted to a spool directory as they come, oldest first, until it is interrupted.
+    :param spool_path: path of the spool directory, which is created if needed.
+    :param workers: number of jobs converted simultaneously. If equal to 1, jobs are converted one at a time in the
+                    calling process.
+    :param pool: 'process' for a pool of processes, or 'thread' for a pool of threads. See exrconverter.batch.run.
+    :param formats: formats whose converters are imported up front (see exrconverter.router.preload), all of them if
+                    None.
+    :param poll_interval: seconds between two looks at the spool directory while there is nothing to do.
+    :param max_jobs: If not None, the worker stops after converting this many jobs.
+    :param idle_timeout: If not None, the worker stops once no job was submitted for this many seconds.
+    :param verbose: Boolean variable for deciding whether to print progress and warning messages.
+    :return: the number of jobs converted, successfully or not.
+    :example: serve("/path/to/spool", workers=8)
+    """
+    if pool not in __POOL_TYPES:
+        raise Exception("Unsupported pool type " + str(pool))
+    __make_spool(spool_path)
+    router.preload(formats)
+    executor = None
+    if workers is not None and workers > 1:
+        # Forked worker processes inherit the loaded converters, and spawned ones import them once.
+        executor = __POOL_TYPES[pool](max_workers=workers, initializer=router.preload, initargs=(formats,))
+
+    pending = {}
+    converted = 0
+    last_job = time.time()
+    try:
+        while max_jobs is None or converted < max_jobs:
+            capacity = max(workers or 1, 1) - len(pending)
+            if max_jobs is not None:
+                capacity = min(capacity, max_jobs - converted - len(pending))
+            jobs = __claim_jobs(spool_path, capacity)
+            for job in jobs:
+                last_job = time.time()
+                if verbose:
+                    print ("Converting: " + os.path.basename(job['input']))
+                if executor is None:
+                    __finish(spool_path, run_job(job), verbose)
+                    converted += 1
+                else:
+                    pending[executor.submit(run_job, job)] = job
+
+            if pending:
+                finished, not_finished = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job = pending.pop(future)
+                    try:
+                        job = future.result()
+                    except Exception as e:  # e.g. a worker process that died
+                        job = dict(job, status='failed', error=repr(e), traceback=traceback.format_exc())
+                    __finish(spool_path, job, verbose)
+                    converted += 1
+            elif idle_timeout is not None and time.time() - last_job >= idle_timeout:
+                break
+            elif not jobs:
+                time.sleep(poll_interval)
+    finally:
+        # Jobs that were claimed but not converted go back to the spool, for the next worker.
+        for future, job in pending.items():
+            if future.cancel():
+                requeue(spool_path, [job['id']])
+        if executor is not None:
+            executor.shutdown(wait=True)
+        for future, job in pending.items():
+            if not future.cancelled():
+                try:
+                    __finish(spool_path, future.result(), verbose)
+                except Exception as e:
+                    __finish(spool_path, dict(job, status='failed', error=repr(e)), verbose)
+    return converted
+
+
+def requeue(spool_path, job_ids=None):
+    """
+    Moves running jobs back to incoming, e.g. those of a worker that was killed. Only call it for the jobs of workers
+    that are no longer running.
+    :param job_ids: ids of the jobs to requeue, or None for all the running jobs.
+    :return: the ids of the requeued jobs.
+    """
+    requeued = []
+    running_path = os.path.join(spool_path, 'running')
+    for filename in sorted(os.listdir(running_path)):
+        job_id = filename[:-len('.json')]
+        if not filename.endswith('.json') or (job_ids is not None and job_id not in job_ids):
+            continue
+        try:
+            os.rename(os.path.join(running_path, filename), os.path.join(spool_path, 'incoming', filename))
+        except FileNotFoundError:  # finished in the meantime
+            continue
+        requeued.append(job_id)
+    return requeued
+
+
+def __claim_jobs(spool_path, count):
+    # Claims up to count of the oldest incoming jobs. Hidden files are jobs still being written.
+    incoming_path = os.path.join(spool_path, 'incoming')
+    if count <= 0:
+        return []
+    entries = []
+    for entry in os.scandir(incoming_path):
+        if entry.name.endswith('.json') and not entry.name.startswith('.'):
+            try:
+                entries.append((entry.stat().st_mtime, entry.name))
+            except FileNotFoundError:  # claimed by another worker
+                continue
+
+    jobs = []
+    for mtime, filename in sorted(entries):
+        running_path = os.path.join(spool_path, 'running', filename)
+        try:
+            os.rename(os.path.join(incoming_path, filename), running_path)
+        except FileNotFoundError:  # claimed by another worker
+            continue
+        try:
+            with open(running_path) as job_file:
+                job = json.load(job_file)
+            job['id'] = filename[:-len('.json')]
+            if 'input' not in job or 'output' not in job:
+                raise Exception("Job without input or output")
+        except Exception as e:
+            job = {'id': filename[:-len('.json')], 'status': 'failed', 'error': "Invalid job file: " + repr(e)}
+            __finish(spool_path, job, True)
+            continue
+        jobs.append(job)
+        if len(jobs) == count:
+            break
+    return jobs
+
+
+def __finish(spool_path, job, verbose):
+    __write_json(os.path.join(spool_path, job['status'], job['id'] + '.json'), job)
+    running_path = os.path.join(spool_path, 'running', job['id'] + '.json')
+    if os.path.exists(running_path):
+        os.remove(running_path)
+    if verbose and job['status'] == 'failed':
+        warnings.warn("Failed to convert job " + job['id'] + ": " + str(job.get('error')))
+
+
+def __make_spool(spool_path):
+    for directory in SPOOL_DIRECTORIES:
+        os.makedirs(os.path.join(spool_path, directory), exist_ok=True)
+
+
+def __write_json(path, data):
+    # Written to a hidden temporary file and renamed, so that readers never see a partial file.
+    temporary_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.' + uuid.uuid4().hex[:12])
+    with open(temporary_path, 'w') as json_file:
+        json.dump(data, json_file, default=str)
+    os.replace(temporary_path, path)
@@ -13,8 +13,10 @@ setup(
     include_package_data = True,
     keywords=["package", "setup"],
     scripts=[],
+    entry_points={'console_scripts': ['exrconvert = exrconverter.cli:main']},
     license='Apache 2.0',
     install_requires=['numpy'],
+    extras_require={'dask': ['dask[array]'], 'tifffile': ['tifffile']},
     classifiers = [
                    "Intended Audience :: Developers",
                    "Operating System :: OS Independent",
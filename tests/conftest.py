@@ -0,0 +1,25 @@
+import numpy
+import pytest
+from astropy.io import fits
+
+
+@pytest.fixture
+def write_fits():
+    """
+    Returns a function writing a FITS file with one HDU per array, the first one as the primary HDU.
+    """
+    def write(path, *arrays, **keywords):
+        hdus = [fits.PrimaryHDU(arrays[0])] + [fits.ImageHDU(array) for array in arrays[1:]]
+        for hdu in hdus:
+            hdu.header.update(keywords)
+        fits.HDUList(hdus).writeto(str(path), overwrite=True)
+        return str(path)
+    return write
+
+
+@pytest.fixture
+def image():
+    """
+    A small float32 image with a noisy, non constant background.
+    """
+    return (numpy.random.RandomState(0).normal(size=(40, 50)) * 100).astype(numpy.float32)
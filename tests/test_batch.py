@@ -0,0 +1,225 @@
+import json
+import os
+import pytest
+import socket
+from exrconverter import batch, fits2exr
+
+
+@pytest.fixture
+def directory(tmp_path, write_fits, image):
+    write_fits(tmp_path / 'a.fits', image)
+    write_fits(tmp_path / 'b.fits', image * 2)
+    return str(tmp_path)
+
+
+def touch(path, seconds=10):
+    status = os.stat(path)
+    os.utime(path, ns=(status.st_atime_ns, status.st_mtime_ns + seconds * 10 ** 9))
+
+
+def converted(result):
+    return [os.path.basename(file_result.input_path) for file_result in result.results
+            if file_result.succeeded and not file_result.skipped]
+
+
+def test_incremental_rerun_skips_up_to_date_files(directory):
+    result = fits2exr.convert_directory(directory, incremental=True, verbose=False)
+    assert converted(result) == ['a.fits', 'b.fits']
+    assert os.path.exists(os.path.join(directory, batch.MANIFEST_NAME))
+
+    result = fits2exr.convert_directory(directory, incremental=True, verbose=False)
+    assert converted(result) == []
+    assert len(result.skipped) == 2
+
+
+def test_incremental_rerun_converts_changed_inputs_options_and_outputs(directory):
+    fits2exr.convert_directory(directory, incremental=True, verbose=False)
+
+    touch(os.path.join(directory, 'a.fits'))
+    assert converted(fits2exr.convert_directory(directory, incremental=True, verbose=False)) == ['a.fits']
+
+    os.remove(os.path.join(directory, 'b.exr'))
+    assert converted(fits2exr.convert_directory(directory, incremental=True, verbose=False)) == ['b.fits']
+
+    result = fits2exr.convert_directory(directory, incremental=True, compression='PIZ', verbose=False)
+    assert converted(result) == ['a.fits', 'b.fits']
+
+
+def test_incremental_checksum_skips_touched_but_unchanged_inputs(directory, write_fits, image):
+    fits2exr.convert_directory(directory, incremental=True, checksum=True, verbose=False)
+
+    touch(os.path.join(directory, 'a.fits'))
+    assert converted(fits2exr.convert_directory(directory, incremental=True, checksum=True, verbose=False)) == []
+
+    write_fits(os.path.join(directory, 'a.fits'), image * 3)
+    touch(os.path.join(directory, 'a.fits'))
+    assert converted(fits2exr.convert_directory(directory, incremental=True, checksum=True,
+                                                verbose=False)) == ['a.fits']
+
+
+def test_incremental_rerun_retries_failed_files(directory, write_fits, image):
+    with open(os.path.join(directory, 'c.fits'), 'w') as junk:
+        junk.write('not a FITS file')
+    result = fits2exr.convert_directory(directory, incremental=True, verbose=False)
+    assert [os.path.basename(file_result.input_path) for file_result in result.failed] == ['c.fits']
+
+    write_fits(os.path.join(directory, 'c.fits'), image)
+    assert converted(fits2exr.convert_directory(directory, incremental=True, verbose=False)) == ['c.fits']
+
+
+def test_manifest_compaction(tmp_path):
+    input_path = str(tmp_path / 'a.fits')
+    output_path = str(tmp_path / 'a.exr')
+    for path in (input_path, output_path):
+        with open(path, 'w') as data:
+            data.write('data')
+    manifest_path = str(tmp_path / batch.MANIFEST_NAME)
+
+    def line_count():
+        with open(manifest_path) as manifest_file:
+            return len(manifest_file.readlines())
+
+    manifest = batch.Manifest(manifest_path)
+    for attempt in range(2):
+        manifest.record(batch.FileResult(input_path, output_path), 'options')
+    batch.Manifest(manifest_path)
+    assert line_count() == 2  # superseded entries are not the majority of the manifest yet
+
+    manifest.record(batch.FileResult(input_path, output_path), 'options')
+    manifest = batch.Manifest(manifest_path)
+    assert line_count() == 1
+    assert manifest.is_up_to_date(input_path, output_path, 'options')
+    assert not manifest.is_up_to_date(input_path, output_path, 'other options')
+
+
+def test_manifest_skips_truncated_lines(tmp_path):
+    manifest_path = str(tmp_path / batch.MANIFEST_NAME)
+    with open(manifest_path, 'w') as manifest_file:
+        manifest_file.write(json.dumps({'input': 'a.fits', 'time': 1.0}) + '\n{"input": "b.fi')
+    assert list(batch.Manifest(manifest_path).entries) == ['a.fits']
+
+
+def test_shard_splits_jobs_by_size(directory, write_fits, image):
+    write_fits(os.path.join(directory, 'c.fits'), image, image, image)
+    jobs = batch.list_directory(directory, ['fits'], 'exr')
+    shards = [batch.shard(jobs, index, 2) for index in range(2)]
+    assert sorted(shards[0] + shards[1]) == jobs
+    assert [os.path.basename(job[0]) for job in shards[0]] == ['c.fits']
+    with pytest.raises(Exception):
+        batch.shard(jobs, 2, 2)
+
+
+def test_shard_manifests_are_shared(directory):
+    for shard_index in range(2):
+        result = fits2exr.convert_directory(directory, incremental=True, shard_index=shard_index, shard_count=2,
+                                            verbose=False)
+        assert len(converted(result)) == 1
+    assert sorted(name for name in os.listdir(directory) if name.startswith('.exrconverter-manifest')) == \
+        ['.exrconverter-manifest.0.jsonl', '.exrconverter-manifest.1.jsonl']
+
+    # Every shard, and an unsharded batch, sees the files converted by the other shards.
+    assert converted(fits2exr.convert_directory(directory, incremental=True, verbose=False)) == []
+    assert converted(fits2exr.convert_directory(directory, incremental=True, shard_index=0, shard_count=2,
+                                                verbose=False)) == []
+
+
+def test_claim_succeeds_once(tmp_path):
+    claims_path = str(tmp_path / 'claims')
+    assert batch.claim(claims_path, '/data/a.fits')
+    assert not batch.claim(claims_path, '/data/a.fits')
+    assert batch.claim(claims_path, '/data/b.fits')
+    with open(os.path.join(claims_path, 'a.fits')) as claim_file:
+        assert json.load(claim_file)['pid'] == os.getpid()
+
+    batch.release(claims_path, '/data/a.fits')
+    assert batch.claim(claims_path, '/data/a.fits')
+
+
+def test_claim_run_converts_every_file_once_and_retries_failures(directory, write_fits, image):
+    with open(os.path.join(directory, 'c.fits'), 'w') as junk:
+        junk.write('not a FITS file')
+    result = fits2exr.convert_directory(directory, claim_run='run', shard_index=0, shard_count=2, verbose=False)
+    assert converted(result) == ['a.fits', 'b.fits']
+    assert len(result.failed) == 1
+
+    write_fits(os.path.join(directory, 'c.fits'), image)
+    result = fits2exr.convert_directory(directory, claim_run='run', shard_index=1, shard_count=2, verbose=False)
+    assert converted(result) == ['c.fits']
+    assert len(result.skipped) == 2
+
+    batch.clear_claims(directory, 'run')
+    assert os.listdir(os.path.join(directory, batch.CLAIMS_NAME)) == []
+    assert len(converted(fits2exr.convert_directory(directory, claim_run='run', verbose=False))) == 3
+
+
+def test_node_manifests_survive_the_compaction_of_each_other(tmp_path):
+    inputs = []
+    for name in ('a', 'b', 'c'):
+        for extension in ('fits', 'exr'):
+            with open(str(tmp_path / (name + '.' + extension)), 'w') as data:
+                data.write('data')
+        inputs.append((str(tmp_path / (name + '.fits')), str(tmp_path / (name + '.exr'))))
+    paths = [str(tmp_path / ('.exrconverter-manifest.run.node%d.jsonl' % index)) for index in range(2)]
+
+    first = batch.Manifest(paths[0], shared_paths=paths)
+    second = batch.Manifest(paths[1], shared_paths=paths)
+    for attempt in range(3):
+        first.record(batch.FileResult(*inputs[0]), 'options')
+    second.record(batch.FileResult(*inputs[1]), 'options')
+    batch.Manifest(paths[0], shared_paths=paths)  # compacts the manifest of the first node while the second appends
+    second.record(batch.FileResult(*inputs[2]), 'options')
+
+    manifest = batch.Manifest(str(tmp_path / batch.MANIFEST_NAME), shared_paths=paths)
+    assert all(manifest.is_up_to_date(input_path, output_path, 'options') for input_path, output_path in inputs)
+
+
+def test_claim_run_nodes_keep_their_own_manifests(directory):
+    result = fits2exr.convert_directory(directory, incremental=True, claim_run='run', verbose=False)
+    assert len(converted(result)) == 2
+    assert [name for name in os.listdir(directory) if name.startswith('.exrconverter-manifest')] == \
+        ['.exrconverter-manifest.run.%s.%d.jsonl' % (socket.gethostname(), os.getpid())]
+
+    batch.clear_claims(directory, 'run')
+    assert converted(fits2exr.convert_directory(directory, incremental=True, verbose=False)) == []
+
+
+def test_list_directory_pairs_inputs_with_outputs(directory):
+    for name in ('.hidden.fits', 'notes.txt'):
+        with open(os.path.join(directory, name), 'w') as data:
+            data.write('data')
+    assert batch.list_directory(directory, ['fits'], 'exr') == [
+        (directory + '/a.fits', directory + '/a.exr'), (directory + '/b.fits', directory + '/b.exr')]
+
+
+@pytest.mark.parametrize('workers, pool', [(1, 'process'), (2, 'thread'), (2, 'process')])
+def test_run_keeps_the_order_of_the_jobs_and_goes_on_after_failures(directory, image, workers, pool):
+    with open(os.path.join(directory, 'a0.fits'), 'w') as junk:
+        junk.write('not a FITS file')
+    jobs = batch.list_directory(directory, ['fits'], 'exr')
+    result = batch.run(fits2exr.convert, jobs, kwargs={'verbose': False}, workers=workers, pool=pool, verbose=False)
+
+    assert [(file_result.input_path, file_result.output_path) for file_result in result.results] == jobs
+    assert [os.path.basename(file_result.input_path) for file_result in result.failed] == ['a0.fits']
+    assert result.failed[0].error_traceback and not os.path.exists(os.path.join(directory, 'a0.exr'))
+    assert converted(result) == ['a.fits', 'b.fits']
+    assert result.summary().startswith('Converted 2 of 3 files (1 failed)')
+    assert result.stats.pixels == 2 * image.size
+
+
+def test_run_rejects_unknown_pools(directory):
+    with pytest.raises(Exception):
+        batch.run(fits2exr.convert, batch.list_directory(directory, ['fits'], 'exr'), workers=2, pool='cluster')
+
+
+def test_atomic_conversions_keep_the_previous_output_of_failures(directory):
+    output_path = os.path.join(directory, 'c.exr')
+    with open(os.path.join(directory, 'c.fits'), 'w') as junk:
+        junk.write('not a FITS file')
+    with open(output_path, 'w') as previous:
+        previous.write('previous output')
+
+    result = batch.convert_file(fits2exr.convert, os.path.join(directory, 'c.fits'), output_path, atomic=True)
+    assert not result.succeeded
+    with open(output_path) as previous:
+        assert previous.read() == 'previous output'
+    assert sorted(os.listdir(directory)) == ['a.fits', 'b.fits', 'c.exr', 'c.fits']
@@ -0,0 +1,45 @@
+import os
+import sys
+import numpy
+import pytest
+from astropy.io import fits
+from exrconverter import exr2fits, exr2tiff
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+import generators  # noqa: E402
+import run  # noqa: E402
+
+
+def test_generated_images_are_reproducible():
+    numpy.testing.assert_array_equal(generators.make_image(32, 24, 1), generators.make_image(32, 24, 1))
+    assert generators.make_image(32, 24, 1).shape == (24, 32)
+    assert not numpy.array_equal(generators.make_image(32, 24, 0), generators.make_image(32, 24, 1))
+    assert generators.make_image(32, 24, dtype=numpy.float16).dtype == numpy.float16
+
+
+def test_generated_files_can_be_converted(tmp_path):
+    paths = generators.make_directory(str(tmp_path / 'fits'), 'fits', 2, 32, 24, layers=2)
+    assert [os.path.basename(path) for path in paths] == ['frame-0000.fits', 'frame-0001.fits']
+    with fits.open(paths[1]) as hdu_list:
+        assert [hdu.header['FILTER'] for hdu in hdu_list] == ['u', 'g'] and hdu_list[1].data.shape == (24, 32)
+
+    exr_fits = generators.make_directory(str(tmp_path / 'exr-fits'), 'exr-fits', 1, 32, 24)[0]
+    with exr2fits.to_hdulist(exr_fits) as hdu_list:
+        assert len(hdu_list) == 3 and hdu_list[2].header['FILTER'] == 'r'
+    exr_tiff = generators.make_directory(str(tmp_path / 'exr-tiff'), 'exr-tiff', 1, 32, 24)[0]
+    exr2tiff.convert(exr_tiff, str(tmp_path / 'frame.tif'))
+
+    with pytest.raises(Exception):
+        generators.make_directory(str(tmp_path / 'png'), 'png', 1, 32, 24)
+
+
+def test_run_and_compare(capsys):
+    results = run.run(32, 2, 2, 1, 1, cases=['fits2exr.convert', 'exr2fits.convert_directory'])
+    assert [result['name'] for result in results['results']] == ['fits2exr.convert', 'exr2fits.convert_directory']
+    assert results['results'][1]['files'] == 2 and results['parameters']['size'] == 32
+    assert all(result['seconds'] > 0 and result['peak_rss_mb'] > 0 for result in results['results'])
+
+    slower = {'results': [dict(results['results'][0], mp_per_s=results['results'][0]['mp_per_s'] * 2)]}
+    assert run.compare(results, slower, 0.1) == ['fits2exr.convert']
+    assert run.compare(results, results, 0.1) == []
+    assert 'REGRESSION' in capsys.readouterr().out
@@ -0,0 +1,90 @@
+import os
+import numpy
+import pytest
+from exrconverter import catalog, fits2exr, tiff2exr, tiffpages
+
+tifffile = pytest.importorskip('tifffile')
+
+
+@pytest.fixture
+def input_tiff(tmp_path, image):
+    path = str(tmp_path / 'stack.tif')
+    with tiffpages.PageWriter(path, (2,) + image.shape, image.dtype) as writer:
+        writer.write(image, {'Artist': 'A', 'ImageDescription': '{"FILTER": "g", "EXPTIME": 30.5}'})
+        writer.write(image * 2, {'Artist': 'A', 'ImageDescription': '{"FILTER": "r"}', 'PageName': 'second'})
+    return path
+
+
+def test_inspect_tiff_reads_the_tags_of_every_page(input_tiff, image):
+    info = catalog.inspect(input_tiff)
+    assert info['format'] == 'tiff' and (info['width'], info['height']) == (image.shape[1], image.shape[0])
+    assert info['header'] == {'Artist': 'A'}
+    assert [layer['dtype'] for layer in info['layers']] == ['float32', 'float32']
+    assert info['layers'][0]['header'] == {'Artist': 'A', 'FILTER': 'g', 'EXPTIME': 30.5}
+    assert info['layers'][1]['header'] == {'Artist': 'A', 'FILTER': 'r', 'PageName': 'second'}
+
+
+def test_query_tiff_and_exr_page_headers(tmp_path, input_tiff):
+    tiff2exr.convert(input_tiff, str(tmp_path / 'stack.exr'))
+    catalog_path = str(tmp_path / 'catalog.sqlite')
+    assert catalog.build_catalog(str(tmp_path), catalog_path) == 2
+    assert catalog.query(catalog_path, FILTER='r') == [str(tmp_path / 'stack.exr'), input_tiff]
+    assert catalog.query(catalog_path, file_format='tiff', EXPTIME=30.5) == [input_tiff]
+    assert catalog.query(catalog_path, PageName='second', FILTER='g') == [str(tmp_path / 'stack.exr'), input_tiff]
+    assert catalog.query(catalog_path, FILTER='i') == []
+
+
+def test_inspect_tiff_without_tifffile(input_tiff, monkeypatch):
+    pytest.importorskip('SimpleITK')
+    monkeypatch.setattr(tiffpages, 'tifffile', None)
+    info = catalog.inspect(input_tiff)
+    assert len(info['layers']) == 2 and info['layers'][0]['dtype'] == 'float32'
+    assert all(layer['header'] == {} for layer in info['layers'])
+
+
+def test_inspect_color_tiff(tmp_path, image):
+    pytest.importorskip('SimpleITK')
+    path = str(tmp_path / 'rgb.tif')
+    tifffile.imwrite(path, numpy.stack([image] * 3, axis=-1).astype(numpy.uint8), photometric='rgb')
+    assert catalog.inspect(path)['width'] == image.shape[1]
+
+
+def test_inspect_fits_and_exr(tmp_path, write_fits, image):
+    input_fits = write_fits(tmp_path / 'input.fits', image, image[:10], FILTER='g')
+    info = catalog.inspect(input_fits)
+    assert info['format'] == 'fits' and info['size'] > 0 and info['compression'] is None
+    assert [(layer['name'], layer['dtype'], layer['height']) for layer in info['layers']] == \
+        [('PRIMARY', 'float32', 40), ('', 'float32', 10)]
+    assert info['layers'][1]['header']['FILTER'] == 'g'
+
+    fits2exr.convert(input_fits, str(tmp_path / 'input.exr'), compression='PIZ', verbose=False)
+    info = catalog.inspect(str(tmp_path / 'input.exr'))
+    assert info['format'] == 'exr' and info['compression'] == 'PIZ'
+    assert [(layer['name'], layer['dtype']) for layer in info['layers']] == [('0', 'float32')]
+    assert info['layers'][0]['header']['FILTER'] == 'g'
+
+    with pytest.raises(Exception):
+        catalog.inspect(str(tmp_path / 'input.png'))
+
+
+def test_build_catalog_only_indexes_changed_files(tmp_path, write_fits, image):
+    archive = tmp_path / 'archive'
+    archive.mkdir()
+    write_fits(archive / 'a.fits', image, FILTER='g')
+    write_fits(archive / 'b.fits', image, FILTER='r')
+    with open(str(archive / 'broken.fits'), 'w') as junk:
+        junk.write('not a FITS file')
+    catalog_path = str(tmp_path / 'catalog.sqlite')
+
+    assert catalog.build_catalog(str(archive), catalog_path, verbose=False) == 2
+    assert catalog.build_catalog(str(archive), catalog_path, verbose=False) == 0
+    assert catalog.query(catalog_path, file_format='fits') == [str(archive / 'a.fits'), str(archive / 'b.fits')]
+
+    write_fits(archive / 'a.fits', image, FILTER='r')
+    status = os.stat(str(archive / 'a.fits'))  # same size, so make sure the modification time differs
+    os.utime(str(archive / 'a.fits'), ns=(status.st_atime_ns, status.st_mtime_ns + 10 ** 10))
+    os.remove(str(archive / 'b.fits'))
+    assert catalog.build_catalog(str(archive), catalog_path, verbose=False) == 1
+    assert catalog.query(catalog_path, FILTER='r') == [str(archive / 'a.fits')]
+    assert catalog.query(catalog_path, FILTER='g') == []
+    assert catalog.query(catalog_path, file_format='exr') == []
@@ -0,0 +1,40 @@
+import json
+import subprocess
+import sys
+import numpy
+import OpenEXR
+from exrconverter import cli, verification
+from exrconverter.region import read_region
+
+
+def test_convert_command(tmp_path, write_fits, image):
+    input_fits = write_fits(tmp_path / 'input.fits', image)
+    output_exr = str(tmp_path / 'output.exr')
+    assert cli.main(['convert', input_fits, output_exr, '--pixel-type', 'float16', '--compression', 'PIZ',
+                     '--tile-size', '16', '-o', 'channel_stats=true', '--quiet']) == 0
+    assert OpenEXR.File(output_exr).parts[0].header['type'] == OpenEXR.tiledimage
+    assert verification.read_channel_stats(output_exr)['0']['nan'] == 0
+    numpy.testing.assert_array_equal(read_region(output_exr)['0'], image.astype(numpy.float16))
+
+
+def test_failed_commands_return_an_error_status(tmp_path, capsys):
+    assert cli.main(['convert', str(tmp_path / 'missing.fits'), str(tmp_path / 'output.exr')]) == 1
+    assert 'Failed to convert' in capsys.readouterr().err
+    assert cli.main(['inspect', str(tmp_path / 'missing.exr')]) == 1
+
+
+def test_inspect_command(tmp_path, write_fits, image, capsys):
+    input_fits = write_fits(tmp_path / 'input.fits', image, FILTER='g')
+    assert cli.main(['inspect', input_fits]) == 0
+    info = json.loads(capsys.readouterr().out)
+    assert info['format'] == 'fits' and info['layers'][0]['header']['FILTER'] == 'g'
+
+
+def test_commands_only_import_the_converters_they_need(tmp_path):
+    # The console script starts with a bare interpreter, so this is checked in a new one.
+    script = ("import sys; from exrconverter import cli; cli.main(['submit', %r, 'a.fits', 'a.exr']); "
+              "print(sorted(name for name in ('astropy', 'OpenEXR', 'SimpleITK', 'tifffile') if name in sys.modules))"
+              % str(tmp_path / 'spool'))
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=str(tmp_path),
+                                     env={'PYTHONPATH': ':'.join(sys.path)})
+    assert output.decode().splitlines()[-1] == '[]'
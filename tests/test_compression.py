@@ -0,0 +1,48 @@
+import numpy
+import OpenEXR
+import pytest
+from exrconverter import compression, fits2exr
+from exrconverter.pixeltype import PixelType
+from exrconverter.region import read_region
+
+
+def test_benchmark_measures_every_codec(image):
+    results = compression.benchmark({'0': image, '1': image.astype(numpy.float16)}, repeat=2)
+    assert [result['compression'] for result in results] == list(compression.COMPRESSION_OPTIONS)
+    for result in results:
+        assert result['encode_mb_s'] > 0 and result['decode_mb_s'] > 0 and result['ratio'] > 0
+        if result['compression'] in compression.LOSSLESS_COMPRESSIONS:
+            assert result['lossless'] and result['max_error'] == 0.0
+    assert not dict((result['compression'], result) for result in results)['PXR24']['lossless']
+
+
+@pytest.mark.parametrize('pixel_type', [PixelType.FLOAT32, PixelType.FLOAT16])
+def test_choose_compression(image, pixel_type):
+    exr_data = {'0': image, '1': numpy.zeros_like(image)}
+    lossless = compression.LOSSLESS_COMPRESSIONS + (['PXR24'] if pixel_type == PixelType.FLOAT16 else [])
+    assert compression.choose_compression(exr_data, 'lossless', sample_rows=16, pixel_type=pixel_type) in lossless
+    for goal in ('fastest', 'smallest'):
+        assert compression.choose_compression(exr_data, goal, pixel_type=pixel_type) in compression.COMPRESSION_OPTIONS
+    with pytest.raises(Exception):
+        compression.choose_compression(exr_data, 'best')
+
+
+def test_automatic_compression_keeps_the_pixels(tmp_path, write_fits, image):
+    input_fits = write_fits(tmp_path / 'input.fits', image)
+    fits2exr.convert(input_fits, str(tmp_path / 'output.exr'), compression='auto')
+    exr_file = OpenEXR.InputFile(str(tmp_path / 'output.exr'))
+    try:
+        codec = str(exr_file.header()['compression']).replace('_COMPRESSION', '')
+    finally:
+        exr_file.close()
+    assert codec in compression.LOSSLESS_COMPRESSIONS
+    numpy.testing.assert_array_equal(read_region(str(tmp_path / 'output.exr'))['0'], image)
+
+
+def test_load_sample(tmp_path, write_fits, image):
+    input_fits = write_fits(tmp_path / 'input.fits', image, numpy.zeros((5, 5)), image * 2)
+    sample = compression.load_sample(input_fits, PixelType.FLOAT16)
+    assert list(sample) == ['0', '1'] and sample['1'].dtype == numpy.float16
+    numpy.testing.assert_array_equal(sample['1'], (image * 2).astype(numpy.float16))
+    with pytest.raises(Exception):
+        compression.load_sample(str(tmp_path / 'input.png'))
@@ -0,0 +1,64 @@
+import numpy
+import pytest
+from astropy.io import fits
+from exrconverter import catalog, exr2fits, fits2exr
+from exrconverter.pixeltype import PixelType
+from exrconverter.region import read_region
+
+
+@pytest.fixture
+def cube(image):
+    return numpy.stack([image, image + 1, image + 2, image + 3])
+
+
+@pytest.fixture
+def input_fits(tmp_path, image, cube):
+    primary = fits.PrimaryHDU(image * 2)
+    primary.header['OBJECT'] = 'M31'
+    extension = fits.ImageHDU(cube, name='CUBE')
+    extension.header['CRPIX1'] = 20.0
+    fits.HDUList([primary, extension, fits.ImageHDU(image * 3)]).writeto(str(tmp_path / 'cube.fits'))
+    return str(tmp_path / 'cube.fits')
+
+
+def test_every_plane_is_a_channel(tmp_path, input_fits, image, cube):
+    fits2exr.convert(input_fits, str(tmp_path / 'cube.exr'), block_size=16)
+    region = read_region(str(tmp_path / 'cube.exr'))
+    assert list(region) == [str(index) for index in range(6)]
+    numpy.testing.assert_array_equal(region['0'], image * 2)
+    numpy.testing.assert_array_equal(numpy.stack([region[str(index)] for index in range(1, 5)]), cube)
+    numpy.testing.assert_array_equal(region['5'], image * 3)
+
+    layers = catalog.inspect(str(tmp_path / 'cube.exr'))['layers']
+    assert [layer['header'].get('EXTNAME') for layer in layers] == [None, 'CUBE', 'CUBE', 'CUBE', 'CUBE', None]
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_cubes_are_put_back_together(tmp_path, input_fits, image, cube, streaming):
+    fits2exr.convert(input_fits, str(tmp_path / 'cube.exr'))
+    exr2fits.convert(str(tmp_path / 'cube.exr'), str(tmp_path / 'output.fits'), streaming=streaming, block_size=7)
+    with fits.open(input_fits) as inputs, fits.open(str(tmp_path / 'output.fits')) as outputs:
+        assert len(outputs) == 3 and outputs[1].header['NAXIS'] == 3
+        for input_hdu, output_hdu in zip(inputs, outputs):
+            numpy.testing.assert_array_equal(output_hdu.data, input_hdu.data)
+        assert outputs[0].header['OBJECT'] == 'M31' and outputs[1].header['EXTNAME'] == 'CUBE'
+
+    with exr2fits.to_hdulist(str(tmp_path / 'cube.exr')) as hdu_list:
+        numpy.testing.assert_array_equal(hdu_list[1].data, cube)
+
+
+def test_cube_cutouts(tmp_path, input_fits, cube):
+    fits2exr.convert(input_fits, str(tmp_path / 'cube.exr'))
+    exr2fits.convert(str(tmp_path / 'cube.exr'), str(tmp_path / 'cutout.fits'), window=(5, 3, 25, 33),
+                     channels=[2, 3])
+    with fits.open(str(tmp_path / 'cutout.fits')) as outputs:
+        assert len(outputs) == 1 and outputs[0].header['CRPIX1'] == 15.0
+        numpy.testing.assert_array_equal(outputs[0].data, cube[1:3, 3:33, 5:25])
+
+
+def test_cubes_change_the_pixel_type(tmp_path, write_fits, cube):
+    input_fits = write_fits(tmp_path / 'cube.fits', cube)
+    fits2exr.convert(input_fits, str(tmp_path / 'cube.exr'), output_pixel_type=PixelType.FLOAT16)
+    region = read_region(str(tmp_path / 'cube.exr'))
+    assert len(region) == 4 and region['3'].dtype == numpy.float16
+    numpy.testing.assert_array_equal(region['3'], cube[3].astype(numpy.float16))
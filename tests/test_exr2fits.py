@@ -0,0 +1,39 @@
+import io
+import numpy
+import pytest
+from astropy.io import fits
+from exrconverter import exr2fits, fits2exr
+from exrconverter.pixeltype import PixelType
+
+
+@pytest.fixture
+def input_exr(tmp_path, write_fits, image):
+    input_fits = write_fits(tmp_path / 'input.fits', image, image * 2, FILTER='g', EXPTIME=30.5)
+    fits2exr.convert(input_fits, str(tmp_path / 'input.exr'))
+    return str(tmp_path / 'input.exr')
+
+
+@pytest.mark.parametrize('block_size', [1, 16, 40, 256])
+def test_streaming_writes_the_same_fits_file(tmp_path, input_exr, image, block_size):
+    exr2fits.convert(input_exr, str(tmp_path / 'whole.fits'))
+    exr2fits.convert(input_exr, str(tmp_path / 'streaming.fits'), streaming=True, block_size=block_size)
+
+    with fits.open(str(tmp_path / 'whole.fits')) as whole, fits.open(str(tmp_path / 'streaming.fits')) as streaming:
+        assert len(streaming) == len(whole) == 2
+        numpy.testing.assert_array_equal(streaming[0].data, image)
+        for streaming_hdu, whole_hdu in zip(streaming, whole):
+            numpy.testing.assert_array_equal(streaming_hdu.data, whole_hdu.data)
+            assert streaming_hdu.header['FILTER'] == 'g' and streaming_hdu.header['EXPTIME'] == 30.5
+
+
+def test_streaming_changes_the_pixel_type(tmp_path, input_exr, image):
+    exr2fits.convert(input_exr, str(tmp_path / 'streaming.fits'), output_pixel_type=PixelType.FLOAT64,
+                     streaming=True, block_size=16)
+    with fits.open(str(tmp_path / 'streaming.fits')) as streaming:
+        assert streaming[1].header['BITPIX'] == -64
+        numpy.testing.assert_array_equal(streaming[1].data, (image * 2).astype(numpy.float64))
+
+
+def test_streaming_requires_an_output_path(input_exr):
+    with pytest.raises(Exception):
+        exr2fits.convert(input_exr, io.BytesIO(), streaming=True)
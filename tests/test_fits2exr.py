@@ -0,0 +1,87 @@
+import io
+import numpy
+import OpenEXR
+import pytest
+from astropy.io import fits
+from exrconverter import exr2fits, fits2exr
+from exrconverter.pixeltype import PixelType
+from exrconverter.region import read_region
+
+
+@pytest.fixture
+def input_fits(tmp_path, write_fits, image):
+    return write_fits(tmp_path / 'input.fits', image, image * 2, FILTER='g')
+
+
+@pytest.mark.parametrize('block_size', [1, 16, 40, 256])
+def test_streaming_writes_the_same_image(tmp_path, input_fits, image, block_size):
+    fits2exr.convert(input_fits, str(tmp_path / 'whole.exr'))
+    fits2exr.convert(input_fits, str(tmp_path / 'streaming.exr'), streaming=True, block_size=block_size)
+
+    whole = read_region(str(tmp_path / 'whole.exr'))
+    streaming = read_region(str(tmp_path / 'streaming.exr'))
+    assert list(streaming) == list(whole) == ['0', '1']
+    numpy.testing.assert_array_equal(streaming['0'], image)
+    numpy.testing.assert_array_equal(streaming['1'], whole['1'])
+
+
+def test_streaming_changes_the_pixel_type_and_keeps_the_headers(tmp_path, input_fits, image):
+    fits2exr.convert(input_fits, str(tmp_path / 'streaming.exr'), output_pixel_type=PixelType.FLOAT16, streaming=True,
+                     block_size=7)
+    fits2exr.convert(input_fits, str(tmp_path / 'whole.exr'), output_pixel_type=PixelType.FLOAT16)
+    numpy.testing.assert_array_equal(read_region(str(tmp_path / 'streaming.exr'))['0'], image.astype(numpy.float16))
+
+    with exr2fits.to_hdulist(str(tmp_path / 'streaming.exr'), verbose=False) as streaming, \
+            exr2fits.to_hdulist(str(tmp_path / 'whole.exr'), verbose=False) as whole:
+        assert len(streaming) == len(whole) and all(hdu.header['FILTER'] == 'g' for hdu in streaming)
+        for streaming_hdu, whole_hdu in zip(streaming, whole):
+            numpy.testing.assert_array_equal(streaming_hdu.data, whole_hdu.data)
+
+
+def test_streaming_requires_an_output_path(input_fits):
+    with pytest.raises(Exception):
+        fits2exr.convert(input_fits, io.BytesIO(), streaming=True)
+
+
+def test_streaming_skips_hdus_of_other_sizes(tmp_path, write_fits, image):
+    input_fits = write_fits(tmp_path / 'input.fits', image, numpy.zeros((5, 5), numpy.float32), image * 3)
+    fits2exr.convert(input_fits, str(tmp_path / 'streaming.exr'), streaming=True, block_size=16, verbose=False)
+    with fits.open(input_fits) as hdu_list:
+        expected = [hdu.data for hdu in hdu_list if hdu.data.shape == image.shape]
+    region = read_region(str(tmp_path / 'streaming.exr'))
+    assert len(region) == len(expected)
+    for data, expected_data in zip(region.values(), expected):
+        numpy.testing.assert_array_equal(data, expected_data)
+
+
+def test_tiled_output_is_read_back_like_scanlines(tmp_path, input_fits, image):
+    fits2exr.convert(input_fits, str(tmp_path / 'tiled.exr'), tile_size=(16, 8), compression='PIZ')
+    parts = OpenEXR.File(str(tmp_path / 'tiled.exr')).parts
+    assert len(parts) == 1 and parts[0].header['type'] == OpenEXR.tiledimage
+    assert (parts[0].header['tiles'].xSize, parts[0].header['tiles'].ySize) == (16, 8)
+
+    numpy.testing.assert_array_equal(read_region(str(tmp_path / 'tiled.exr'), window=(3, 5, 30, 37))['1'],
+                                     image[5:37, 3:30] * 2)
+    with exr2fits.to_hdulist(str(tmp_path / 'tiled.exr')) as hdu_list:
+        assert [hdu.header['FILTER'] for hdu in hdu_list] == ['g', 'g']
+
+
+@pytest.mark.parametrize('levels, count', [('mipmap', 6), ('ripmap', 36)])
+def test_levels_are_written_as_reduced_parts(tmp_path, input_fits, image, levels, count):
+    fits2exr.convert(input_fits, str(tmp_path / 'levels.exr'), levels=levels)
+    parts = OpenEXR.File(str(tmp_path / 'levels.exr')).parts
+    assert len(parts) == count and parts[0].name() == 'level_0_0'
+    numpy.testing.assert_array_equal(parts[0].channels['0'].pixels, image)
+
+    # Every level averages boxes of the full image, rounding odd sizes down.
+    level = dict((part.name(), part.channels['0'].pixels) for part in parts)['level_1_1']
+    assert level.shape == (20, 25)
+    numpy.testing.assert_allclose(level, image.reshape(20, 2, 25, 2).mean(axis=(1, 3)), rtol=1e-5, atol=1e-4)
+    numpy.testing.assert_array_equal(read_region(str(tmp_path / 'levels.exr'))['0'], image)
+
+
+def test_tiles_cannot_be_streamed_and_levels_must_be_known(tmp_path, input_fits):
+    with pytest.raises(Exception):
+        fits2exr.convert(input_fits, str(tmp_path / 'tiled.exr'), tile_size=16, streaming=True)
+    with pytest.raises(Exception):
+        fits2exr.convert(input_fits, str(tmp_path / 'levels.exr'), levels='pyramid')
@@ -0,0 +1,83 @@
+import json
+import numpy
+import Imath
+import OpenEXR
+from astropy.io import fits
+from exrconverter import catalog, exr2fits, fits2exr
+from exrconverter.utils import __FITS_HEADERS_ID, __encode_fits_headers, __decode_fits_headers, \
+    __get_fits_header_indexes
+
+
+def header_string(**keywords):
+    header = fits.Header()
+    header.update(keywords)
+    return header.tostring()
+
+
+def cards(header):
+    return [str(card) for card in fits.Header.fromstring(header).cards]
+
+
+def test_encoded_headers_round_trip_and_share_cards():
+    headers = [header_string(OBJECT='M31', TELESCOP='HST', EXPTIME=10.0),
+               header_string(OBJECT='M31', TELESCOP='HST', EXTNAME='SCI'), header_string()]
+    attributes = __encode_fits_headers(headers)
+    assert set(attributes) == {'fits_cards', 'fits_header_index'}
+    assert all(isinstance(value, str) and '\0' not in value for value in attributes.values())
+
+    decoded = __decode_fits_headers(attributes)
+    assert [cards(header) for header in decoded] == [cards(header) for header in headers]
+    assert all(len(header) % 80 == 0 for header in decoded)
+    assert fits.Header.fromstring(decoded[1])['EXTNAME'] == 'SCI'
+
+    # The shared cards and END are stored once.
+    assert len(json.loads(attributes['fits_header_index'])[1]) == 3
+    assert __decode_fits_headers(attributes, header_indexes=[1]) == [None, decoded[1], None]
+
+
+def test_legacy_and_missing_headers():
+    headers = [header_string(OBJECT='M31'), header_string(OBJECT='M32')]
+    assert __decode_fits_headers({__FITS_HEADERS_ID: json.dumps(headers)}) == headers
+    assert __decode_fits_headers({}) is None
+
+
+def test_header_indexes_of_channels():
+    channels = {'0': None, '1': None, '2': None}
+    assert __get_fits_header_indexes({'channels': channels}) == {'0': 0, '1': 1, '2': 2}
+    assert __get_fits_header_indexes({'channels': channels, 'fits_planes': '[[0,null],[1,0],[1,1]]'}) == \
+        {'0': 0, '1': 1, '2': 1}
+
+
+def test_fits_round_trip_keeps_data_and_headers(tmp_path, write_fits, image):
+    input_fits = write_fits(tmp_path / 'input.fits', image, image * 2, OBJECT='M31', EXPTIME=30.0)
+    fits2exr.convert(input_fits, str(tmp_path / 'image.exr'))
+    exr2fits.convert(str(tmp_path / 'image.exr'), str(tmp_path / 'output.fits'))
+
+    with fits.open(str(tmp_path / 'output.fits')) as hdu_list:
+        assert len(hdu_list) == 2
+        for hdu, data in zip(hdu_list, (image, image * 2)):
+            numpy.testing.assert_array_equal(hdu.data, data)
+            assert hdu.header['OBJECT'] == 'M31' and hdu.header['EXPTIME'] == 30.0
+
+
+def test_baseline_exr_files_are_read(tmp_path, image):
+    # The layout written by the first versions of fits2exr: one FLOAT channel per HDU, and a fits_headers attribute
+    # with the JSON list of the headers.
+    headers = [fits.PrimaryHDU(image).header, fits.ImageHDU(image * 2).header]
+    headers[0]['OBJECT'] = 'M31'
+    headers[1]['OBJECT'] = 'M32'
+    exr_header = OpenEXR.Header(image.shape[1], image.shape[0])
+    exr_header['channels'] = dict((str(index), Imath.Channel(Imath.PixelType(OpenEXR.FLOAT))) for index in range(2))
+    exr_header[__FITS_HEADERS_ID] = str.encode(json.dumps([header.tostring() for header in headers]))
+    exr_file = OpenEXR.OutputFile(str(tmp_path / 'baseline.exr'), exr_header)
+    exr_file.writePixels({'0': image.tobytes(), '1': (image * 2).tobytes()})
+    exr_file.close()
+
+    exr2fits.convert(str(tmp_path / 'baseline.exr'), str(tmp_path / 'output.fits'))
+    with fits.open(str(tmp_path / 'output.fits')) as hdu_list:
+        numpy.testing.assert_array_equal(hdu_list[0].data, image)
+        numpy.testing.assert_array_equal(hdu_list[1].data, image * 2)
+        assert [hdu.header['OBJECT'] for hdu in hdu_list] == ['M31', 'M32']
+
+    layers = catalog.inspect(str(tmp_path / 'baseline.exr'))['layers']
+    assert [layer['header']['OBJECT'] for layer in layers] == ['M31', 'M32']
@@ -0,0 +1,52 @@
+import io
+import numpy
+import pytest
+from astropy.io import fits
+from exrconverter import exr2fits, exr2tiff, fits2exr, tiff2exr
+from exrconverter.region import read_region
+
+
+@pytest.fixture
+def hdu_list(image):
+    primary = fits.PrimaryHDU(image)
+    primary.header['FILTER'] = 'g'
+    return fits.HDUList([primary, fits.ImageHDU(image * 2)])
+
+
+def test_hdulist_round_trip_through_bytes(hdu_list, image):
+    exr_bytes = fits2exr.from_hdulist(hdu_list, compression='PIZ')
+    assert isinstance(exr_bytes, bytes) and exr_bytes[:4] == b'\x76\x2f\x31\x01'
+
+    for input_exr in (exr_bytes, io.BytesIO(exr_bytes)):
+        with exr2fits.to_hdulist(input_exr) as output:
+            assert len(output) == 2 and output[0].header['FILTER'] == 'g'
+            numpy.testing.assert_array_equal(output[1].data, image * 2)
+    numpy.testing.assert_array_equal(read_region(exr_bytes, channels=[0])['0'], image)
+
+
+def test_convert_between_file_like_objects(hdu_list, image):
+    input_fits = io.BytesIO()
+    hdu_list.writeto(input_fits)
+    input_fits.seek(0)
+    output_exr = io.BytesIO()
+    fits2exr.convert(input_fits, output_exr)
+
+    output_fits = io.BytesIO()
+    exr2fits.convert(io.BytesIO(output_exr.getvalue()), output_fits, window=(0, 0, 20, 10))
+    output_fits.seek(0)
+    with fits.open(output_fits) as output:
+        numpy.testing.assert_array_equal(output[0].data, image[:10, :20])
+
+
+def test_hdulist_without_images():
+    assert fits2exr.from_hdulist(fits.HDUList([fits.PrimaryHDU()]), verbose=False) is None
+
+
+def test_image_round_trip_through_bytes(image):
+    sitk = pytest.importorskip('SimpleITK')
+    stack = numpy.stack([image, image * 2, image * 3])
+    exr_bytes = tiff2exr.from_image(sitk.GetImageFromArray(stack))
+    assert list(read_region(exr_bytes)) == ['0', '1', '2']
+
+    tiff_image = exr2tiff.to_image(exr_bytes, channels=[2, 0])
+    numpy.testing.assert_array_equal(sitk.GetArrayFromImage(tiff_image), stack[[2, 0]])
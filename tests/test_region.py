@@ -0,0 +1,98 @@
+import pickle
+import numpy
+import pytest
+from astropy.io import fits
+from exrconverter import exr2fits, fits2exr
+from exrconverter.pixeltype import PixelType
+from exrconverter.region import ExrArray, read_region, stack
+
+
+@pytest.fixture
+def input_exr(tmp_path, write_fits, image):
+    input_fits = write_fits(tmp_path / 'input.fits', image, image * 2, image * 3, CRPIX1=20.5, CRPIX2=10.0)
+    fits2exr.convert(input_fits, str(tmp_path / 'input.exr'))
+    return str(tmp_path / 'input.exr')
+
+
+def test_read_region_cuts_out_channels_and_windows(input_exr, image):
+    region = read_region(input_exr, window=(5, 3, 25, 33), channels=[2, '0'])
+    assert list(region) == ['2', '0']
+    numpy.testing.assert_array_equal(region['2'], image[3:33, 5:25] * 3)
+    numpy.testing.assert_array_equal(region['0'], image[3:33, 5:25])
+
+    whole = read_region(input_exr, output_pixel_type=PixelType.FLOAT16)
+    assert list(whole) == ['0', '1', '2'] and whole['1'].dtype == numpy.float16
+    numpy.testing.assert_array_equal(whole['1'], (image * 2).astype(numpy.float16))
+
+    with open(input_exr, 'rb') as exr_file:
+        numpy.testing.assert_array_equal(read_region(exr_file.read(), window=(0, 39, 50, 40))['0'], image[39:])
+
+
+@pytest.mark.parametrize('window', [(0, 0, 51, 40), (10, 5, 10, 6), (-1, 0, 5, 5)])
+def test_read_region_rejects_windows_outside_the_image(input_exr, window):
+    with pytest.raises(Exception):
+        read_region(input_exr, window=window)
+
+
+def test_read_region_rejects_unknown_channels(input_exr):
+    with pytest.raises(Exception):
+        read_region(input_exr, channels=[3])
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_fits_cutouts_shift_the_reference_pixel(tmp_path, input_exr, image, streaming):
+    output_fits = str(tmp_path / 'cutout.fits')
+    exr2fits.convert(input_exr, output_fits, window=(5, 3, 25, 33), channels=[1], streaming=streaming, block_size=7)
+    with fits.open(output_fits) as hdu_list:
+        assert len(hdu_list) == 1
+        numpy.testing.assert_array_equal(hdu_list[0].data, image[3:33, 5:25] * 2)
+        assert (hdu_list[0].header['CRPIX1'], hdu_list[0].header['CRPIX2']) == (15.5, 7.0)
+
+
+@pytest.mark.parametrize('key', [0, -1, (1, 5), (slice(None), 3, 7), (slice(0, 3, 2), slice(3, 30, 4)),
+                                 (Ellipsis, slice(10, 20)), (slice(2, 0, -1), slice(None), slice(None, None, -3)),
+                                 (slice(1, 1),), (0, slice(5, 5))])
+def test_exr_array_slices_like_numpy(input_exr, image, key):
+    cube = numpy.stack([image, image * 2, image * 3])
+    array = ExrArray(input_exr)
+    try:
+        assert array.shape == cube.shape and array.dtype == cube.dtype and len(array) == 3
+        sliced = array[key]
+        assert sliced.shape == cube[key].shape
+        numpy.testing.assert_array_equal(sliced, cube[key])
+    finally:
+        array.close()
+
+
+def test_exr_array_rejects_other_indices(input_exr):
+    array = ExrArray(input_exr)
+    with pytest.raises(IndexError):
+        array[[0, 1]]
+    with pytest.raises(IndexError):
+        array[0, 0, 0, 0]
+    array.close()
+
+
+def test_exr_array_channels_types_and_pickling(input_exr, image):
+    array = ExrArray(input_exr, channels=[2], output_pixel_type=PixelType.FLOAT16)
+    assert array.shape == (1,) + image.shape and array.dtype == numpy.float16
+    numpy.testing.assert_array_equal(numpy.asarray(array)[0], (image * 3).astype(numpy.float16))
+
+    copy = pickle.loads(pickle.dumps(array))
+    array.close()
+    numpy.testing.assert_array_equal(copy[0, 3:5], (image[3:5] * 3).astype(numpy.float16))
+    copy.close()
+
+
+def test_stack_reduces_files_with_dask(tmp_path, write_fits, image):
+    pytest.importorskip('dask')
+    inputs = []
+    for index in range(3):
+        fits2exr.convert(write_fits(tmp_path / ('%d.fits' % index), image + index), str(tmp_path / ('%d.exr' % index)))
+        inputs.append(str(tmp_path / ('%d.exr' % index)))
+
+    cube = stack(inputs, channels=[0], chunks=(1, 16, 50))
+    assert cube.shape == (3, 1) + image.shape and cube.chunks[2] == (16, 16, 8)
+    numpy.testing.assert_allclose(cube.mean(axis=0).compute()[0], image + 1, rtol=1e-6)
+    with pytest.raises(Exception):
+        stack([])
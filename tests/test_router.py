@@ -0,0 +1,76 @@
+import numpy
+import pytest
+from astropy.io import fits
+from exrconverter import exr2fits, fits2exr, router, tiffpages
+from exrconverter.image import read, read_tiff
+
+
+@pytest.fixture
+def input_fits(tmp_path, image):
+    # HDUs with different keyword sets: the second one has none of the keywords of the first.
+    primary = fits.PrimaryHDU(image)
+    primary.header.update(FILTER='g', EXPTIME=30.5, OBJECT='M31')
+    extension = fits.ImageHDU(image * 2)
+    named = fits.ImageHDU(image * 3, name='SCI')
+    named.header['OBJECT'] = 'M32'
+    fits.HDUList([primary, extension, named]).writeto(str(tmp_path / 'input.fits'))
+    return str(tmp_path / 'input.fits')
+
+
+def keywords(header):
+    return dict((keyword, header[keyword]) for keyword in ('FILTER', 'EXPTIME', 'OBJECT', 'EXTNAME')
+                if keyword in header)
+
+
+def test_get_format_and_route():
+    assert router.get_format('/data/image.FITS') == 'fits'
+    assert router.get_format('image.tif') == router.get_format('image.tiff') == 'tiff'
+    assert router.get_route('fits', 'exr') is fits2exr.convert
+    assert router.get_route('exr', 'fits') is exr2fits.convert
+    assert router.get_route('fits', 'tiff') is router.convert_image
+    with pytest.raises(Exception):
+        router.get_format('image.png')
+    with pytest.raises(Exception):
+        router.get_route('exr', 'exr')
+
+
+def test_fits_tiff_fits_round_trip_keeps_the_keywords_of_every_hdu(tmp_path, input_fits, image):
+    router.convert(input_fits, str(tmp_path / 'image.tif'))
+    router.convert(str(tmp_path / 'image.tif'), str(tmp_path / 'output.fits'))
+
+    with fits.open(input_fits) as inputs, fits.open(str(tmp_path / 'output.fits')) as outputs:
+        assert len(outputs) == 3
+        for input_hdu, output_hdu in zip(inputs, outputs):
+            numpy.testing.assert_array_equal(output_hdu.data, input_hdu.data)
+            assert keywords(output_hdu.header) == keywords(input_hdu.header)
+
+
+def test_tiff_pages_keep_their_own_headers(tmp_path, input_fits):
+    router.convert(input_fits, str(tmp_path / 'image.tif'))
+    with read_tiff(str(tmp_path / 'image.tif')) as tiff_image:
+        headers = [tiff_image.get_header(index) for index in range(3)]
+    assert headers[0]['FILTER'] == 'g' and headers[0]['EXPTIME'] == 30.5
+    assert 'FILTER' not in headers[1] and 'OBJECT' not in headers[1]
+    assert headers[2]['OBJECT'] == 'M32' and headers[2]['EXTNAME'] == 'SCI'
+
+
+def test_convert_image_changes_the_pixel_type(tmp_path, input_fits, image):
+    router.convert(input_fits, str(tmp_path / 'image.tif'), output_pixel_type='float16')
+    with read(str(tmp_path / 'image.tif')) as tiff_image:
+        assert tiff_image.shape == (3,) + image.shape and tiff_image.dtype == numpy.float16
+        numpy.testing.assert_array_equal(tiff_image.layers[1][:], (image * 2).astype(numpy.float16))
+
+
+def test_sitk_backend_round_trip(tmp_path, input_fits, image, monkeypatch):
+    pytest.importorskip('SimpleITK')
+    monkeypatch.setattr(tiffpages, 'tifffile', None)
+    router.convert(input_fits, str(tmp_path / 'image.tif'))
+    router.convert(str(tmp_path / 'image.tif'), str(tmp_path / 'output.fits'))
+    with fits.open(str(tmp_path / 'output.fits')) as outputs:
+        numpy.testing.assert_array_equal(outputs[2].data, image * 3)
+
+
+def test_fits_without_images_is_not_written(tmp_path):
+    fits.HDUList([fits.PrimaryHDU()]).writeto(str(tmp_path / 'empty.fits'))
+    assert router.convert(str(tmp_path / 'empty.fits'), str(tmp_path / 'empty.tif'), verbose=False) is False
+
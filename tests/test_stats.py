@@ -0,0 +1,48 @@
+import tracemalloc
+from exrconverter import fits2exr
+from exrconverter.stats import STAGES, ConversionStats
+
+
+def test_conversion_stats(tmp_path, write_fits, image):
+    input_fits = write_fits(tmp_path / 'input.fits', image, image)
+    calls = []
+    stats = ConversionStats(callback=lambda stage, seconds, nbytes: calls.append(stage))
+    fits2exr.convert(input_fits, str(tmp_path / 'output.exr'), stats=stats)
+
+    assert stats.files == 1 and stats.pixels == 2 * image.size
+    assert list(stats.stages)[:len(STAGES)] == STAGES
+    assert stats.stages['read']['bytes'] == 2 * image.nbytes
+    assert set(calls) <= set(stats.stages) and stats.stages['write']['calls'] >= 1
+    assert stats.to_dict()['seconds'] == stats.elapsed > 0
+
+
+def test_merge_adds_up_figures_and_keeps_peaks():
+    first, second = ConversionStats(), ConversionStats()
+    first.record('read', 1.0, 10)
+    second.record('read', 2.0, 20)
+    first.peak_traced_bytes, second.peak_traced_bytes = 5, 7
+    merged = ConversionStats().merge(first).merge(second)
+    assert merged.stages['read'] == {'seconds': 3.0, 'bytes': 30, 'calls': 2}
+    assert merged.peak_traced_bytes == 7
+
+
+def test_trace_memory_in_a_pool_of_threads(tmp_path, write_fits, image):
+    for index in range(4):
+        write_fits(tmp_path / ('%d.fits' % index), image * index)
+    result = fits2exr.convert_directory(str(tmp_path), workers=2, pool='thread', trace_memory=True, verbose=False)
+
+    assert len(result.succeeded) == 4
+    assert all(file_result.stats.peak_traced_bytes >= image.nbytes for file_result in result.results)
+    assert not tracemalloc.is_tracing()
+
+
+def test_trace_memory_leaves_tracing_of_the_caller_on(tmp_path, write_fits, image):
+    input_fits = write_fits(tmp_path / 'input.fits', image)
+    tracemalloc.start()
+    try:
+        stats = ConversionStats(trace_memory=True)
+        fits2exr.convert(input_fits, str(tmp_path / 'output.exr'), stats=stats)
+        assert tracemalloc.is_tracing()
+        assert stats.peak_traced_bytes >= image.nbytes
+    finally:
+        tracemalloc.stop()
@@ -0,0 +1,76 @@
+import numpy
+import OpenEXR
+import pytest
+from astropy.io import fits
+from exrconverter import exr2fits, exr2tiff, fits2exr, tiff2exr
+from exrconverter.region import read_region
+from exrconverter.utils import __map as map_threads
+
+
+@pytest.fixture(autouse=True)
+def thread_count():
+    # threads= resizes the process-wide thread pool of OpenEXR, which is restored after each test.
+    count = OpenEXR.global_thread_count()
+    yield
+    OpenEXR.set_global_thread_count(count)
+
+
+@pytest.fixture
+def input_fits(tmp_path, write_fits, image):
+    return write_fits(tmp_path / 'input.fits', image, image * 2, image * 3, FILTER='g')
+
+
+def read_fits(path):
+    with fits.open(path) as hdu_list:
+        return [(hdu.data.copy(), hdu.header.get('FILTER')) for hdu in hdu_list]
+
+
+def test_map_keeps_the_order_of_the_items():
+    assert map_threads(lambda item: item * 2, range(20), threads=4) == list(range(0, 40, 2))
+    assert map_threads(lambda item: item * 2, [3], threads=4) == [6]
+
+
+@pytest.mark.parametrize('options', [{}, {'streaming': True, 'block_size': 16}, {'tile_size': 16},
+                                     {'compression': 'PIZ', 'channel_stats': True}])
+def test_fits2exr_threads_write_the_same_image(tmp_path, input_fits, options):
+    fits2exr.convert(input_fits, str(tmp_path / 'serial.exr'), **options)
+    fits2exr.convert(input_fits, str(tmp_path / 'threads.exr'), threads=4, **options)
+    assert OpenEXR.global_thread_count() == 4
+
+    serial, threaded = read_region(str(tmp_path / 'serial.exr')), read_region(str(tmp_path / 'threads.exr'))
+    assert list(threaded) == list(serial) == ['0', '1', '2']
+    for name in serial:
+        numpy.testing.assert_array_equal(threaded[name], serial[name])
+
+
+def test_fits2exr_threads_in_memory(image):
+    hdu_list = fits.HDUList([fits.PrimaryHDU(image), fits.ImageHDU(image * 2)])
+    assert read_region(fits2exr.from_hdulist(hdu_list, threads=3))['1'].tobytes() == (image * 2).tobytes()
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_exr2fits_threads_write_the_same_fits_file(tmp_path, input_fits, streaming):
+    fits2exr.convert(input_fits, str(tmp_path / 'input.exr'))
+    exr2fits.convert(str(tmp_path / 'input.exr'), str(tmp_path / 'serial.fits'), streaming=streaming)
+    exr2fits.convert(str(tmp_path / 'input.exr'), str(tmp_path / 'threads.fits'), streaming=streaming, threads=4)
+
+    serial, threaded = read_fits(str(tmp_path / 'serial.fits')), read_fits(str(tmp_path / 'threads.fits'))
+    assert len(threaded) == len(serial) == 3
+    for (serial_data, serial_filter), (data, threaded_filter) in zip(serial, threaded):
+        numpy.testing.assert_array_equal(data, serial_data)
+        assert threaded_filter == serial_filter == 'g'
+
+
+@pytest.mark.parametrize('backend', ['tifffile', 'sitk'])
+def test_tiff_threads_write_the_same_images(tmp_path, image, backend):
+    tifffile = pytest.importorskip('tifffile')
+    pytest.importorskip('SimpleITK')
+    stack = numpy.stack([image, image * 2, image * 3])
+    tifffile.imwrite(str(tmp_path / 'input.tif'), stack, photometric='minisblack', compression='zlib', rowsperstrip=8)
+
+    tiff2exr.convert(str(tmp_path / 'input.tif'), str(tmp_path / 'threads.exr'), backend=backend, threads=4)
+    region = read_region(str(tmp_path / 'threads.exr'))
+    numpy.testing.assert_array_equal(numpy.stack([region[name] for name in ('0', '1', '2')]), stack)
+
+    exr2tiff.convert(str(tmp_path / 'threads.exr'), str(tmp_path / 'threads.tif'), backend=backend, threads=4)
+    numpy.testing.assert_array_equal(tifffile.imread(str(tmp_path / 'threads.tif')), stack)
@@ -0,0 +1,74 @@
+import logging
+import numpy
+import pytest
+from exrconverter import exr2tiff, tiff2exr
+from exrconverter.region import read_region
+
+tifffile = pytest.importorskip('tifffile')
+from exrconverter.tiffpages import PageReader, PageWriter  # noqa: E402
+
+
+@pytest.fixture
+def stack(image):
+    return numpy.stack([image, image * 2, image * 3])
+
+
+@pytest.mark.parametrize('options', [{}, {'compression': 'zlib', 'rowsperstrip': 7}, {'tile': (16, 16)}])
+def test_page_reader_reads_rows(tmp_path, stack, options):
+    path = str(tmp_path / 'stack.tif')
+    tifffile.imwrite(path, stack, photometric='minisblack', **options)
+    with PageReader(path) as reader:
+        assert reader.shape == stack.shape and reader.dtype == stack.dtype
+        numpy.testing.assert_array_equal(reader.read_page(1), stack[1])
+        numpy.testing.assert_array_equal(reader.read_rows(2, 5, 23), stack[2, 5:23])
+        numpy.testing.assert_array_equal(reader.page(0)[3:9, 4:8], stack[0, 3:9, 4:8])
+
+
+def test_page_reader_keeps_the_tags_of_every_page(tmp_path, image):
+    path = str(tmp_path / 'stack.tif')
+    with PageWriter(path, (3,) + image.shape, image.dtype) as writer:
+        writer.write(image, {'Artist': 'A', 'PageName': 'first', 'ImageDescription': 'one'})
+        writer.write(image, {'Artist': 'A', 'PageName': 'second'})
+        writer.write(image, {'Artist': 'A'})
+    with PageReader(path) as reader:
+        assert reader.headers[0] == {'Artist': 'A'}
+        assert reader.headers[1] == {'Artist': 'A', 'PageName': 'first', 'ImageDescription': 'one'}
+        assert reader.headers[2] == {'Artist': 'A', 'PageName': 'second'}
+        assert reader.headers[3] == {'Artist': 'A'}
+
+
+def test_page_reader_rejects_color_images(tmp_path, image):
+    path = str(tmp_path / 'rgb.tif')
+    tifffile.imwrite(path, numpy.stack([image] * 3, axis=-1).astype(numpy.uint8), photometric='rgb')
+    with pytest.raises(Exception):
+        PageReader(path)
+
+
+def test_shaped_descriptions_are_not_copied(tmp_path, stack, caplog):
+    input_tiff = str(tmp_path / 'stack.tif')
+    tifffile.imwrite(input_tiff, stack, photometric='minisblack', metadata={'OBJECT': 'M31'})
+    with PageReader(input_tiff) as reader:
+        assert reader.headers[1]['ImageDescription'] == '{"OBJECT": "M31"}'
+
+    tiff2exr.convert(input_tiff, str(tmp_path / 'stack.exr'))
+    with caplog.at_level(logging.WARNING):
+        exr2tiff.convert(str(tmp_path / 'stack.exr'), str(tmp_path / 'cutout.tif'), window=(0, 0, 10, 8), channels=[1])
+        cutout = tifffile.imread(str(tmp_path / 'cutout.tif'))
+    assert not caplog.records
+    numpy.testing.assert_array_equal(cutout, stack[1, :8, :10])
+
+
+def test_tifffile_and_sitk_backends_agree(tmp_path, stack):
+    pytest.importorskip('SimpleITK')
+    input_tiff = str(tmp_path / 'stack.tif')
+    tifffile.imwrite(input_tiff, stack, photometric='minisblack')
+    for backend in ('tifffile', 'sitk'):
+        tiff2exr.convert(input_tiff, str(tmp_path / (backend + '.exr')), backend=backend)
+        region = read_region(str(tmp_path / (backend + '.exr')))
+        numpy.testing.assert_array_equal(numpy.stack([region[name] for name in ('0', '1', '2')]), stack)
+
+        exr2tiff.convert(str(tmp_path / (backend + '.exr')), str(tmp_path / (backend + '.tif')), backend=backend)
+        numpy.testing.assert_array_equal(tifffile.imread(str(tmp_path / (backend + '.tif'))), stack)
+
+    with pytest.raises(Exception):
+        tiff2exr.convert(input_tiff, str(tmp_path / 'other.exr'), backend='other')
@@ -0,0 +1,43 @@
+import numpy
+import pytest
+from exrconverter.pixeltype import PixelType
+from exrconverter.utils import __change_array_type as change_array_type, __new_buffer as new_buffer
+
+
+def test_arrays_of_the_requested_type_are_not_copied(image):
+    assert change_array_type(image, PixelType.FLOAT32) is image
+    assert change_array_type(image, numpy.float32) is image
+
+    columns = change_array_type(image[:, ::2], PixelType.FLOAT32)
+    assert columns.flags['C_CONTIGUOUS'] and not numpy.shares_memory(columns, image)
+    numpy.testing.assert_array_equal(columns, image[:, ::2])
+
+
+def test_big_endian_arrays_are_swapped_and_cast_at_once(image):
+    big_endian = image.astype('>f4')
+    native = change_array_type(big_endian, PixelType.FLOAT32)
+    assert native.dtype == numpy.dtype('=f4')
+    numpy.testing.assert_array_equal(native, image)
+
+    half = change_array_type(big_endian, PixelType.FLOAT16)
+    assert half.dtype == numpy.dtype('=f2')
+    numpy.testing.assert_array_equal(half, image.astype(numpy.float16))
+
+    assert change_array_type(image, PixelType.FLOAT64, byteorder='>').dtype == numpy.dtype('>f8')
+    assert change_array_type(big_endian, PixelType.FLOAT32, byteorder='>') is big_endian
+
+
+def test_conversions_into_a_reused_buffer(image):
+    out = new_buffer(image.shape, PixelType.FLOAT16)
+    assert change_array_type(image.astype('>f4'), PixelType.FLOAT16, out=out) is out
+    numpy.testing.assert_array_equal(out, image.astype(numpy.float16))
+
+    with pytest.raises(Exception):
+        change_array_type(image[1:], PixelType.FLOAT16, out=out)
+    with pytest.raises(Exception):
+        change_array_type(image, PixelType.FLOAT32, out=out)
+
+
+def test_unsupported_pixel_types():
+    with pytest.raises(Exception):
+        change_array_type(numpy.zeros(3, numpy.uint32), numpy.uint32)
@@ -0,0 +1,119 @@
+import numpy
+import pytest
+from astropy.io import fits
+from exrconverter import fits2exr, tiff2exr, verification
+from exrconverter.pixeltype import PixelType
+
+
+@pytest.fixture
+def special_image(image):
+    image = image.copy()
+    image[0, 0] = 70000.0  # becomes inf in float16
+    image[1, 1] = numpy.nan
+    image[2, 2] = -numpy.inf
+    return image
+
+
+def test_channel_stats_accumulate_across_blocks(special_image):
+    whole = verification.ChannelStats()
+    whole.update(special_image)
+    blocks = verification.ChannelStats()
+    for first_row in range(0, special_image.shape[0], 7):
+        blocks.update(special_image[first_row:first_row + 7])
+
+    assert blocks.to_dict() == whole.to_dict()
+    finite = special_image[numpy.isfinite(special_image)]
+    assert whole.to_dict() == {'crc32': whole.crc32, 'min': float(finite.min()), 'max': 70000.0, 'nan': 1, 'inf': 1,
+                               'float16_overflow': 1}
+
+
+def test_checksum_is_of_the_stored_pixels(image):
+    source = verification.ChannelStats()
+    source.update(image)
+    stored = verification.ChannelStats()
+    stored.update(image, image.astype(numpy.float16))
+    assert stored.crc32 != source.crc32
+    assert dict(stored.to_dict(), crc32=None) == dict(source.to_dict(), crc32=None)
+
+
+def test_verify_float16_conversion_of_several_hdus(tmp_path, write_fits, image):
+    input_fits = write_fits(tmp_path / 'input.fits', image, image * 2)
+    output_exr = str(tmp_path / 'output.exr')
+    fits2exr.convert(input_fits, output_exr, output_pixel_type=PixelType.FLOAT16, channel_stats=True)
+
+    # fits2exr only keeps the first HDU, since the second one is not FLOAT16, and so does verify.
+    report = verification.verify(output_exr, source=input_fits, tolerance=0.5)
+    assert report['match'] and list(report['channels']) == ['0']
+    channel = report['channels']['0']
+    assert channel['checksum'] is True
+    assert 0 < channel['rms_error'] <= channel['max_error'] <= 0.5
+    assert channel['nonfinite_mismatch'] == 0
+
+    assert not verification.verify(output_exr, source=input_fits, tolerance=channel['max_error'] / 2)['match']
+
+
+def test_verify_skips_the_hdus_fits2exr_skipped(tmp_path, write_fits, image):
+    input_fits = write_fits(tmp_path / 'input.fits', image, numpy.arange(image.size, dtype=numpy.int16).reshape(
+        image.shape), image * 3, numpy.zeros((5, 5), numpy.float32))
+    output_exr = str(tmp_path / 'output.exr')
+    fits2exr.convert(input_fits, output_exr, channel_stats=True)
+
+    report = verification.verify(output_exr, source=input_fits, tolerance=0)
+    assert report['match'] and list(report['channels']) == ['0', '1']
+
+
+@pytest.mark.filterwarnings('ignore:overflow encountered in cast')
+def test_verify_reports_float16_overflows(tmp_path, write_fits, special_image):
+    input_fits = write_fits(tmp_path / 'input.fits', special_image)
+    output_exr = str(tmp_path / 'output.exr')
+    fits2exr.convert(input_fits, output_exr, output_pixel_type=PixelType.FLOAT16, channel_stats=True)
+
+    assert verification.read_channel_stats(output_exr)['0']['float16_overflow'] == 1
+    report = verification.verify(output_exr, source=input_fits, tolerance=0.5, block_size=16)
+    assert not report['match']
+    assert report['channels']['0']['checksum'] is True
+    assert report['channels']['0']['nonfinite_mismatch'] == 1
+
+
+def test_streaming_and_cube_conversions_store_the_same_stats(tmp_path, write_fits, image):
+    input_fits = write_fits(tmp_path / 'input.fits', image, image * 2)
+    fits2exr.convert(input_fits, str(tmp_path / 'whole.exr'), channel_stats=True)
+    fits2exr.convert(input_fits, str(tmp_path / 'streaming.exr'), channel_stats=True, streaming=True, block_size=16)
+    assert verification.read_channel_stats(str(tmp_path / 'streaming.exr')) == \
+        verification.read_channel_stats(str(tmp_path / 'whole.exr'))
+
+    cube_fits = write_fits(tmp_path / 'cube.fits', numpy.stack([image, image + 1, image + 2]))
+    fits2exr.convert(cube_fits, str(tmp_path / 'cube.exr'), channel_stats=True)
+    report = verification.verify(str(tmp_path / 'cube.exr'), source=cube_fits, tolerance=0)
+    assert report['match'] and len(report['channels']) == 3
+    assert all(channel['checksum'] for channel in report['channels'].values())
+
+
+def test_verify_detects_lossy_codecs_and_files_without_stats(tmp_path, write_fits, image):
+    input_fits = write_fits(tmp_path / 'input.fits', image)
+    fits2exr.convert(input_fits, str(tmp_path / 'lossy.exr'), output_pixel_type=PixelType.FLOAT16,
+                     compression='B44', channel_stats=True)
+    report = verification.verify(str(tmp_path / 'lossy.exr'))
+    assert not report['match'] and report['channels']['0']['checksum'] is False
+
+    fits2exr.convert(input_fits, str(tmp_path / 'plain.exr'))
+    assert verification.read_channel_stats(str(tmp_path / 'plain.exr')) == {}
+    report = verification.verify(str(tmp_path / 'plain.exr'), source=input_fits, tolerance=0)
+    assert report['match'] and report['channels']['0']['checksum'] is None
+
+
+def test_verify_in_memory_conversions(image):
+    exr_bytes = fits2exr.from_hdulist(fits.HDUList([fits.PrimaryHDU(image)]), channel_stats=True)
+    assert verification.verify(exr_bytes)['match']
+
+
+def test_verify_tiff_conversions(tmp_path, image):
+    tifffile = pytest.importorskip('tifffile')
+    input_tiff = str(tmp_path / 'input.tif')
+    tifffile.imwrite(input_tiff, numpy.stack([image, image * 2]))
+    for index, options in enumerate([{}, {'tile_size': 16}, {'output_pixel_type': PixelType.FLOAT16}]):
+        output_exr = str(tmp_path / ('output%d.exr' % index))
+        tiff2exr.convert(input_tiff, output_exr, channel_stats=True, **options)
+        report = verification.verify(output_exr, source=input_tiff, tolerance=0.5)
+        assert report['match'] and len(report['channels']) == 2
+        assert all(channel['checksum'] for channel in report['channels'].values())
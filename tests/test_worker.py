@@ -0,0 +1,65 @@
+import json
+import os
+import numpy
+import pytest
+from exrconverter import cli, worker
+from exrconverter.region import read_region
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return str(tmp_path / 'spool')
+
+
+def test_submitted_jobs_are_converted_oldest_first(tmp_path, spool, write_fits, image):
+    input_fits = write_fits(tmp_path / 'input.fits', image)
+    good = worker.submit(spool, input_fits, str(tmp_path / 'output.exr'), output_pixel_type='float16')
+    bad = worker.submit(spool, str(tmp_path / 'missing.fits'), str(tmp_path / 'missing.exr'))
+    assert worker.get_result(spool, good, timeout=0) is None
+
+    assert worker.serve(spool, max_jobs=2, verbose=False) == 2
+    result = worker.get_result(spool, good)
+    assert result['status'] == 'done' and result['error'] is None and result['stats']['pixels'] == image.size
+    numpy.testing.assert_array_equal(read_region(str(tmp_path / 'output.exr'))['0'], image.astype(numpy.float16))
+    assert worker.get_result(spool, bad)['status'] == 'failed' and not os.path.exists(str(tmp_path / 'missing.exr'))
+    assert all(os.listdir(os.path.join(spool, directory)) == [] for directory in ('incoming', 'running'))
+
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_pools_of_workers(tmp_path, spool, write_fits, image, pool):
+    job_ids = [worker.submit(spool, write_fits(tmp_path / ('%d.fits' % index), image * index),
+                             str(tmp_path / ('%d.exr' % index))) for index in range(3)]
+    assert worker.serve(spool, workers=2, pool=pool, max_jobs=3, formats=['fits', 'exr'], verbose=False) == 3
+    assert [worker.get_result(spool, job_id)['status'] for job_id in job_ids] == ['done'] * 3
+    numpy.testing.assert_array_equal(read_region(str(tmp_path / '2.exr'))['0'], image * 2)
+
+
+def test_idle_workers_stop(spool):
+    assert worker.serve(spool, idle_timeout=0.05, poll_interval=0.01, verbose=False) == 0
+    with pytest.raises(Exception):
+        worker.serve(spool, workers=2, pool='cluster')
+
+
+def test_invalid_jobs_fail_and_running_jobs_can_be_requeued(tmp_path, spool):
+    os.makedirs(os.path.join(spool, 'incoming'))
+    with open(os.path.join(spool, 'incoming', 'broken.json'), 'w') as job_file:
+        job_file.write('{"input": ')
+    with pytest.warns(UserWarning):
+        assert worker.serve(spool, idle_timeout=0.05, poll_interval=0.01, verbose=False) == 0
+    assert 'Invalid job file' in worker.get_result(spool, 'broken')['error']
+
+    job_id = worker.submit(spool, 'input.fits', 'output.exr')
+    os.rename(os.path.join(spool, 'incoming', job_id + '.json'), os.path.join(spool, 'running', job_id + '.json'))
+    assert worker.requeue(spool, ['other']) == []
+    assert worker.requeue(spool) == [job_id]
+    with open(os.path.join(spool, 'incoming', job_id + '.json')) as job_file:
+        assert json.load(job_file)['input'] == os.path.abspath('input.fits')
+
+
+def test_submit_command(tmp_path, spool, write_fits, image, capsys):
+    input_fits = write_fits(tmp_path / 'input.fits', image)
+    assert cli.main(['submit', spool, input_fits, str(tmp_path / 'output.exr'), '--compression', 'PIZ']) == 0
+    job_id = capsys.readouterr().out.strip()
+    assert cli.main(['worker', spool, '--max-jobs', '1', '--quiet']) == 0
+    assert worker.get_result(spool, job_id)['options'] == {'compression': 'PIZ'}
+    assert cli.main(['submit', spool, input_fits, str(tmp_path / 'other.exr'), '--wait', '--timeout', '0.05']) == 1